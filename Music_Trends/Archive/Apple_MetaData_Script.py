@@ -1,5 +1,13 @@
+import os
+import sys
 import requests
-import pandas as pd
+
+# The shared HTTP cache lives with the other scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Python_Scripts'))
+from http_cache import cached_get
+from storage import load_frame, save_frame, export_excel
+from throttle import get_throttle, log_throttle_metrics
+from metrics import get_metrics, write_metrics
 
 def search_itunes(song_title, artist_name, limit=1):
     """Search iTunes for a song and artist and return the metadata"""
@@ -11,7 +19,11 @@ def search_itunes(song_title, artist_name, limit=1):
         "limit": limit
     }
 
-    response = requests.get(base_url, params=search_params)
+    # iTunes answers 429 when called too fast; the throttle backs off and adapts the rate
+    def fetch(url, **kwargs):
+        return get_throttle('itunes').call(lambda: requests.get(url, timeout=30, **kwargs))
+
+    response = cached_get('itunes', base_url, params=search_params, fetch=fetch)
 
     if response.status_code != 200:
         print("Failed to retrieve data from iTunes")
@@ -23,11 +35,11 @@ def search_itunes(song_title, artist_name, limit=1):
     else:
         return None
     
-def fetch_metadata(input_file, output_file):
+def fetch_metadata(input_file, output_file, title_column='song', artist_column='artist'):
     """Fetch iTunes metadata for songs in the Excel file"""
 
-    #Read the Excel file
-    df = pd.read_excel(input_file)
+    #Read the input dataset (its Parquet copy once one exists)
+    df = load_frame(input_file)
 
     #Add new columns to store metadata
     df['Album'] = ""
@@ -35,9 +47,10 @@ def fetch_metadata(input_file, output_file):
     df['Release Date'] = ""
     df['iTunes URL'] = ""
 
+    progress = get_metrics().progress('itunes', len(df))
     for index, row in df.iterrows():
-        title = row['song']
-        artist = row['artist']
+        title = row[title_column]
+        artist = row[artist_column]
 
         #Search iTunes for the song
         itunes_data = search_itunes(title, artist)
@@ -52,9 +65,13 @@ def fetch_metadata(input_file, output_file):
             df.at[index, 'Genre'] = "N/A"
             df.at[index, 'Release Date'] = "N/A"
             df.at[index, 'iTunes URL'] = "N/A"
+        progress.advance()
         
-    df.to_excel(output_file, index=False)
+    save_frame(df, output_file)
+    export_excel(df, output_file)
     print(f"Metadata has been written to {output_file}")
+    log_throttle_metrics()
+    write_metrics()
 
 if __name__ == "__main__":
     input_file = input("Enter the input Excel file: ")
@@ -1,24 +1,19 @@
-import json
-from spotipy.oauth2 import SpotifyClientCredentials
-import spotipy
+from app_config import get_config
+from spotify_pool import PooledClient, load_credentials
 
-# Load the Spotify credentials from the config.json file
-with open('config.json', 'r') as config_file:
-    config = json.load(config_file)
+def main():
+    # Check every client_id/client_secret pair the metadata client pool will use
+    # (load_credentials raises if none are filled in)
+    for name, client_id, client_secret in load_credentials(get_config()):
+        # Same client the pool builds, so the token it gets is cached for the metadata runs
+        sp = PooledClient(name, client_id, client_secret, rate=1).sp
 
-client_id = config['spotify']['client_id_5']
-client_secret = config['spotify']['client_secret_5']
+        # Test the connection by fetching a song to ensure the API works
+        try:
+            result = sp.search(q='track:Hello artist:Adele', type='track')
+            print(f"{name}: OK ({result['tracks']['items'][0]['name']})")
+        except Exception as e:
+            print(f"{name}: FAILED ({e})")
 
-# Check if credentials are loaded correctly
-if not client_id or not client_secret:
-    raise Exception("Spotify API credentials are missing in the config.json file.")
-
-# Set up Spotify credentials manager
-client_credentials_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret)
-
-# Initialize Spotify client with credentials manager
-sp = spotipy.Spotify(client_credentials_manager=client_credentials_manager)
-
-# Test the connection by fetching a song to ensure the API works
-result = sp.search(q='track:Hello artist:Adele', type='track')
-print(result)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+import json
+import os
+import threading
+
+# config.json holds the Genius token and the Spotify app credentials
+DEFAULT_CONFIG_PATH = os.environ.get('MUSIC_TRENDS_CONFIG', 'config.json')
+
+_configs = {}
+_lock = threading.Lock()
+
+
+def get_config(path=None):
+    """The parsed config file, read on first use and reused after that
+
+    Nothing reads config.json at import time, so modules can be imported
+    (by the pipeline, worker processes or benchmarks) without it.
+    """
+    path = path or DEFAULT_CONFIG_PATH
+    with _lock:
+        if path not in _configs:
+            with open(path) as config_file:
+                _configs[path] = json.load(config_file)
+        return _configs[path]
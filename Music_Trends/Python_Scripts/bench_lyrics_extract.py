@@ -0,0 +1,62 @@
+import argparse
+import glob
+import os
+import time
+
+from bs4 import BeautifulSoup
+
+from lyrics_extract import EXTRACTORS, available_extractors
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'genius')
+
+
+def baseline_genius_lyrics(content):
+    """The parsing genuisLyrics.scrape_lyrics used before the extractor module"""
+    soup = BeautifulSoup(content, 'html.parser')
+    lyrics_divs = soup.find_all('div', class_='Lyrics__Container')
+    if not lyrics_divs:
+        return None
+    return '\n'.join([div.get_text(separator="\n").strip() for div in lyrics_divs])
+
+def baseline_lyrics_scrape(content):
+    """The parsing lyricsScrape.fetch_lyrics_from_url used before the extractor module"""
+    soup = BeautifulSoup(content, 'html.parser')
+    lyrics_div = soup.find('div', {'data-lyrics-container': 'true', 'class': 'Lyrics__Container-sc-1ynbvzw-1 kUgSbL'})
+    if lyrics_div:
+        return lyrics_div.get_text(separator="\n").strip()
+    return None
+
+def load_fixtures(fixture_dir):
+    """(name, content, expects_lyrics) per saved page; pages named instrumental_* have no lyrics"""
+    fixtures = []
+    for path in sorted(glob.glob(os.path.join(fixture_dir, '*.html'))):
+        name = os.path.basename(path)
+        with open(path, 'rb') as page:
+            fixtures.append((name, page.read(), not name.startswith('instrumental')))
+    return fixtures
+
+def run(extract, fixtures, rounds):
+    """Pages per second and the share of pages where lyrics were (not) found against expectation"""
+    failures = sum((extract(content) is not None) != expected for _, content, expected in fixtures)
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for _, content, _ in fixtures:
+            extract(content)
+    elapsed = time.perf_counter() - started
+    return rounds * len(fixtures) / elapsed, failures / len(fixtures)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare lyrics extractors on saved Genius pages")
+    parser.add_argument('--fixtures', default=FIXTURE_DIR, help="Directory of saved Genius song pages")
+    parser.add_argument('--rounds', type=int, default=50, help="Times every page is parsed")
+    args = parser.parse_args()
+
+    fixtures = load_fixtures(args.fixtures)
+    candidates = {'genuisLyrics (old)': baseline_genius_lyrics, 'lyricsScrape (old)': baseline_lyrics_scrape}
+    candidates.update({name: EXTRACTORS[name] for name in available_extractors()})
+
+    print(f"{len(fixtures)} fixture pages, {args.rounds} rounds")
+    print(f"{'extractor':<22}{'pages/s':>10}{'failure rate':>15}")
+    for name, extract in candidates.items():
+        pages_per_second, failure_rate = run(extract, fixtures, args.rounds)
+        print(f"{name:<22}{pages_per_second:>10.1f}{failure_rate:>15.0%}")
@@ -0,0 +1,71 @@
+import argparse
+import os
+import resource
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from billboard_data_scrape import parse_billboard_html
+from lyrics_extract import extract_lyrics
+from parse_pool import ParsePool
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Saved page and the parser the scrapers use for it
+PAGES = {
+    'billboard': ('billboard/hot100_page.html', parse_billboard_html),
+    'genius': ('genius/modern_page.html', extract_lyrics),
+}
+
+
+def load_page(name):
+    with open(os.path.join(FIXTURE_DIR, PAGES[name][0]), 'rb') as page:
+        return page.read()
+
+def threads_only(content, parse, pages, fetch_workers, latency):
+    """Download and parse on the same threads, as the scrapers do without --parse-workers"""
+    def fetch_and_parse(_):
+        time.sleep(latency)
+        return parse(content)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=fetch_workers) as executor:
+        list(executor.map(fetch_and_parse, range(pages)))
+    return pages / (time.perf_counter() - started)
+
+def with_parse_pool(content, parse, pages, fetch_workers, parse_workers, latency, max_pending):
+    def fetch(_):
+        time.sleep(latency)
+        return content, None
+
+    pool = ParsePool(fetch, parse, fetch_workers, parse_workers, max_pending)
+    started = time.perf_counter()
+    for _ in pool.run(range(pages)):
+        pass
+    return pages / (time.perf_counter() - started)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure how page parsing scales across processes on saved fixture pages")
+    parser.add_argument('--page', choices=sorted(PAGES), default='billboard', help="Which saved page to parse")
+    parser.add_argument('--pages', type=int, default=400, help="Pages pushed through each configuration")
+    parser.add_argument('--fetch-workers', type=int, default=8, help="Download threads")
+    parser.add_argument('--latency', type=float, default=0.02, help="Simulated seconds per download")
+    parser.add_argument('--max-pending', type=int, default=32, help="Bound on queued and in-flight pages")
+    args = parser.parse_args()
+
+    content = load_page(args.page)
+    parse = PAGES[args.page][1]
+    cores = os.cpu_count()
+    print(f"{args.pages} {args.page} pages ({len(content) // 1024} KiB each), {args.fetch_workers} download threads, "
+          f"{args.latency * 1000:.0f} ms per download, {cores} CPUs")
+    print(f"{'configuration':<26}{'pages/s':>10}{'speedup':>10}")
+
+    baseline = threads_only(content, parse, args.pages, args.fetch_workers, args.latency)
+    print(f"{'threads only':<26}{baseline:>10.1f}{1:>9.2f}x")
+    workers = 1
+    while workers <= cores:
+        rate = with_parse_pool(content, parse, args.pages, args.fetch_workers, workers, args.latency, args.max_pending)
+        print(f"{f'{workers} parse processes':<26}{rate:>10.1f}{rate / baseline:>9.2f}x")
+        workers *= 2
+
+    # Peak memory of this process stays flat because at most 2 x max_pending pages are held
+    print(f"Peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB")
@@ -0,0 +1,396 @@
+import argparse
+import contextlib
+import copy
+import hashlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = os.path.join(SCRIPT_DIR, 'fixtures')
+
+# One JSON line per suite run, so every run can be compared with the ones before it
+RESULTS_PATH = os.path.join(SCRIPT_DIR, 'bench_results.jsonl')
+
+# A benchmark whose median time grows by more than this against the last run is flagged
+REGRESSION_THRESHOLD = 0.10
+
+
+def read_fixture(*parts):
+    with open(os.path.join(FIXTURE_DIR, *parts), 'rb') as f:
+        return f.read()
+
+def _id(text):
+    # Spotify-looking 22 character id that is stable for the same text
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:22]
+
+
+class StubServer:
+    """Replays the recorded Genius and Spotify fixtures on 127.0.0.1
+
+    Responses are built from the saved fixtures with ids and URLs derived from
+    the request, so every song looks different to the caches and planners.
+    `latency` seconds are added to every response to stand in for the network.
+    Arrival times and the most requests ever in flight at once are recorded.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.arrivals = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self.genius_search = json.loads(read_fixture('genius', 'search_response.json'))
+        self.genius_page = read_fixture('genius', 'modern_page.html')
+        self.spotify_search = json.loads(read_fixture('spotify', 'search_response.json'))
+        self.spotify_artist = json.loads(read_fixture('spotify', 'artist.json'))
+        self.requests = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _track(self, query):
+        track = copy.deepcopy(self.spotify_search['tracks']['items'][0])
+        track['id'] = _id('track ' + query)
+        track['name'] = query
+        # A handful of artists, so the artist dedup has something to do
+        track['artists'][0]['id'] = _id(f"artist {int(_id(query), 16) % 25}")
+        return track
+
+    def _artist(self, artist_id):
+        artist = dict(self.spotify_artist)
+        artist['id'] = artist_id
+        return artist
+
+    def respond(self, path, query):
+        if path == '/genius/search':
+            result = copy.deepcopy(self.genius_search)
+            slug = _id(query['q'][0])
+            result['response']['hits'][0]['result']['url'] = f"{self.url}/genius/page/{slug}"
+            return 'application/json', json.dumps(result).encode('utf-8')
+        if path.startswith('/genius/page/'):
+            return 'text/html', self.genius_page
+        if path == '/v1/search':
+            result = copy.deepcopy(self.spotify_search)
+            result['tracks']['items'] = [self._track(query['q'][0])]
+            return 'application/json', json.dumps(result).encode('utf-8')
+        if path == '/v1/artists':
+            artists = [self._artist(i) for i in query['ids'][0].split(',')]
+            return 'application/json', json.dumps({'artists': artists}).encode('utf-8')
+        if path == '/v1/tracks':
+            tracks = [dict(self._track(i), id=i) for i in query['ids'][0].split(',')]
+            return 'application/json', json.dumps({'tracks': tracks}).encode('utf-8')
+        return None
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                with stub._lock:
+                    stub.requests += 1
+                    stub.arrivals.append(time.monotonic())
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                try:
+                    if stub.latency:
+                        time.sleep(stub.latency)
+                    found = stub.respond(url.path.rstrip('/'), parse_qs(url.query))
+                finally:
+                    with stub._lock:
+                        stub.in_flight -= 1
+                if found is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                content_type, body = found
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def synthetic_charts(path, rows):
+    """A charts.csv with the Kaggle columns and realistic song runs (the real file lives in git LFS)"""
+    rng = np.random.default_rng(69)
+    weeks = rows // 100
+    dates = pd.date_range('1958-08-04', periods=weeks, freq='7D').strftime('%Y-%m-%d')
+    song_ids = (np.arange(weeks)[:, None] // 10 * 40 + rng.integers(0, 400, size=(weeks, 100))).ravel()
+    pd.DataFrame({
+        'date': np.repeat(dates, 100),
+        'rank': np.tile(np.arange(1, 101), weeks),
+        'song': [f"Song {i}" for i in song_ids],
+        'artist': [f"Artist {i % 997}" for i in song_ids],
+        'last-week': rng.integers(1, 101, size=weeks * 100),
+        'peak-rank': rng.integers(1, 101, size=weeks * 100),
+        'weeks-on-board': rng.integers(1, 60, size=weeks * 100),
+    }).to_csv(path, index=False)
+
+
+class Suite:
+    """Runs every benchmark in a scratch directory against the stub server"""
+
+    def __init__(self, workdir, stub, size):
+        self.workdir = workdir
+        self.stub = stub
+        self.size = size
+        self.benchmarks = {
+            'chart_page_parse': self.chart_page_parse,
+            'lyrics_page_parse': self.lyrics_page_parse,
+            'charts_csv_load': self.charts_csv_load,
+            'charts_parquet_load': self.charts_parquet_load,
+            'charts_stream_aggregate': self.charts_stream_aggregate,
+            'lyrics_checkpoint_append': self.lyrics_checkpoint_append,
+            'lyrics_fetch_serial': self.lyrics_fetch_serial,
+            'lyrics_fetch_concurrent': self.lyrics_fetch_concurrent,
+            'spotify_metadata_batched': self.spotify_metadata_batched,
+        }
+
+    def path(self, name):
+        return os.path.join(self.workdir, name)
+
+    def fresh_cache(self):
+        from http_cache import configure_cache
+        path = self.path('bench_cache.sqlite')
+        if os.path.exists(path):
+            os.remove(path)
+        configure_cache(path)
+
+    # Each benchmark returns (setup, run, items); only run() is timed
+
+    def chart_page_parse(self):
+        from billboard_data_scrape import parse_billboard_html
+        page = read_fixture('billboard', 'hot100_page.html')
+        return None, lambda: parse_billboard_html(page), 1
+
+    def lyrics_page_parse(self):
+        from lyrics_extract import extract_lyrics
+        pages = [read_fixture('genius', name) for name in sorted(os.listdir(os.path.join(FIXTURE_DIR, 'genius')))
+                 if name.endswith('.html')]
+        return None, lambda: [extract_lyrics(page) for page in pages], len(pages)
+
+    def _charts_csv(self):
+        path = self.path('charts.csv')
+        if not os.path.exists(path):
+            synthetic_charts(path, self.size * 100)
+        return path
+
+    def charts_csv_load(self):
+        path = self._charts_csv()
+        return None, lambda: pd.read_csv(path), self.size * 100
+
+    def charts_parquet_load(self):
+        from storage import convert_charts_csv, read_charts
+        dataset = self.path('charts_parquet')
+        if not os.path.exists(dataset):
+            convert_charts_csv(self._charts_csv(), dataset)
+        return None, lambda: read_charts(dataset), self.size * 100
+
+    def charts_stream_aggregate(self):
+        from chart_stream import aggregate_charts
+        path = self._charts_csv()
+        return None, lambda: aggregate_charts(path), self.size * 100
+
+    def lyrics_checkpoint_append(self):
+        # The per-row save that replaced rewriting the _partial_save.xlsx workbook
+        from checkpoint import CheckpointStore
+        path = self.path('bench_checkpoint.jsonl')
+        rows = [{'Song': f"Song {i}", 'Artist': f"Artist {i}"} for i in range(self.size)]
+        lyrics = read_fixture('genius', 'modern_page.html').decode('utf-8')[:2000]
+
+        def setup():
+            if os.path.exists(path):
+                os.remove(path)
+
+        def run():
+            store = CheckpointStore(path)
+            for row in rows:
+                store.append(row, Lyrics_URL='https://genius.com/x', Lyrics=lyrics)
+            store.close()
+        return setup, run, self.size
+
+    def _songs(self, name, count):
+        path = self.path(name)
+        pd.DataFrame({'Song': [f"Song {i}" for i in range(count)],
+                      'Artist': [f"Artist {i % 250}" for i in range(count)]}).to_excel(path, index=False)
+        return path
+
+    def _lyrics_fetch(self, workers):
+        import genuisLyrics
+        genuisLyrics.GENIUS_SEARCH_URL = f"{self.stub.url}/genius/search"
+        songs = min(self.size, 200)
+        source = self._songs(f'bench_songs_{workers}.xlsx', songs)
+        output = self.path(f'bench_songs_{workers}_out.xlsx')
+
+        def setup():
+            self.fresh_cache()
+            for leftover in (source.replace('.xlsx', '_checkpoint.jsonl'), source.replace('.xlsx', '.parquet')):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+        def run():
+            genuisLyrics.fetch_all_lyrics(source, output, workers=workers, rate=10000)
+        return setup, run, songs
+
+    def lyrics_fetch_serial(self):
+        return self._lyrics_fetch(1)
+
+    def lyrics_fetch_concurrent(self):
+        return self._lyrics_fetch(8)
+
+    def spotify_metadata_batched(self):
+        import spotipy
+        import requests
+        import metadataSpotifyGathering
+        for client in metadataSpotifyGathering.get_pool().clients:
+            client.sp = spotipy.Spotify(auth='bench', requests_session=requests.Session())
+            client.sp.prefix = f"{self.stub.url}/v1/"
+        songs = min(self.size, 500)
+        source = self._songs('bench_spotify.xlsx', songs)
+
+        def setup():
+            self.fresh_cache()
+            for leftover in (metadataSpotifyGathering.new_excel_path(source), source.replace('.xlsx', '.parquet')):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+        def run():
+            metadataSpotifyGathering.enrich_file(source, batched=True)
+        return setup, run, songs
+
+    def run(self, name, rounds):
+        setup, run, items = self.benchmarks[name]()
+        times = []
+        for round_number in range(rounds + 1):
+            if setup is not None:
+                setup()
+            started = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                run()
+            elapsed = time.perf_counter() - started
+            if round_number > 0:  # The first round only warms imports and caches
+                times.append(elapsed)
+        median = statistics.median(times)
+        return {
+            'rounds': rounds,
+            'median_s': round(median, 6),
+            'min_s': round(min(times), 6),
+            'max_s': round(max(times), 6),
+            'items': items,
+            'items_per_s': round(items / median, 2),
+        }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_history(path=RESULTS_PATH):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def compare(previous, current, threshold=REGRESSION_THRESHOLD):
+    """(name, change) for every benchmark that got slower than `threshold` since `previous`"""
+    regressions = []
+    for name, result in current['results'].items():
+        before = previous['results'].get(name)
+        if before:
+            change = result['median_s'] / before['median_s'] - 1
+            if change > threshold:
+                regressions.append((name, change))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the scraper and writer hot paths against recorded fixtures")
+    parser.add_argument('benchmarks', nargs='*', help="Benchmarks to run (default: all)")
+    parser.add_argument('--rounds', type=int, default=5, help="Timed rounds per benchmark")
+    parser.add_argument('--size', type=int, default=1000, help="Rows per benchmark (charts use 100x this many)")
+    parser.add_argument('--results', default=RESULTS_PATH, help="JSONL file the results are appended to")
+    parser.add_argument('--no-save', action='store_true', help="Print the results without recording them")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='music_trends_bench_')
+    cwd = os.getcwd()
+    # The scrapers read config.json and write their logs in the working directory
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        json.dump({'GENUIS_API_TOKEN': 'bench', 'spotify': {'client_id': 'bench', 'client_secret': 'bench'}}, f)
+    os.chdir(workdir)
+    sys.path.insert(0, SCRIPT_DIR)
+    os.environ['MUSIC_TRENDS_METRICS'] = os.path.join(workdir, 'metrics')
+
+    # Start the throttles far above anything the stub cannot take
+    from throttle import get_throttle
+    for service in ('genius_search', 'genius_page', 'spotify client_id'):
+        get_throttle(service, 10000)
+
+    try:
+        with StubServer() as stub:
+            suite = Suite(workdir, stub, args.size)
+            names = args.benchmarks or list(suite.benchmarks)
+            unknown = set(names) - set(suite.benchmarks)
+            if unknown:
+                parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+
+            run = {
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'revision': git_revision(),
+                'python': platform.python_version(),
+                'cpus': os.cpu_count(),
+                'size': args.size,
+                'results': {},
+            }
+            print(f"{'benchmark':<28}{'median':>12}{'items/s':>14}")
+            for name in names:
+                result = suite.run(name, args.rounds)
+                run['results'][name] = result
+                print(f"{name:<28}{result['median_s'] * 1000:>10.1f}ms{result['items_per_s']:>14.1f}")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    history = [h for h in load_history(args.results) if h.get('size') == args.size]
+    if history:
+        previous = history[-1]
+        regressions = compare(previous, run)
+        for name, change in regressions:
+            print(f"REGRESSION {name}: {change:+.0%} slower than {previous['revision'] or previous['timestamp']}")
+        if not regressions:
+            print(f"No regressions against {previous['revision'] or previous['timestamp']}")
+
+    if not args.no_save:
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(run) + '\n')
+        print(f"Results appended to {args.results}")
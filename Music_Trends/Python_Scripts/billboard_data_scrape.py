@@ -1,63 +1,315 @@
-import requests
-from bs4 import BeautifulSoup
 import pandas as pd
+import os
+import time
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
+import requests
+from http_cache import SOURCE_TTL, cached_get, get_cache
+from storage import apply_dtypes, load_frame, parquet_path, save_frame, export_excel
+from throttle import HostRateLimiter, get_throttle, log_throttle_metrics
+from parse_pool import ParsePool
+from metrics import get_metrics, write_metrics
+from planner import new_songs
 
-def get_billboard_data(date):
-	"""Scrape Billboard Hot 100 Data for a specific date"""
-	url = f"https://www.billboard.com/charts/hot-100/{date}"
-	response = requests.get(url)
+# Directory that holds one Parquet file per crawled chart week
+WEEK_STORE = 'billboard_weeks'
 
-	if response.status_code !=200:
-		print(f"Failed to retrieve data for {date}")
-		return[]
+# Chart weeks older than this are final, so their cached pages never expire;
+# newer ones use the 'billboard' TTL of the HTTP cache
+SETTLED_WEEK_AGE = timedelta(days=14)
+
+class MissingWeeksError(Exception):
+	"""Raised when chart weeks could not be crawled; `weeks` lists their dates"""
 
-	soup = BeautifulSoup(response.content, 'html.parser')
+	def __init__(self, weeks):
+		self.weeks = list(weeks)
+		shown = ', '.join(self.weeks[:10]) + (', ...' if len(self.weeks) > 10 else '')
+		super().__init__(f"{len(self.weeks)} chart weeks could not be crawled ({shown}); run again to retry them")
+
+def parse_billboard_html(content):
+	"""Parse the rows of a Billboard Hot 100 chart page into [rank, title, artist] lists"""
+	# Imported here, so the pipeline and the update planner do not pay for bs4 until a page is parsed
+	from bs4 import BeautifulSoup
+
+	soup = BeautifulSoup(content, 'html.parser')
 	chart_data = []
 
-	chart_entries = soup.find_all('li', class_='o-chart-results-list__item')
+	# Every chart position is one <ul> row; rank, title and artist live in its <li> items
+	chart_rows = soup.find_all('ul', class_='o-chart-results-list-row')
 
-	for entry in chart_entries:
-		rank_element = entry.find('span', class_='c-label')
-		print(rank_element.prettyfy())
-		rank = rank_element.strip() if entry.find('span', class_='c-label') else 'N/A'
-		title_element = entry.find('h3', class_='c-title')
-		title = title_element.text.strip() if title_element else 'N/A'
-		artist_element = entry.find('span', class_='c-label')
-		artist = artist_element.text.strip() if artist_element else 'N/A'
+	for row in chart_rows:
+		rank_element = row.find('span', class_='c-label')
+		rank = rank_element.get_text(strip=True) if rank_element else 'N/A'
+		title_element = row.find('h3', id='title-of-a-story')
+		title = title_element.get_text(strip=True) if title_element else 'N/A'
+		# The artist is the label right after the title
+		artist_element = title_element.find_next_sibling('span', class_='c-label') if title_element else None
+		artist = artist_element.get_text(strip=True) if artist_element else 'N/A'
 
 		chart_data.append([rank, title, artist])
-	
+
 	return chart_data
 
+def fetch_billboard_page(date, limiter=None):
+	"""Raw HTML of the Hot 100 page for a specific date, or None if it could not be fetched"""
+	url = f"https://www.billboard.com/charts/hot-100/{date}"
 
-def scrape_billboard_data(start_date, end_date, output_file):
-	"""Scrape Billboard Hot 100 data from start_date to end_date and write to Excel"""
-	current_date = start_date
-	all_data = []
+	def fetch(fetch_url, **kwargs):
+		# Only weeks missing from the cache use up the rate limit
+		if limiter is not None:
+			limiter.acquire(fetch_url)
+		return get_throttle('billboard').call(lambda: requests.get(fetch_url, timeout=30, **kwargs))
 
-	#Loop through each week
-	while current_date <= end_date:
-		date_str = current_date.strftime('%Y-%m-%d')
-		print(f"Scraping data for {date_str}")
+	# A recent or future week can still change on billboard.com
+	settled = datetime.strptime(date, '%Y-%m-%d') < datetime.now() - SETTLED_WEEK_AGE
+	response = cached_get('billboard', url, fetch=fetch, ttl=None if settled else SOURCE_TTL)
 
-		#Get data for the current week
-		weekly_data = get_billboard_data(date_str)
+	if response.status_code !=200:
+		print(f"Failed to retrieve data for {date}")
+		return None
+
+	return response.content
+
+def get_billboard_data(date, limiter=None):
+	"""Scrape Billboard Hot 100 Data for a specific date"""
+	content = fetch_billboard_page(date, limiter)
+	if content is None:
+		return[]
+
+	with get_metrics().phase('parsing'):
+		return parse_billboard_html(content)
 
-		if weekly_data:
-			for row in weekly_data:
-				row.insert(0, date_str) #Add the date to the column
-			all_data.extend(weekly_data)
+def week_path(store_dir, date_str):
+	return os.path.join(store_dir, f"{date_str}.parquet")
 
-		#Move to the next week
+def weekly_dates(start_date, end_date):
+	"""Every chart date from start_date to end_date, one week apart"""
+	dates = []
+	current_date = start_date
+	while current_date <= end_date:
+		dates.append(current_date.strftime('%Y-%m-%d'))
 		current_date += timedelta(days=7)
+	return dates
+
+def crawl_week(date_str, store_dir, limiter=None):
+	"""Fetch one chart week and store it on its own; returns the number of rows"""
+	return store_week(date_str, get_billboard_data(date_str, limiter), store_dir)
+
+def store_week(date_str, weekly_data, store_dir):
+	"""Write one parsed chart week to the store; returns the number of rows"""
+	if not weekly_data:
+		return 0
+
+	df = pd.DataFrame(weekly_data, columns=['Rank', 'Title', 'Artist'])
+	df.insert(0, 'Date', date_str)
+
+	# Write under a temporary name first so a crash never leaves a half-written week behind
+	path = week_path(store_dir, date_str)
+	df.to_parquet(path + '.tmp', index=False)
+	os.replace(path + '.tmp', path)
+	return len(df)
+
+def crawl_billboard_data(start_date, end_date, store_dir=WEEK_STORE, workers=4, rate=2.0, parse_workers=0):
+	"""Crawl the weeks from start_date to end_date that are not stored yet
+
+	Weeks already in store_dir are skipped, so an interrupted crawl picks up
+	where it stopped. Returns the dates of the weeks that could not be crawled.
+	"""
+	os.makedirs(store_dir, exist_ok=True)
+	dates = weekly_dates(start_date, end_date)
+	pending = [d for d in dates if not os.path.exists(week_path(store_dir, d))]
+	print(f"{len(dates) - len(pending)} of {len(dates)} weeks already stored, {len(pending)} to crawl")
+	return crawl_weeks(pending, store_dir, workers, rate, parse_workers)
+
+def crawl_weeks(pending, store_dir=WEEK_STORE, workers=4, rate=2.0, parse_workers=0):
+	"""Crawl the chart weeks in `pending` (YYYY-MM-DD dates) on a worker pool
 
-	#create a DataFrame and save to Excel
-	df = pd.DataFrame(all_data, columns=['Date', 'Rank', 'Title', 'Artist'])
-	df.to_excel(output_file, index=False)
+	Each week is stored as soon as it is fetched. Returns the dates of the
+	weeks that could not be crawled, oldest first.
+	`rate` caps the requests per second sent to billboard.com.
+	With `parse_workers` the pages are parsed in that many processes instead of
+	on the download threads.
+	"""
+	os.makedirs(store_dir, exist_ok=True)
+	limiter = HostRateLimiter(rate)
+	started = time.monotonic()
+	done = 0
+	progress = get_metrics().progress('billboard', len(pending))
+
+	if parse_workers:
+		def fetch(date_str):
+			return fetch_billboard_page(date_str, limiter), None
+
+		pool = ParsePool(fetch, parse_billboard_html, workers, parse_workers)
+		for date_str, _, weekly_data in pool.run(pending):
+			rows = store_week(date_str, weekly_data, store_dir)
+			progress.advance()
+			if not rows:
+				print(f"No chart data for {date_str}")
+				continue
+			done += 1
+			elapsed = time.monotonic() - started
+			print(f"Stored {date_str} ({rows} rows) - {done}/{len(pending)} weeks, {done / elapsed:.2f} weeks/s, ETA {progress.eta()}")
+
+	else:
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			futures = {executor.submit(crawl_week, d, store_dir, limiter): d for d in pending}
+			for future in as_completed(futures):
+				date_str = futures[future]
+				try:
+					rows = future.result()
+				except Exception as e:
+					# The week stays missing from the store and is retried on the next run
+					logging.error(f"Failed to crawl {date_str}: {e}")
+					print(f"Failed to crawl {date_str}: {e}")
+					continue
+
+				progress.advance()
+				if not rows:
+					print(f"No chart data for {date_str}")
+					continue
+				done += 1
+				elapsed = time.monotonic() - started
+				print(f"Stored {date_str} ({rows} rows) - {done}/{len(pending)} weeks, {done / elapsed:.2f} weeks/s, ETA {progress.eta()}")
+
+	elapsed = time.monotonic() - started
+	if done:
+		print(f"Crawled {done} weeks in {elapsed:.1f}s ({done / elapsed:.2f} weeks/s)")
+
+	# A page that failed to download or had no chart rows leaves its week unstored
+	failed = [d for d in pending if not os.path.exists(week_path(store_dir, d))]
+	if failed:
+		logging.error(f"{len(failed)} weeks could not be crawled: {', '.join(failed)}")
+		print(f"{len(failed)} weeks could not be crawled")
+	return failed
+
+def load_crawled_weeks(store_dir=WEEK_STORE, start_date=None, end_date=None, dates=None):
+	"""Combine the stored weeks (optionally limited to a date range or to `dates`) into one DataFrame"""
+	if dates is not None:
+		dates = set(dates)
+	elif start_date is not None and end_date is not None:
+		dates = set(weekly_dates(start_date, end_date))
+
+	frames = []
+	for name in sorted(os.listdir(store_dir)):
+		if not name.endswith('.parquet'):
+			continue
+		if dates is not None and name[:-len('.parquet')] not in dates:
+			continue
+		frames.append(pd.read_parquet(os.path.join(store_dir, name)))
+
+	if not frames:
+		return pd.DataFrame(columns=['Date', 'Rank', 'Title', 'Artist'])
+	return pd.concat(frames, ignore_index=True)
+
+def scrape_billboard_data(start_date, end_date, output_file, store_dir=WEEK_STORE, workers=4, rate=2.0, parse_workers=0):
+	"""Scrape Billboard Hot 100 data from start_date to end_date and write to Excel
+
+	Raises MissingWeeksError without writing output_file when any week in the
+	range could not be crawled; the weeks that were crawled stay in store_dir.
+	"""
+	failed = crawl_billboard_data(start_date, end_date, store_dir, workers, rate, parse_workers)
+	if failed:
+		get_cache().log_stats()
+		log_throttle_metrics()
+		write_metrics()
+		raise MissingWeeksError(failed)
+
+	#create a DataFrame, keep it as Parquet and export it to Excel
+	df = load_crawled_weeks(store_dir, start_date, end_date)
+	save_frame(df, output_file)
+	export_excel(df, output_file)
 	print(f"Data has been written to {output_file}")
+	get_cache().log_stats()
+	log_throttle_metrics()
+	write_metrics()
+
+def stored_weeks(store_dir=WEEK_STORE):
+	"""Dates (YYYY-MM-DD) of every week in the store"""
+	if not os.path.isdir(store_dir):
+		return set()
+	return {name[:-len('.parquet')] for name in os.listdir(store_dir) if name.endswith('.parquet')}
+
+def update_billboard_data(output_file, store_dir=WEEK_STORE, through=None, workers=4, rate=2.0, parse_workers=0, excel=False):
+	"""Crawl every week missing since the first stored one and add the new weeks to output_file
+
+	A week counts as missing when it is neither in the store nor in the chart,
+	so a week that failed in an earlier run is crawled again. Returns (new chart
+	rows, new songs): the songs are the ones charting for the first time in those
+	weeks, so only they need lyrics and metadata. Raises MissingWeeksError
+	before changing output_file if any week still could not be crawled. The
+	Excel export of the whole chart is skipped unless `excel` is set.
+	"""
+	through = through or datetime.now()
+
+	# Songs that charted before this update; the combined chart is one read, the week store a fallback
+	if os.path.exists(parquet_path(output_file)) or os.path.exists(output_file):
+		chart = load_frame(output_file)
+	elif os.path.isdir(store_dir):
+		chart = load_crawled_weeks(store_dir)
+	else:
+		chart = pd.DataFrame(columns=['Date', 'Rank', 'Title', 'Artist'])
+
+	charted = {str(date)[:10] for date in chart['Date'].unique()}
+	stored = stored_weeks(store_dir)
+	if not stored and not charted:
+		raise Exception(f"No stored chart weeks in {store_dir}; run a full scrape first")
+
+	first = datetime.strptime(min(stored | charted), '%Y-%m-%d')
+	expected = weekly_dates(first, through)
+	pending = [d for d in expected if d not in stored and d not in charted]
+	print(f"Chart has {len(charted)} weeks since {first:%Y-%m-%d}; {len(pending)} of {len(expected)} weeks through {through:%Y-%m-%d} to crawl")
+
+	failed = crawl_weeks(pending, store_dir, workers, rate, parse_workers) if pending else []
+	if failed:
+		get_cache().log_stats()
+		log_throttle_metrics()
+		write_metrics()
+		raise MissingWeeksError(failed)
+
+	# Stored weeks that are not in the chart yet, including ones crawled by an earlier failed update
+	unmerged = sorted(d for d in stored_weeks(store_dir) if d not in charted and d <= through.strftime('%Y-%m-%d'))
+	if not unmerged:
+		print(f"Chart is up to date (latest week {max(stored | charted)})")
+		return chart.iloc[:0], pd.DataFrame(columns=['Song', 'Artist'])
+
+	weeks = load_crawled_weeks(store_dir, dates=unmerged)
+	songs = new_songs(weeks, chart)[['Title', 'Artist']].rename(columns={'Title': 'Song'})
+	print(f"{weeks['Date'].nunique()} new weeks ({len(weeks)} rows), {len(songs)} songs charting for the first time")
+
+	# Same column types as the stored chart, or the combined columns end up mixed
+	chart = pd.concat([chart, apply_dtypes(weeks.copy())], ignore_index=True)
+	save_frame(chart, output_file)
+	if excel:
+		export_excel(chart, output_file)
+	get_cache().log_stats()
+	log_throttle_metrics()
+	write_metrics()
+	return weeks, songs
 
 if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Scrape the Billboard Hot 100 for a range of weeks")
+	parser.add_argument('--workers', type=int, default=4, help="Number of weeks fetched at once")
+	parser.add_argument('--rate', type=float, default=2.0, help="Maximum requests per second to billboard.com")
+	parser.add_argument('--store', default=WEEK_STORE, help="Directory holding one file per crawled week")
+	parser.add_argument('--parse-workers', type=int, default=0, help="Parse pages in this many processes (0 parses on the download threads)")
+	parser.add_argument('--update', action='store_true', help="Only crawl the weeks missing since the first stored one")
+	parser.add_argument('--excel', action='store_true', help="With --update, also rewrite the whole chart workbook")
+	args = parser.parse_args()
+
+	#specify output Excel file
+	output_file = 'billboard_hot_100.xlsx'
+
+	if args.update:
+		#the new songs go to their own small file for the lyrics and metadata scripts
+		weeks, songs = update_billboard_data(output_file, args.store, None, args.workers, args.rate, args.parse_workers, args.excel)
+		save_frame(songs, 'billboard_new_songs.xlsx')
+		export_excel(songs, 'billboard_new_songs.xlsx')
+		print(f"{len(songs)} new songs written to billboard_new_songs.xlsx")
+		exit(0)
+
 	#Define the start and end date
 	start_date_str = input("Enter the start date (YYYY-MM-DD): ")
 	end_date_str = input("Enter the end date (YYYY-MM-DD): ")
@@ -70,8 +322,9 @@ if __name__ == "__main__":
 		print("Error: Invalid date format. Please use YYYY-MM-DD.")
 		exit(1) #Exit if the date format is invalid
 
-	#specify output Excel file
-	output_file = 'billboard_hot_100.xlsx'
-
 	#scrape the data and write to excel
-	scrape_billboard_data(start_date, end_date, output_file)
+	try:
+		scrape_billboard_data(start_date, end_date, output_file, args.store, args.workers, args.rate, args.parse_workers)
+	except MissingWeeksError as e:
+		print(f"Error: {e}")
+		exit(1)
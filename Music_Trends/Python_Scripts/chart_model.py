@@ -0,0 +1,208 @@
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from chart_stream import EPOCH, iter_chart_chunks
+
+# Where the built model is cached; rebuilt when charts.csv is newer
+MODEL_FILE = 'chart_model.npz'
+
+
+class ChartModel:
+    """The whole chart history as integer ids and flat NumPy arrays
+
+    Titles and artists are interned once; song i is (titles[title_id[i]],
+    artists[artist_id[i]]). Every song's weekly run is stored contiguously,
+    ordered by date, in `days` (days since 1970) and `ranks`, with
+    offsets[i]:offsets[i + 1] selecting song i's weeks, like a CSR matrix row.
+    Peak, debut, final week and weeks on board are worked out once when the
+    model is built, so the queries below are array lookups.
+    """
+
+    def __init__(self, titles, artists, title_id, artist_id, offsets, days, ranks, weeks_on_board):
+        self.titles = titles
+        self.artists = artists
+        self.title_id = title_id
+        self.artist_id = artist_id
+        self.offsets = offsets
+        self.days = days
+        self.ranks = ranks
+        self.weeks_on_board_ = weeks_on_board
+
+        # Per-song summaries; every song has at least one week, so offsets[i] is its debut
+        starts, ends = offsets[:-1], offsets[1:] - 1
+        self.peak_rank = np.minimum.reduceat(ranks, starts) if len(starts) else np.zeros(0, dtype=np.int8)
+        self.debut_day = days[starts]
+        self.debut_rank = ranks[starts]
+        self.final_day = days[ends]
+        self.final_rank = ranks[ends]
+        years = (EPOCH + self.debut_day.astype('timedelta64[D]')).astype('datetime64[Y]').astype(np.int32) + 1970
+        self.decade = (years // 10 * 10).astype(np.int16)
+
+        # Song ids sorted by debut decade, so a decade is one slice of this array
+        self._by_decade = np.argsort(self.decade, kind='stable').astype(np.int32)
+        self._sorted_decades = self.decade[self._by_decade]
+
+        self._ids = {(titles[t], artists[a]): i for i, (t, a) in enumerate(zip(title_id.tolist(), artist_id.tolist()))}
+
+    def __len__(self):
+        return len(self.title_id)
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        """Build from DataFrame chunks with date, rank, song, artist and weeks-on-board columns"""
+        title_ids, artist_ids, song_ids = {}, {}, {}
+        song_title, song_artist = [], []
+        ids, days, ranks, weeks = [], [], [], []
+
+        for chunk in chunks:
+            # Intern each distinct (song, artist) pair of the chunk once, then map the rows to it
+            pairs = chunk[['song', 'artist']].astype(str).drop_duplicates()
+            pair_ids = np.empty(len(pairs), dtype=np.int32)
+            for n, key in enumerate(zip(pairs['song'], pairs['artist'])):
+                song = song_ids.get(key)
+                if song is None:
+                    song = song_ids[key] = len(song_title)
+                    song_title.append(title_ids.setdefault(key[0], len(title_ids)))
+                    song_artist.append(artist_ids.setdefault(key[1], len(artist_ids)))
+                pair_ids[n] = song
+            index = pd.MultiIndex.from_frame(pairs)
+            ids.append(pair_ids[index.get_indexer(pd.MultiIndex.from_frame(chunk[['song', 'artist']].astype(str)))])
+            days.append((chunk['date'].to_numpy(dtype='datetime64[D]') - EPOCH).astype(np.int32))
+            ranks.append(chunk['rank'].to_numpy(dtype=np.int8))
+            weeks.append(chunk['weeks-on-board'].to_numpy(dtype=np.int16))
+
+        ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int32)
+        days = np.concatenate(days) if days else np.zeros(0, dtype=np.int32)
+        ranks = np.concatenate(ranks) if ranks else np.zeros(0, dtype=np.int8)
+        weeks = np.concatenate(weeks) if weeks else np.zeros(0, dtype=np.int16)
+
+        # Group the rows by song, each song's weeks in date order
+        order = np.lexsort((days, ids))
+        offsets = np.zeros(len(song_title) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(ids, minlength=len(song_title)), out=offsets[1:])
+        weeks_on_board = np.zeros(len(song_title), dtype=np.int16)
+        np.maximum.at(weeks_on_board, ids, weeks)
+
+        return cls(np.array(list(title_ids), dtype=str), np.array(list(artist_ids), dtype=str),
+                   np.array(song_title, dtype=np.int32), np.array(song_artist, dtype=np.int32),
+                   offsets, days[order], ranks[order], weeks_on_board)
+
+    @classmethod
+    def from_charts(cls, path='charts.csv', chunksize=100_000):
+        """Build from charts.csv or the Parquet dataset written by storage.py"""
+        return cls.from_chunks(iter_chart_chunks(path, chunksize))
+
+    def save(self, path=MODEL_FILE):
+        np.savez(path, titles=self.titles, artists=self.artists, title_id=self.title_id, artist_id=self.artist_id,
+                 offsets=self.offsets, days=self.days, ranks=self.ranks, weeks_on_board=self.weeks_on_board_)
+        return path
+
+    @classmethod
+    def load(cls, path=MODEL_FILE):
+        with np.load(path) as arrays:
+            return cls(**{name: arrays[name] for name in arrays.files})
+
+    @classmethod
+    def cached(cls, source='charts.csv', path=MODEL_FILE):
+        """Load the saved model, rebuilding it first if `source` changed since it was saved"""
+        if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source):
+            return cls.load(path)
+        model = cls.from_charts(source)
+        model.save(path)
+        logging.info(f"Built chart model for {len(model)} songs from {source} into {path}")
+        return model
+
+    def nbytes(self):
+        """Memory held by the arrays, interned strings included"""
+        arrays = (self.titles, self.artists, self.title_id, self.artist_id, self.offsets, self.days, self.ranks,
+                  self.weeks_on_board_, self.peak_rank, self.debut_day, self.debut_rank, self.final_day,
+                  self.final_rank, self.decade, self._by_decade, self._sorted_decades)
+        return sum(array.nbytes for array in arrays)
+
+    # Queries. `song` is a song id; song_id() turns a title and artist into one.
+
+    def song_id(self, title, artist):
+        """Id of the song with exactly this title and artist; KeyError if it never charted"""
+        return self._ids[(title, artist)]
+
+    def name(self, song):
+        return str(self.titles[self.title_id[song]]), str(self.artists[self.artist_id[song]])
+
+    def trajectory(self, song):
+        """(dates, ranks) of every week the song spent on the chart, oldest first"""
+        start, end = self.offsets[song], self.offsets[song + 1]
+        return EPOCH + self.days[start:end].astype('timedelta64[D]'), self.ranks[start:end]
+
+    def peak(self, song):
+        return int(self.peak_rank[song])
+
+    def debut(self, song):
+        """(date, rank) of the song's first week on the chart"""
+        return EPOCH + np.timedelta64(int(self.debut_day[song]), 'D'), int(self.debut_rank[song])
+
+    def final(self, song):
+        """(date, rank) of the song's last week on the chart"""
+        return EPOCH + np.timedelta64(int(self.final_day[song]), 'D'), int(self.final_rank[song])
+
+    def weeks_on_board(self, song):
+        return int(self.weeks_on_board_[song])
+
+    def songs_in_decade(self, decade):
+        """Ids of the songs that debuted in `decade` (e.g. 1980)"""
+        start, end = np.searchsorted(self._sorted_decades, [decade, decade + 10])
+        return self._by_decade[start:end]
+
+    def select(self, decade=None, max_peak=None, min_weeks=None):
+        """Ids of the songs matching every filter given"""
+        ids = self.songs_in_decade(decade) if decade is not None else np.arange(len(self), dtype=np.int32)
+        if max_peak is not None:
+            ids = ids[self.peak_rank[ids] <= max_peak]
+        if min_weeks is not None:
+            ids = ids[self.weeks_on_board_[ids] >= min_weeks]
+        return ids
+
+    def to_frame(self, ids=None):
+        """One row per song, with the same columns as ChartStats.to_frame"""
+        ids = np.arange(len(self)) if ids is None else np.asarray(ids)
+        return pd.DataFrame({
+            'song': pd.Categorical.from_codes(self.title_id[ids], self.titles),
+            'artist': pd.Categorical.from_codes(self.artist_id[ids], self.artists),
+            'peak_rank': self.peak_rank[ids],
+            'debut_rank': self.debut_rank[ids],
+            'debut_date': EPOCH + self.debut_day[ids].astype('timedelta64[D]'),
+            'final_rank': self.final_rank[ids],
+            'final_date': EPOCH + self.final_day[ids].astype('timedelta64[D]'),
+            'weeks_on_board': self.weeks_on_board_[ids],
+            'appearances': np.diff(self.offsets)[ids],
+            'decade': self.decade[ids],
+        })
+
+def _time_query(query, repeat=10_000):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        query()
+    return (time.perf_counter() - started) / repeat * 1e6
+
+if __name__ == "__main__":
+    source = sys.argv[1] if len(sys.argv) > 1 else 'charts.csv'
+    model = ChartModel.cached(source)
+    print(f"{len(model)} songs, {len(model.days)} chart weeks in {model.nbytes() / 1024 ** 2:.1f} MiB")
+
+    if not os.path.isdir(source):
+        frame = pd.read_csv(source)
+        print(f"The same rows as a DataFrame take {frame.memory_usage(deep=True).sum() / 1024 ** 2:.1f} MiB")
+
+    song = int(np.argmax(model.weeks_on_board_))
+    print(f"Longest run: {model.name(song)} - {model.weeks_on_board(song)} weeks, peak #{model.peak(song)}")
+    for label, query in (('trajectory', lambda: model.trajectory(song)),
+                         ('peak', lambda: model.peak(song)),
+                         ('debut', lambda: model.debut(song)),
+                         ('weeks_on_board', lambda: model.weeks_on_board(song)),
+                         ('songs_in_decade', lambda: model.songs_in_decade(1980)),
+                         ('song_id', lambda: model.song_id(*model.name(song)))):
+        print(f"{label:<16}{_time_query(query):>8.2f} us")
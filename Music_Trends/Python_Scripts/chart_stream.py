@@ -0,0 +1,163 @@
+import os
+import sys
+import logging
+
+import numpy as np
+import pandas as pd
+
+# Only the columns the aggregates need, read with the narrowest types that hold them
+CHART_COLUMNS = ['date', 'rank', 'song', 'artist', 'weeks-on-board']
+CHART_DTYPES = {
+    'rank': 'int8',
+    'song': 'category',
+    'artist': 'category',
+    'weeks-on-board': 'int16',
+}
+
+EPOCH = np.datetime64('1970-01-01', 'D')
+
+
+def iter_chart_chunks(path='charts.csv', chunksize=100_000):
+    """Yield the chart history in chunks of at most `chunksize` rows
+
+    `path` is either charts.csv or the Parquet dataset written by storage.py.
+    """
+    if os.path.isdir(path):
+        import pyarrow.dataset as ds
+        dataset = ds.dataset(path, format='parquet', partitioning='hive')
+        for batch in dataset.to_batches(columns=CHART_COLUMNS, batch_size=chunksize):
+            chunk = batch.to_pandas(date_as_object=False)
+            yield chunk.astype(CHART_DTYPES)
+    else:
+        yield from pd.read_csv(path, usecols=CHART_COLUMNS, dtype=CHART_DTYPES,
+                               parse_dates=['date'], chunksize=chunksize)
+
+
+class ChartStats:
+    """Running per-song statistics, updated one chunk at a time
+
+    Songs are identified by (song, artist) and numbered in the order they are
+    first seen. Stats live in flat NumPy arrays indexed by that number, so memory
+    grows with the number of distinct songs, not with the number of chart weeks.
+    """
+
+    def __init__(self, capacity=1024, max_weeks=128):
+        self.song_ids = {}
+        self.songs = []
+        self.peak_rank = np.full(capacity, 127, dtype=np.int8)
+        self.debut_rank = np.zeros(capacity, dtype=np.int8)
+        self.debut_day = np.full(capacity, np.iinfo(np.int32).max, dtype=np.int32)
+        self.final_rank = np.zeros(capacity, dtype=np.int8)
+        self.final_day = np.full(capacity, np.iinfo(np.int32).min, dtype=np.int32)
+        self.weeks_on_board = np.zeros(capacity, dtype=np.int16)
+        self.appearances = np.zeros(capacity, dtype=np.int16)
+        # Row counts for every (rank, weeks-on-board) pair, behind the "Rank vs Weeks" plot
+        self.rank_weeks_counts = np.zeros((101, max_weeks), dtype=np.int64)
+        self.rows = 0
+
+    def __len__(self):
+        return len(self.songs)
+
+    def _grow(self, needed):
+        capacity = len(self.peak_rank)
+        if needed <= capacity:
+            return
+        new_capacity = max(needed, capacity * 2)
+        for name, fill in (('peak_rank', 127), ('debut_rank', 0), ('debut_day', np.iinfo(np.int32).max),
+                           ('final_rank', 0), ('final_day', np.iinfo(np.int32).min),
+                           ('weeks_on_board', 0), ('appearances', 0)):
+            old = getattr(self, name)
+            new = np.full(new_capacity, fill, dtype=old.dtype)
+            new[:capacity] = old
+            setattr(self, name, new)
+
+    def _ids_for(self, chunk):
+        # Number the (song, artist) pairs of this chunk, giving new songs the next free ids
+        pairs = chunk[['song', 'artist']].drop_duplicates()
+        pair_ids = np.empty(len(pairs), dtype=np.int32)
+        for i, key in enumerate(zip(pairs['song'].astype(str), pairs['artist'].astype(str))):
+            song_id = self.song_ids.get(key)
+            if song_id is None:
+                song_id = self.song_ids[key] = len(self.songs)
+                self.songs.append(key)
+            pair_ids[i] = song_id
+        self._grow(len(self.songs))
+
+        index = pd.MultiIndex.from_frame(pairs.astype(str))
+        return pair_ids[index.get_indexer(pd.MultiIndex.from_frame(chunk[['song', 'artist']].astype(str)))]
+
+    def update(self, chunk):
+        """Fold one chunk of chart rows into the running stats"""
+        ids = self._ids_for(chunk)
+        ranks = chunk['rank'].to_numpy(dtype=np.int8)
+        weeks = chunk['weeks-on-board'].to_numpy(dtype=np.int16)
+        days = (chunk['date'].to_numpy(dtype='datetime64[D]') - EPOCH).astype(np.int32)
+
+        np.minimum.at(self.peak_rank, ids, ranks)
+        np.maximum.at(self.weeks_on_board, ids, weeks)
+        np.add.at(self.appearances, ids, 1)
+
+        if weeks.max(initial=0) >= self.rank_weeks_counts.shape[1]:
+            grown = np.zeros((101, int(weeks.max()) + 1), dtype=np.int64)
+            grown[:, :self.rank_weeks_counts.shape[1]] = self.rank_weeks_counts
+            self.rank_weeks_counts = grown
+        np.add.at(self.rank_weeks_counts, (ranks, weeks), 1)
+
+        # Earliest and latest row of every song in this chunk; replace the stored ones if further out
+        order = np.lexsort((days, ids))
+        sorted_ids = ids[order]
+        first = order[np.r_[True, sorted_ids[1:] != sorted_ids[:-1]]]
+        last = order[np.r_[sorted_ids[1:] != sorted_ids[:-1], True]]
+
+        earlier = days[first] < self.debut_day[ids[first]]
+        self.debut_day[ids[first][earlier]] = days[first][earlier]
+        self.debut_rank[ids[first][earlier]] = ranks[first][earlier]
+
+        later = days[last] > self.final_day[ids[last]]
+        self.final_day[ids[last][later]] = days[last][later]
+        self.final_rank[ids[last][later]] = ranks[last][later]
+
+        self.rows += len(chunk)
+
+    def to_frame(self):
+        """One row per song with its peak, debut, final week and decade"""
+        n = len(self.songs)
+        debut_date = EPOCH + self.debut_day[:n].astype('timedelta64[D]')
+        years = debut_date.astype('datetime64[Y]').astype(int) + 1970
+        return pd.DataFrame({
+            'song': pd.Categorical([s for s, _ in self.songs]),
+            'artist': pd.Categorical([a for _, a in self.songs]),
+            'peak_rank': self.peak_rank[:n],
+            'debut_rank': self.debut_rank[:n],
+            'debut_date': debut_date,
+            'final_rank': self.final_rank[:n],
+            'final_date': EPOCH + self.final_day[:n].astype('timedelta64[D]'),
+            'weeks_on_board': self.weeks_on_board[:n],
+            'appearances': self.appearances[:n],
+            'decade': (years // 10 * 10).astype(np.int16),
+        })
+
+    def debut_rank_by_decade(self):
+        """Debut ranks grouped by decade, as used for the "Initial Rank by Decade" plot"""
+        songs = self.to_frame()
+        return songs.groupby('decade')['debut_rank'].describe()
+
+    def final_rank_at_most_weeks(self):
+        """Final rank and weeks on board per song, as used for "Final Rank @ Highest Weeks on Board" """
+        return self.to_frame()[['song', 'artist', 'weeks_on_board', 'final_rank']]
+
+
+def aggregate_charts(path='charts.csv', chunksize=100_000):
+    """Stream the whole chart history through a ChartStats"""
+    stats = ChartStats()
+    for chunk in iter_chart_chunks(path, chunksize):
+        stats.update(chunk)
+        logging.info(f"Aggregated {stats.rows} chart rows, {len(stats)} songs so far")
+    return stats
+
+if __name__ == "__main__":
+    source = sys.argv[1] if len(sys.argv) > 1 else 'charts.csv'
+    stats = aggregate_charts(source)
+    stats.to_frame().to_parquet('song_stats.parquet', index=False)
+    print(f"Aggregated {stats.rows} rows into {len(stats)} songs; per-song stats written to song_stats.parquet")
+    print(stats.debut_rank_by_decade())
@@ -0,0 +1,91 @@
+import json
+import os
+import logging
+import pandas as pd
+
+
+class CheckpointStore:
+    """Append-only JSONL log of finished rows, keyed by (Song, Artist)
+
+    Every completed fetch adds one line to the log instead of rewriting the whole
+    workbook, so saving progress costs the same on row 30,000 as on row 1.
+    Replaying the log on startup restores everything that was already fetched.
+    """
+
+    def __init__(self, path, key_columns=('Song', 'Artist')):
+        self.path = path
+        self.key_columns = tuple(key_columns)
+        self._file = None
+
+    @staticmethod
+    def _clean(value):
+        # JSON has no NaN, and numpy scalars are not serializable
+        if value is None or (not isinstance(value, (list, dict)) and pd.isna(value)):
+            return None
+        if hasattr(value, 'item'):
+            return value.item()
+        return value
+
+    def key_for(self, row):
+        return tuple(self._clean(row.get(column)) for column in self.key_columns)
+
+    def append(self, row, **values):
+        """Write one record holding the row key plus the given column values"""
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+            # Start on a fresh line if the previous run died halfway through one
+            if self._file.tell() > 0:
+                with open(self.path, 'rb') as log_file:
+                    log_file.seek(-1, os.SEEK_END)
+                    if log_file.read(1) != b'\n':
+                        self._file.write('\n')
+
+        record = {column: self._clean(row.get(column)) for column in self.key_columns}
+        record.update({column: self._clean(value) for column, value in values.items()})
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._file.flush()  # One line per record, so a crash loses at most the line being written
+
+    def load(self):
+        """Replay the log into a {key: {column: value}} dict, later records winning"""
+        records = {}
+        if not os.path.exists(self.path):
+            return records
+
+        with open(self.path, encoding='utf-8') as log_file:
+            for line_number, line in enumerate(log_file, start=1):
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A run killed mid-write leaves a partial last line behind
+                    logging.warning(f"Skipping unreadable checkpoint line {line_number} in {self.path}")
+                    continue
+                key = tuple(record.pop(column, None) for column in self.key_columns)
+                records.setdefault(key, {}).update(record)
+        return records
+
+    def apply(self, df, columns):
+        """Fill `columns` of df with the values recorded in the log"""
+        records = self.load()
+        if not records:
+            return df
+
+        keys = [self.key_for(row) for row in df[[c for c in self.key_columns if c in df.columns]].to_dict('records')]
+        for column in columns:
+            replayed = pd.Series([records.get(key, {}).get(column) for key in keys], index=df.index, dtype=object)
+            if column in df.columns:
+                df[column] = replayed.where(replayed.notna(), df[column])
+            else:
+                df[column] = replayed
+        return df
+
+    def import_frame(self, df, columns):
+        """Seed the log from a frame, e.g. an old *_partial_save.xlsx"""
+        for row in df.to_dict('records'):
+            values = {column: row.get(column) for column in columns if not pd.isna(row.get(column))}
+            if values:
+                self.append(row, **values)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -1,55 +1,80 @@
 import os
+import argparse
+import threading
 import pandas as pd
 import requests
 import time
 import logging
-import json
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from throttle import HostRateLimiter, get_throttle, log_throttle_metrics
+from checkpoint import CheckpointStore
+from http_cache import cached_get, get_cache
+from storage import load_frame, save_frame, export_excel
+from planner import fill_from_matches, plan_lyrics_work, song_keys
+from lyrics_extract import extract_lyrics
+from parse_pool import ParsePool
+from metrics import get_metrics, write_metrics
+from app_config import get_config
+from work_queue import WorkQueue, run_worker, worker_name
 
-# Setup logging
-logging.basicConfig(filename='lyrics_fetch.log', level=logging.INFO,
-                    format='%(asctime)s:%(levelname)s:%(message)s')
+# Base URL for Genius search
+GENIUS_SEARCH_URL = "https://api.genius.com/search"
 
-# Load the API token from a JSON file
-with open('config.json') as config_file:
-    config = json.load(config_file)
+# Columns filled in by this script
+LYRICS_COLUMNS = ['Lyrics_URL', 'Lyrics']
 
-genius_token = config['GENUIS_API_TOKEN']
+# Stored when a request failed (a 429 or server error left after the retries, a network error)
+# or the page had no lyrics on it. It counts as an empty cell, so the next run tries the song
+# again; None is only stored when Genius answered the search and had no hit.
+RETRY_LATER = ''
+
+# One session per worker thread so connections to Genius are reused
+_local = threading.local()
+
+def _network_get(url, limiter=None, source='genius_page', **kwargs):
+    if limiter is not None:
+        limiter.acquire(url)  # Wait for a slot on this host
+
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = _local.session = requests.Session()
+    # The adaptive throttle backs off on 429s and server errors and retries them
+    return get_throttle(source).call(lambda: session.get(url, **kwargs))
+
+def _http_get(url, limiter=None, source='genius_page', **kwargs):
+    # Responses already in the shared cache cost neither a request nor a rate-limit slot
+    def fetch(fetch_url, **fetch_kwargs):
+        return _network_get(fetch_url, limiter, source, **fetch_kwargs)
+    return cached_get(source, url, fetch=fetch, **kwargs)
 
 # Function to scrape lyrics from a Genius song URL
-def scrape_lyrics(url):
+def scrape_lyrics(url, limiter=None):
     try:
-        response = requests.get(url)
+        response = _http_get(url, limiter)
         if response.status_code != 200:
             logging.error(f"Failed to fetch {url}, status code: {response.status_code}")
-            return None
+            return RETRY_LATER
         
-        # Parse the HTML using BeautifulSoup
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
-        # Genius lyrics are often inside <div> tags with class "Lyrics__Container"
-        lyrics_divs = soup.find_all('div', class_='Lyrics__Container')
-        
-        if not lyrics_divs:
+        # Genius lyrics are inside <div data-lyrics-container="true"> blocks
+        lyrics = extract_lyrics(response.content)
+
+        if not lyrics:
+            # Likely a placeholder or interstitial page; keep it out of the cache so the next run fetches it again
             logging.error(f"Lyrics not found on the page: {url}")
-            return None
-        
-        # Extract text from all lyrics containers
-        lyrics = '\n'.join([div.get_text(separator="\n").strip() for div in lyrics_divs])
+            get_cache().forget('genius_page', url)
+            return RETRY_LATER
+
         return lyrics
 
     except Exception as e:
         logging.error(f"Error occurred while fetching lyrics from {url}: {e}")
-        return None
+        return RETRY_LATER
 
 # Define a function to get song lyrics URL using the Genius API
-def get_lyrics(song_title, artist=None, max_retries=3):
-    # Base URL for Genius search
-    base_url = "https://api.genius.com/search"
-    
-    # Set up headers with the API token
+def get_lyrics(song_title, artist=None, max_retries=3, limiter=None):
+    # Set up headers with the API token (config.json is only read on the first search)
     headers = {
-        "Authorization": f"Bearer {genius_token}"
+        "Authorization": f"Bearer {get_config()['GENUIS_API_TOKEN']}"
     }
     
     # Build the query for the song (optional: include artist)
@@ -58,7 +83,7 @@ def get_lyrics(song_title, artist=None, max_retries=3):
     for attempt in range(max_retries):  # Retry up to max_retries times
         try:
             # Make the API request
-            response = requests.get(base_url, headers=headers, params={'q': query})
+            response = _http_get(GENIUS_SEARCH_URL, limiter, source='genius_search', headers=headers, params={'q': query})
             
             # Check if the request was successful
             if response.status_code == 200:
@@ -79,103 +104,289 @@ def get_lyrics(song_title, artist=None, max_retries=3):
             
             else:
                 logging.warning(f"Failed request for {song_title} by {artist}, Status code: {response.status_code}")
-                return None
+                return RETRY_LATER
 
         except requests.exceptions.ConnectionError as e:
             logging.error(f"ConnectionError for {song_title} by {artist}: {e}, attempt {attempt + 1}")
-            time.sleep(2)  # Wait 2 seconds before retrying
+            time.sleep(get_throttle('genius_search').backoff_delay(attempt))  # Jittered backoff before retrying
             
         except Exception as e:
             logging.error(f"Unexpected error for {song_title} by {artist}: {e}")
-            return None
+            return RETRY_LATER
 
     logging.error(f"Failed to retrieve data for {song_title} by {artist} after {max_retries} attempts")
-    return None
-
-# Define the file paths
-file_path = 'Blank_Data.xlsx'  # Original file
-output_directory = os.path.dirname(file_path)  # Get the directory of the input file
-partial_save_path = os.path.join(output_directory, 'Blank_Data_partial_save.xlsx')  # Partial save path
-output_file = os.path.join(output_directory, 'Blank_Data_final_output.xlsx')  # Final output file
-
-# Check if the partial save file exists
-if os.path.exists(partial_save_path):
-    # Load data from the partial save file
-    df = pd.read_excel(partial_save_path)
-    logging.info(f"Resuming from partial save: {partial_save_path}")
-    print(f"Resuming from partial save: {partial_save_path}")
-else:
-    # Load the original data from charts.xlsx
-    df = pd.read_excel(file_path)
-    logging.info(f"Starting fresh from {file_path}")
-    print(f"Starting fresh from {file_path}")
-
-# Check if an existing output file is present
-if os.path.exists(output_file):
-    # Read the existing data
-    existing_df = pd.read_excel(output_file)
-    # Merge the dataframes on the 'Song' column to retain previously fetched lyrics and URLs
-    df = df.merge(existing_df[['Song', 'Lyrics_URL', 'Lyrics']], on='Song', how='left', suffixes=('', '_existing'))
-    # Drop duplicates in case some rows are already processed
-    df.drop(columns=['Lyrics_existing'], errors='ignore', inplace=True)
-else:
+    return RETRY_LATER
+
+def is_missing(value):
+    """True for the empty markers that astype(str) leaves behind for missing cells"""
+    return pd.isna(value) or value in ('nan', '')
+
+def fetch_song(song, artist, lyrics_url, lyrics, limiter=None):
+    """Fetch whatever is still missing for one song: the URL first, then the lyrics page"""
+    if is_missing(lyrics_url):
+        lyrics_url = get_lyrics(song, artist, limiter=limiter)
+
+    # A URL of None means the search found nothing, so there is no page to scrape
+    if is_missing(lyrics) and lyrics_url not in [None, 'None', 'nan', '']:
+        lyrics = scrape_lyrics(lyrics_url, limiter=limiter)
+
+    return lyrics_url, lyrics
+
+def fetch_song_page(song, artist, lyrics_url, lyrics, limiter=None):
+    """Like fetch_song, but returns the raw lyrics page instead of parsing it
+
+    Returns (page content or None, (lyrics_url, lyrics to keep if there is no page)).
+    """
+    if is_missing(lyrics_url):
+        lyrics_url = get_lyrics(song, artist, limiter=limiter)
+
+    if is_missing(lyrics) and lyrics_url not in [None, 'None', 'nan', '']:
+        response = _http_get(lyrics_url, limiter)
+        if response.status_code == 200:
+            return response.content, (lyrics_url, None)
+        logging.error(f"Failed to fetch {lyrics_url}, status code: {response.status_code}")
+        return None, (lyrics_url, RETRY_LATER)
+
+    return None, (lyrics_url, lyrics)
+
+def process_serially(df, store, plan):
+    progress = get_metrics().progress('lyrics', len(plan))
+    for index in plan.rows:
+        row = df.loc[index]
+        song = row['Song']
+        artist = row['Artist'] if 'Artist' in df.columns else None
+
+        # Initialize lyrics_url
+        lyrics_url = None
+
+        # If the lyrics URL is missing, fetch it
+        if is_missing(row['Lyrics_URL']):
+            lyrics_url = get_lyrics(song, artist)
+            df.at[index, 'Lyrics_URL'] = str(lyrics_url)
+            store.append(row, Lyrics_URL=str(lyrics_url))  # Checkpoint the URL immediately
+        else:
+            # Use existing URL from the row
+            lyrics_url = row['Lyrics_URL']
+
+        # If the lyrics are missing but we have a URL, scrape the lyrics from the URL
+        if is_missing(row['Lyrics']) and lyrics_url not in [None, 'None', 'nan', '']:
+            lyrics = scrape_lyrics(lyrics_url)
+            df.at[index, 'Lyrics'] = str(lyrics)
+            store.append(row, Lyrics=str(lyrics))  # Checkpoint the lyrics immediately
+
+        # Output song title once it's processed
+        progress.advance()
+        print(f"Processed: {song} by {artist} ({progress.done}/{progress.total}, ETA {progress.eta()})")
+        logging.info(f"Processed: {song} by {artist}")
+
+def process_concurrently(df, store, plan, workers, rate):
+    """Fetch lyrics on a thread pool so the Genius API calls and page scrapes overlap
+
+    Each worker runs the search and then the scrape for one song, so while one
+    thread waits on the API another is already downloading a lyrics page.
+    Every host is throttled by its own token bucket of `rate` requests per second.
+    """
+    limiter = HostRateLimiter(rate)
+    has_artist = 'Artist' in df.columns
+    progress = get_metrics().progress('lyrics', len(plan))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for index in plan.rows:
+            row = df.loc[index]
+            artist = row['Artist'] if has_artist else None
+            future = executor.submit(fetch_song, row['Song'], artist, row['Lyrics_URL'], row['Lyrics'], limiter)
+            futures[future] = (index, row)
+
+        for future in as_completed(futures):
+            index, row = futures[future]
+            lyrics_url, lyrics = future.result()
+            df.at[index, 'Lyrics_URL'] = str(lyrics_url)
+            df.at[index, 'Lyrics'] = str(lyrics)
+
+            # Results are only checkpointed from this thread, so the log needs no locking
+            store.append(row, Lyrics_URL=str(lyrics_url), Lyrics=str(lyrics))
+
+            progress.advance()
+            print(f"Processed: {row['Song']} by {row.get('Artist')} ({progress.done}/{progress.total}, ETA {progress.eta()})")
+            logging.info(f"Processed: {row['Song']} by {row.get('Artist')}")
+
+def process_pipelined(df, store, plan, workers, rate, parse_workers):
+    """Download on `workers` threads and parse the lyrics pages in `parse_workers` processes
+
+    Pages go through a bounded queue, so downloads pause whenever the parsers
+    fall behind. Results come back on this thread, the only one writing the checkpoint.
+    """
+    limiter = HostRateLimiter(rate)
+    has_artist = 'Artist' in df.columns
+    progress = get_metrics().progress('lyrics', len(plan))
+
+    # Snapshot every planned row up front; the download threads must not read df while this thread writes it
+    rows = {index: df.loc[index].copy() for index in plan.rows}
+
+    def fetch(index):
+        row = rows[index]
+        artist = row['Artist'] if has_artist else None
+        return fetch_song_page(row['Song'], artist, row['Lyrics_URL'], row['Lyrics'], limiter)
+
+    pool = ParsePool(fetch, extract_lyrics, workers, parse_workers)
+    for index, (lyrics_url, lyrics), parsed in pool.run(plan.rows):
+        row = rows[index]
+        if parsed is not None:
+            lyrics = parsed
+        elif lyrics is None:
+            logging.error(f"No lyrics for {row['Song']} from {lyrics_url}")
+            get_cache().forget('genius_page', lyrics_url)
+            lyrics = RETRY_LATER
+        df.at[index, 'Lyrics_URL'] = str(lyrics_url)
+        df.at[index, 'Lyrics'] = str(lyrics)
+        store.append(row, Lyrics_URL=str(lyrics_url), Lyrics=str(lyrics))
+
+        progress.advance()
+        print(f"Processed: {row['Song']} by {row.get('Artist')} ({progress.done}/{progress.total}, ETA {progress.eta()})")
+        logging.info(f"Processed: {row['Song']} by {row.get('Artist')}")
+
+def process_shared(df, plan, queue_path, stage, workers, rate, batch_size=25):
+    """Split the songs with other processes or machines through the shared queue at queue_path
+
+    Each process claims leased batches and fetches them on `workers` threads.
+    The one process that merges every result into df once the queue is drained
+    gets the open queue back and calls finish_merge() after writing the output;
+    the others get None and leave the output to it.
+    """
+    queue = WorkQueue(queue_path, stage)
+    worker = worker_name()
+    keys = song_keys(df.loc[plan.rows], 'Song', 'Artist' if 'Artist' in df.columns else None)
+    index_by_key = dict(zip(keys, plan.rows))
+    added = queue.add((key, {'Song': df.at[index, 'Song'], 'Artist': df.at[index, 'Artist'] if 'Artist' in df.columns else None})
+                      for key, index in index_by_key.items())
+    print(f"[{worker}] {added} songs added to the {stage} queue in {queue_path}")
+
+    limiter = HostRateLimiter(rate)
+    progress = get_metrics().progress('lyrics', len(plan))
+
+    def fetch(key):
+        row = df.loc[index_by_key[key]]
+        return fetch_song(row['Song'], row.get('Artist'), row['Lyrics_URL'], row['Lyrics'], limiter)
+
+    def process_batch(items):
+        keys = [key for key, _ in items if key in index_by_key]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            fetched = dict(zip(keys, executor.map(fetch, keys)))
+        progress.advance(len(fetched))
+        # Songs whose requests failed are left out, so the queue hands them out again
+        return {key: {'Lyrics_URL': str(lyrics_url), 'Lyrics': str(lyrics)} for key, (lyrics_url, lyrics) in fetched.items()
+                if RETRY_LATER not in (lyrics_url, lyrics)}
+
+    try:
+        run_worker(queue, worker, process_batch, batch_size)
+        if not queue.claim_merge(worker):
+            queue.close()
+            return None
+        for key, result in queue.results().items():
+            if key in index_by_key:
+                for column, value in result.items():
+                    df.at[index_by_key[key], column] = value
+        print(f"[{worker}] merged {queue.counts()['done']} songs from the {stage} queue")
+        return queue
+    except BaseException:
+        queue.close()
+        raise
+
+def fetch_all_lyrics(file_path, output_file, workers=1, rate=5.0, export_only=False, parse_workers=0, queue_path=None):
+    """Fill Lyrics_URL and Lyrics for every song in file_path and write the result to output_file
+
+    With `queue_path` the songs are shared out through that work queue, and only
+    the process that merges the results writes output_file.
+    """
+    # Progress files live next to the input file
+    stem = os.path.splitext(file_path)[0]
+    checkpoint_path = stem + '_checkpoint.jsonl'  # Progress log
+    partial_save_path = stem + '_partial_save.xlsx'  # Old-style partial save
+
+    df = load_frame(file_path)
+
     # Ensure that 'Lyrics_URL' and 'Lyrics' columns exist, and initialize them if not
-    if 'Lyrics_URL' not in df.columns:
-        df['Lyrics_URL'] = ''  # Initialize with empty strings if the column doesn't exist
-    if 'Lyrics' not in df.columns:
-        df['Lyrics'] = ''  # Initialize with empty strings if the column doesn't exist
-
-# Ensure the columns are of string type to avoid dtype issues
-df['Lyrics_URL'] = df['Lyrics_URL'].astype(str)
-df['Lyrics'] = df['Lyrics'].astype(str)
-
-# Create lists to store the lyrics URLs and lyrics content
-lyrics_urls = df['Lyrics_URL'].tolist()
-lyrics_content = df['Lyrics'].tolist()
-
-for index, row in df.iterrows():
-    song = row['Song']
-    artist = row['Artist'] if 'Artist' in df.columns else None
-    
-    # Initialize lyrics_url
-    lyrics_url = None
-
-    # If the lyrics URL is missing, fetch it
-    if pd.isna(row['Lyrics_URL']) or row['Lyrics_URL'] == 'nan' or row['Lyrics_URL'] == '':
-        lyrics_url = get_lyrics(song, artist)
-        lyrics_urls[index] = str(lyrics_url)
-        df.at[index, 'Lyrics_URL'] = lyrics_url  # Save the URL immediately
-        
-        # Save the partial progress including the URL
-        df.to_excel(partial_save_path, index=False)
-    else:
-        # Use existing URL from the row
-        lyrics_url = row['Lyrics_URL']
-
-    # If the lyrics are missing but we have a URL, scrape the lyrics from the URL
-    if (pd.isna(row['Lyrics']) or row['Lyrics'] == 'nan' or row['Lyrics'] == '') and lyrics_url not in [None, 'nan', '']:
-        lyrics = scrape_lyrics(lyrics_url)
-        lyrics_content[index] = str(lyrics)
-        df.at[index, 'Lyrics'] = lyrics  # Save the lyrics immediately
-        
-        # Save the partial progress including the lyrics
-        df.to_excel(partial_save_path, index=False)
-    
-    # Output song title once it's processed
-    print(f"Processed: {song} by {artist}")
-    logging.info(f"Processed: {song} by {artist}")
-    
-    # Save the dataframe periodically to prevent data loss
-    if index % 10 == 0:  # Save after every 10 rows
-        df['Lyrics_URL'] = pd.Series(lyrics_urls)
-        df['Lyrics'] = pd.Series(lyrics_content)
-        df.to_excel(partial_save_path, index=False)
-        logging.info(f"Partial save after processing {index + 1} songs.")
-
-# After the loop, ensure the full dataframe is saved
-df['Lyrics_URL'] = pd.Series(lyrics_urls)
-df['Lyrics'] = pd.Series(lyrics_content)
-df.to_excel(output_file, index=False)
-
-print(f"Lyrics have been fetched and saved to '{output_file}'.")
-logging.info(f"Lyrics fetching process completed and saved to '{output_file}'.")
+    for column in LYRICS_COLUMNS:
+        if column not in df.columns:
+            df[column] = ''
+
+    store = CheckpointStore(checkpoint_path)
+
+    # Carry progress over from a run that still used the workbook partial save
+    if not os.path.exists(checkpoint_path) and os.path.exists(partial_save_path):
+        store.import_frame(pd.read_excel(partial_save_path), LYRICS_COLUMNS)
+        logging.info(f"Imported progress from {partial_save_path} into {checkpoint_path}")
+
+    # Replay everything fetched in earlier runs
+    if os.path.exists(checkpoint_path):
+        logging.info(f"Resuming from checkpoint: {checkpoint_path}")
+        print(f"Resuming from checkpoint: {checkpoint_path}")
+    store.apply(df, LYRICS_COLUMNS)
+
+    # Ensure the columns are of string type to avoid dtype issues
+    df['Lyrics_URL'] = df['Lyrics_URL'].fillna('').astype(str)
+    df['Lyrics'] = df['Lyrics'].fillna('').astype(str)
+
+    # Only rows that still need work are handed to the fetchers, each song once
+    fill_from_matches(df, LYRICS_COLUMNS)
+    plan = plan_lyrics_work(df)
+    print(f"{plan.total} of {len(df)} rows need lyrics work ({len(plan)} distinct songs)")
+    logging.info(f"{plan.total} of {len(df)} rows need lyrics work ({len(plan)} distinct songs)")
+
+    queue = None
+    try:
+        if export_only:
+            pass
+        elif queue_path:
+            stage = f"lyrics {os.path.basename(file_path)}"
+            queue = process_shared(df, plan, queue_path, stage, max(workers, 1), rate)
+            if queue is None:
+                print(f"Queue drained; another worker writes '{output_file}' "
+                      f"(python work_queue.py {queue_path} --remerge \"{stage}\" to write it again).")
+                return df
+        elif parse_workers:
+            process_pipelined(df, store, plan, workers, rate, parse_workers)
+        elif workers > 1:
+            process_concurrently(df, store, plan, workers, rate)
+        else:
+            process_serially(df, store, plan)
+    finally:
+        store.close()
+    plan.propagate(df, LYRICS_COLUMNS)
+
+    # Results are kept as Parquet; the workbook is only an export, written once at the end
+    save_frame(df, output_file)
+    export_excel(df, output_file)
+    if queue is not None:
+        queue.finish_merge(worker_name())
+        queue.close()
+
+    print(f"Lyrics have been fetched and saved to '{output_file}'.")
+    logging.info(f"Lyrics fetching process completed and saved to '{output_file}'.")
+    get_cache().log_stats()
+    log_throttle_metrics()
+    write_metrics()
+    return df
+
+def main():
+    logging.basicConfig(filename='lyrics_fetch.log', level=logging.INFO,
+                        format='%(asctime)s:%(levelname)s:%(message)s')
+    parser = argparse.ArgumentParser(description="Fetch Genius lyrics for every song in the input workbook")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of songs fetched at once (1 keeps the original serial loop)")
+    parser.add_argument('--rate', type=float, default=5.0,
+                        help="Maximum requests per second sent to each host in concurrent mode")
+    parser.add_argument('--export-only', action='store_true',
+                        help="Write the Excel output from the checkpoint log without fetching anything")
+    parser.add_argument('--parse-workers', type=int, default=0,
+                        help="Parse lyrics pages in this many processes while --workers threads download")
+    parser.add_argument('--input', default='Blank_Data.xlsx', help="Workbook with Song and Artist columns")
+    parser.add_argument('--output', default='Blank_Data_final_output.xlsx', help="Where the lyrics are written")
+    parser.add_argument('--queue', help="Shared SQLite work queue; start this script on several processes or hosts with the same file to split the songs")
+    args = parser.parse_args()
+
+    fetch_all_lyrics(args.input, args.output, args.workers, args.rate, args.export_only, args.parse_workers, args.queue)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from urllib.parse import urlencode
+
+import requests
+
+from metrics import get_metrics
+
+# Where the shared cache lives unless configure_cache() says otherwise
+DEFAULT_CACHE_PATH = os.environ.get('MUSIC_TRENDS_CACHE', 'http_cache.sqlite')
+
+# Total size of the stored (compressed) bodies before least recently used entries are dropped
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+DAY = 24 * 60 * 60
+
+# Least recently used entries deleted per query while evicting
+EVICT_BATCH = 500
+
+# Seconds a response stays fresh, per source. None means it never expires:
+# a lyrics page does not change, search results and metadata can. The lyrics
+# scrapers forget() a page they could not extract lyrics from, so only pages that
+# held lyrics are kept forever. A chart page can still change while its week is
+# recent, so billboard_data_scrape only keeps old weeks forever.
+DEFAULT_TTLS = {
+    'billboard': DAY,
+    'genius_search': 30 * DAY,
+    'genius_page': None,
+    'itunes': 7 * DAY,
+    'spotify': 7 * DAY,
+}
+
+
+# Stands for "use the source's TTL" where None already means "never expires"
+SOURCE_TTL = object()
+
+
+class CachedResponse:
+    """The parts of requests.Response the scrapers use, rebuilt from a cache entry"""
+
+    def __init__(self, status_code, content, from_cache=True):
+        self.status_code = status_code
+        self.content = content
+        self.from_cache = from_cache
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class ResponseCache:
+    """On-disk response cache shared by every scraper
+
+    Bodies are zlib-compressed in a single SQLite file. Each source has its own
+    TTL, and once the stored bodies pass `max_bytes` the least recently used
+    entries are evicted. Hit and miss counts are kept per source.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES, ttls=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        self.counters = {}
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            ' key TEXT PRIMARY KEY, source TEXT, status INTEGER, body BLOB,'
+            ' size INTEGER, fetched_at REAL, accessed_at REAL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)')
+        self._conn.commit()
+        self._total_bytes = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def make_key(source, url, params=None):
+        """Cache key for a request; headers are left out so tokens never end up in the key"""
+        if params:
+            url = f"{url}?{urlencode(sorted(params.items()))}"
+        return f"{source} {url}"
+
+    def _count(self, source, name):
+        counts = self.counters.setdefault(source, {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0})
+        counts[name] += 1
+        metrics = get_metrics()
+        metrics.count('cache_events_total', source=source, event=name)
+        if name in ('hits', 'misses'):
+            metrics.gauge('cache_hit_rate', round(counts['hits'] / (counts['hits'] + counts['misses']), 4), source=source)
+
+    def lookup(self, source, key, ttl=SOURCE_TTL):
+        """Return (status, body) for a fresh entry, or None; `ttl` overrides the source's TTL"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT status, body, fetched_at FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+
+            if ttl is SOURCE_TTL:
+                ttl = self.ttls.get(source)
+            now = time.time()
+            if row is None or (ttl is not None and now - row[2] > ttl):
+                self._count(source, 'misses')
+                return None
+
+            self._conn.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+            self._conn.commit()
+            self._count(source, 'hits')
+            return row[0], zlib.decompress(row[1])
+
+    def store(self, source, key, status, body):
+        compressed = zlib.compress(body)
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, source, status, compressed, len(compressed), now, now),
+            )
+            self._total_bytes += len(compressed) - (old[0] if old else 0)
+            self._count(source, 'stores')
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        # Drop least recently used entries, a batch at a time, until we are 10% under the cap
+        target = self.max_bytes * 0.9
+        while self._total_bytes > target:
+            rows = self._conn.execute(
+                'SELECT key, source, size FROM responses ORDER BY accessed_at LIMIT ?', (EVICT_BATCH,)
+            ).fetchall()
+            if not rows:
+                break
+            evicted = []
+            for key, source, size in rows:
+                if self._total_bytes <= target:
+                    break
+                evicted.append((key,))
+                self._total_bytes -= size
+                self._count(source, 'evictions')
+            self._conn.executemany('DELETE FROM responses WHERE key = ?', evicted)
+
+    def forget(self, source, url, params=None):
+        """Drop a stored response, e.g. a page that turned out not to hold what it should"""
+        key = self.make_key(source, url, params)
+        with self._lock:
+            row = self._conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self._conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self._conn.commit()
+                self._total_bytes -= row[0]
+
+    def get(self, source, url, params=None, fetch=requests.get, ttl=SOURCE_TTL, **kwargs):
+        """requests.get with the cache in front; `fetch` is only called on a miss
+
+        Only 200 responses are stored, so failures are retried on the next run.
+        `ttl` replaces the source's TTL for this request.
+        """
+        key = self.make_key(source, url, params)
+        cached = self.lookup(source, key, ttl)
+        if cached is not None:
+            return CachedResponse(*cached)
+
+        response = fetch(url, params=params, **kwargs)
+        if response.status_code == 200:
+            self.store(source, key, response.status_code, response.content)
+        return response
+
+    def lookup_json(self, source, key):
+        """A cached API result, or None"""
+        cached = self.lookup(source, f"{source} {key}")
+        return json.loads(cached[1]) if cached is not None else None
+
+    def store_json(self, source, key, value):
+        self.store(source, f"{source} {key}", 200, json.dumps(value).encode('utf-8'))
+
+    def memoize_json(self, source, key, call):
+        """Cache the JSON-serializable result of an API client call such as sp.search"""
+        cached = self.lookup_json(source, key)
+        if cached is not None:
+            return cached
+
+        result = call()
+        self.store_json(source, key, result)
+        return result
+
+    def stats(self):
+        """Counters per source plus the overall hit rate and stored size"""
+        hits = sum(c['hits'] for c in self.counters.values())
+        misses = sum(c['misses'] for c in self.counters.values())
+        return {
+            'sources': {source: dict(counts) for source, counts in self.counters.items()},
+            'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+            'stored_bytes': self._total_bytes,
+        }
+
+    def log_stats(self):
+        logging.info(f"HTTP cache stats: {json.dumps(self.stats())}")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_shared_cache = None
+_shared_lock = threading.Lock()
+
+def configure_cache(path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES, ttls=None):
+    """Replace the shared cache, e.g. to point it at another file or change TTLs"""
+    global _shared_cache
+    with _shared_lock:
+        if _shared_cache is not None:
+            _shared_cache.close()
+        _shared_cache = ResponseCache(path, max_bytes, ttls)
+    return _shared_cache
+
+def get_cache():
+    """The process-wide cache, opened on first use"""
+    global _shared_cache
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = ResponseCache()
+    return _shared_cache
+
+def cached_get(source, url, params=None, fetch=requests.get, ttl=SOURCE_TTL, **kwargs):
+    """Shortcut for get_cache().get(...)"""
+    return get_cache().get(source, url, params=params, fetch=fetch, ttl=ttl, **kwargs)
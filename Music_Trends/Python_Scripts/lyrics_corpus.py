@@ -0,0 +1,295 @@
+import argparse
+import json
+import os
+import time
+import zlib
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from chart_model import EPOCH, ChartModel
+from lyrics_features import FeatureStore, lyrics_hash
+from song_matching import canonical_keys
+from storage import load_frame
+
+# zstd compresses lyrics better and faster, but zlib with a preset dictionary does without the extra package
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CORPUS_DIR = 'lyrics_corpus'
+
+# Size of the shared compression dictionary; zlib can only use the last 32 KiB of one
+ZSTD_DICTIONARY_SIZE = 112 * 1024
+ZLIB_DICTIONARY_SIZE = 32 * 1024
+
+# Lyrics used to train the dictionary when the corpus is created
+DICTIONARY_SAMPLES = 2000
+
+
+def train_dictionary(codec, texts):
+    """Compression dictionary built from a sample of lyrics"""
+    samples = [text.encode('utf-8') for text in texts[:DICTIONARY_SAMPLES] if text]
+    if codec == 'zstd':
+        try:
+            return zstandard.train_dictionary(ZSTD_DICTIONARY_SIZE, samples).as_bytes()
+        except zstandard.ZstdError:
+            return b''  # Too few samples to train on
+    # zlib matches against the end of the dictionary best, so the most common lines go last
+    lines = Counter(line for sample in samples for line in sample.splitlines() if len(line) > 8)
+    dictionary = b''
+    for line, _ in reversed(lines.most_common()):
+        dictionary += line + b'\n'
+    return dictionary[-ZLIB_DICTIONARY_SIZE:]
+
+
+class TextCodec:
+    """Compresses single lyrics with a dictionary shared by the whole corpus"""
+
+    def __init__(self, codec, dictionary):
+        if codec == 'zstd' and zstandard is None:
+            raise ImportError("This corpus was written with zstd; install the zstandard package to read it")
+        self.codec = codec
+        self.dictionary = dictionary
+        if codec == 'zstd':
+            data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            self._compressor = zstandard.ZstdCompressor(level=10, dict_data=data)
+            self._decompressor = zstandard.ZstdDecompressor(dict_data=data)
+
+    def compress(self, text):
+        data = text.encode('utf-8')
+        if self.codec == 'zstd':
+            return self._compressor.compress(data)
+        compressor = zlib.compressobj(9, zdict=self.dictionary) if self.dictionary else zlib.compressobj(9)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, blob):
+        if self.codec == 'zstd':
+            return self._decompressor.decompress(blob).decode('utf-8')
+        decompressor = zlib.decompressobj(zdict=self.dictionary) if self.dictionary else zlib.decompressobj()
+        return (decompressor.decompress(blob) + decompressor.flush()).decode('utf-8')
+
+
+class LyricsCorpus:
+    """Every distinct lyrics text stored once, compressed, with a word index joined to chart years
+
+    Texts are keyed by content hash through a FeatureStore kept inside the
+    corpus directory, so a text's row is the same in the word counts, the text
+    store and the index. The compressed texts sit back to back in texts.bin.
+    The inverted index is the transpose of the word counts (word -> rows and
+    counts). Each text is linked to the years it charted in, through the song
+    list in songs.parquet that every build adds to. All of these are
+    .npy files that are memory-mapped, so a query reads only the slices it needs.
+    """
+
+    def __init__(self, directory=CORPUS_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.features = FeatureStore(self._path('features'))
+        self.codec = None
+        self.text_offsets = np.zeros(1, dtype=np.int64)
+        self._word_ids = None
+        self._load()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _save(self, name, array):
+        np.save(self._path(name + '.tmp.npy'), array)
+        os.replace(self._path(name + '.tmp.npy'), self._path(name))
+
+    def _load(self):
+        if os.path.exists(self._path('codec.json')):
+            with open(self._path('codec.json')) as f:
+                codec = json.load(f)['codec']
+            with open(self._path('dictionary.bin'), 'rb') as f:
+                self.codec = TextCodec(codec, f.read())
+        if os.path.exists(self._path('text_offsets.npy')):
+            self.text_offsets = np.load(self._path('text_offsets.npy'))
+        if os.path.exists(self._path('index_ptr.npy')):
+            self.index_ptr = np.load(self._path('index_ptr.npy'), mmap_mode='r')
+            self.index_rows = np.load(self._path('index_rows.npy'), mmap_mode='r')
+            self.index_counts = np.load(self._path('index_counts.npy'), mmap_mode='r')
+        if os.path.exists(self._path('link_ptr.npy')):
+            self.link_ptr = np.load(self._path('link_ptr.npy'), mmap_mode='r')
+            self.link_years = np.load(self._path('link_years.npy'), mmap_mode='r')
+            self.years = np.load(self._path('years.npy'))
+            self.songs_per_year = np.load(self._path('songs_per_year.npy'))
+            self.words_per_year = np.load(self._path('words_per_year.npy'))
+
+    def __len__(self):
+        return len(self.text_offsets) - 1
+
+    def add(self, lyrics, workers=None):
+        """Store and index the lyrics not in the corpus yet; returns the corpus row of every lyrics cell"""
+        lyrics = [text if isinstance(text, str) and text not in ('None', 'nan') else '' for text in lyrics]
+        rows, tokenized = self.features.update(lyrics, workers)
+
+        if self.codec is None:
+            codec = 'zstd' if zstandard is not None else 'zlib'
+            dictionary = train_dictionary(codec, [text for text in lyrics if text])
+            with open(self._path('dictionary.bin'), 'wb') as f:
+                f.write(dictionary)
+            with open(self._path('codec.json'), 'w') as f:
+                json.dump({'codec': codec}, f)
+            self.codec = TextCodec(codec, dictionary)
+
+        # The feature store appended the new texts in order, so they fill the rows after the stored ones
+        if len(self.features) > len(self):
+            text_by_hash = {lyrics_hash(text): text for text, row in zip(lyrics, rows) if row >= len(self)}
+            blobs = [self.codec.compress(text_by_hash[digest.decode('ascii')].strip())
+                     for digest in self.features.hashes[len(self):]]
+            with open(self._path('texts.bin'), 'ab') as f:
+                # Anything past the last offset is left over from an interrupted run and overwritten
+                f.truncate(int(self.text_offsets[-1]))
+                for blob in blobs:
+                    f.write(blob)
+            lengths = np.array([len(blob) for blob in blobs], dtype=np.int64)
+            self.text_offsets = np.concatenate([self.text_offsets, self.text_offsets[-1] + np.cumsum(lengths)])
+            self._save('text_offsets.npy', self.text_offsets)
+
+        if tokenized or not os.path.exists(self._path('index_ptr.npy')):
+            self.build_index()
+        return rows
+
+    def build_index(self):
+        """Write the inverted index: for every word, the rows that use it and how often"""
+        by_word = self.features.counts().tocsc()
+        by_word.sort_indices()
+        self._save('index_ptr.npy', by_word.indptr.astype(np.int64))
+        self._save('index_rows.npy', by_word.indices.astype(np.int32))
+        self._save('index_counts.npy', by_word.data.astype(np.int32))
+        self._word_ids = None
+        self._load()
+
+    def add_songs(self, titles, artists, rows):
+        """Remember the song (title and artist) of every lyrics row, next to the songs of earlier builds
+
+        A song seen again takes the row from the newer workbook.
+        """
+        songs = pd.DataFrame({
+            'Song': pd.Series(titles).astype(object).fillna('').astype(str).to_numpy(),
+            'Artist': pd.Series(artists).astype(object).fillna('').astype(str).to_numpy(),
+            'row': np.asarray(rows, dtype=np.int64),
+        })
+        if os.path.exists(self._path('songs.parquet')):
+            songs = pd.concat([pd.read_parquet(self._path('songs.parquet')), songs], ignore_index=True)
+        songs = songs.drop_duplicates(['Song', 'Artist'], keep='last').reset_index(drop=True)
+        songs.to_parquet(self._path('songs.parquet.tmp'), index=False)
+        os.replace(self._path('songs.parquet.tmp'), self._path('songs.parquet'))
+        return songs
+
+    def link_chart(self, model):
+        """Join corpus rows to the years their songs were on the chart
+
+        Every song recorded by add_songs() is matched to the chart songs in
+        `model` by canonical key, so each build relinks the whole corpus, not
+        only the workbook it just added.
+        """
+        tokens = np.asarray(self.features.stat_rows[:, 0])
+        songs = pd.read_parquet(self._path('songs.parquet')) if os.path.exists(self._path('songs.parquet')) \
+            else pd.DataFrame({'Song': [], 'Artist': [], 'row': np.zeros(0, dtype=np.int64)})
+        lyrics = pd.DataFrame({'key': canonical_keys(songs['Song'], songs['Artist']).to_numpy(), 'row': songs['row'].to_numpy()})
+        # The newest lyrics of a song win when the same key was recorded more than once
+        lyrics = lyrics[tokens[lyrics['row']] > 0].drop_duplicates('key', keep='last')
+        row_by_key = pd.Series(lyrics['row'].to_numpy(), index=lyrics['key'].to_numpy())
+
+        chart_keys = canonical_keys(model.titles[model.title_id], model.artists[model.artist_id])
+        song_rows = row_by_key.reindex(chart_keys.to_numpy()).to_numpy()
+
+        # One (row, year) pair for every year a linked song spent at least one week on the chart
+        week_rows = np.repeat(song_rows, np.diff(model.offsets))
+        week_years = (EPOCH + model.days.astype('timedelta64[D]')).astype('datetime64[Y]').astype(np.int32) + 1970
+        linked = ~np.isnan(week_rows)
+        pairs = np.unique(week_rows[linked].astype(np.int64) * 10000 + week_years[linked])
+        link_rows, link_years = pairs // 10000, (pairs % 10000).astype(np.int16)
+
+        link_ptr = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(link_rows, minlength=len(self)), out=link_ptr[1:])
+        years = np.arange(link_years.min(), link_years.max() + 1, dtype=np.int16) if len(pairs) else np.zeros(0, np.int16)
+        position = link_years - (years[0] if len(years) else 0)
+
+        self._save('link_ptr.npy', link_ptr)
+        self._save('link_years.npy', link_years)
+        self._save('years.npy', years)
+        self._save('songs_per_year.npy', np.bincount(position, minlength=len(years)))
+        self._save('words_per_year.npy', np.bincount(position, weights=tokens[link_rows], minlength=len(years)))
+        self._load()
+        return len(np.unique(link_rows))
+
+    def text(self, row):
+        """The lyrics stored at `row`, decompressed"""
+        with open(self._path('texts.bin'), 'rb') as f:
+            f.seek(int(self.text_offsets[row]))
+            return self.codec.decompress(f.read(int(self.text_offsets[row + 1] - self.text_offsets[row])))
+
+    def postings(self, word):
+        """(rows, counts) of the texts that use `word`"""
+        if self._word_ids is None:
+            self._word_ids = {w: i for i, w in enumerate(self.features.vocab)}
+        word_id = self._word_ids.get(word.lower())
+        if word_id is None:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+        start, end = self.index_ptr[word_id], self.index_ptr[word_id + 1]
+        return self.index_rows[start:end], self.index_counts[start:end]
+
+    def word_by_year(self, word):
+        """Per chart year: songs with lyrics, how many use `word`, and its occurrences per 10k words"""
+        rows, counts = self.postings(word)
+        starts = np.asarray(self.link_ptr[rows])
+        lengths = np.asarray(self.link_ptr[rows + 1]) - starts
+        # Expand every posting into one entry per year its song charted
+        within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        years = np.asarray(self.link_years[np.repeat(starts, lengths) + within])
+        position = years - (self.years[0] if len(self.years) else 0)
+
+        songs_with_word = np.bincount(position, minlength=len(self.years))
+        occurrences = np.bincount(position, weights=np.repeat(counts, lengths), minlength=len(self.years))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return pd.DataFrame({
+                'year': self.years,
+                'songs': self.songs_per_year,
+                'songs_with_word': songs_with_word,
+                'share': np.where(self.songs_per_year > 0, songs_with_word / self.songs_per_year, 0.0),
+                'occurrences': occurrences.astype(np.int64),
+                'per_10k_words': np.where(self.words_per_year > 0, occurrences / self.words_per_year * 10_000, 0.0),
+            })
+
+def build_corpus(lyrics_path, charts_path='charts.csv', directory=CORPUS_DIR, workers=None):
+    """Add a lyrics workbook to the corpus and relink every song in the corpus to the chart history"""
+    df = load_frame(lyrics_path)
+    corpus = LyricsCorpus(directory)
+    before = len(corpus)
+    rows = corpus.add(df['Lyrics'].tolist(), workers)
+    corpus.add_songs(df['Song'], df['Artist'], rows)
+    linked = corpus.link_chart(ChartModel.cached(charts_path))
+
+    stored = int(corpus.text_offsets[-1])
+    raw = sum(len(t.encode('utf-8')) for t in set(df['Lyrics'].dropna().astype(str)))
+    print(f"{len(df)} rows -> {len(corpus)} distinct lyrics ({len(corpus) - before} new), "
+          f"{len(corpus.features.vocab)} words; {linked} lyrics linked to chart years")
+    print(f"Texts take {stored / 1024 ** 2:.1f} MiB with {corpus.codec.codec} ({raw / max(stored, 1):.1f}x smaller than the raw text)")
+    return corpus
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compressed lyrics corpus with a word index joined to chart years")
+    parser.add_argument('mode', choices=['build', 'word'], help="Add a lyrics workbook to the corpus, or chart words by year")
+    parser.add_argument('words', nargs='*', help="Words to look up in word mode")
+    parser.add_argument('--lyrics', default='Unique_Songs_Lyrics.xlsx', help="Workbook with Song, Artist and Lyrics columns")
+    parser.add_argument('--charts', default='charts.csv', help="Chart history (charts.csv or a Parquet dataset)")
+    parser.add_argument('--corpus', default=CORPUS_DIR, help="Directory holding the corpus")
+    parser.add_argument('--workers', type=int, help="Tokenizer processes (default: one per CPU)")
+    args = parser.parse_args()
+
+    if args.mode == 'build':
+        build_corpus(args.lyrics, args.charts, args.corpus, args.workers)
+    else:
+        corpus = LyricsCorpus(args.corpus)
+        for word in args.words:
+            started = time.perf_counter()
+            by_year = corpus.word_by_year(word)
+            elapsed = (time.perf_counter() - started) * 1000
+            print(f"'{word}' by chart year ({elapsed:.1f} ms):")
+            print(by_year[by_year['songs'] > 0].to_string(index=False))
@@ -0,0 +1,82 @@
+import re
+
+from metrics import get_metrics
+
+# Optional C-backed parsers; the fastest one that is installed is used by default
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+# Genius marks every lyrics block with this attribute. The CSS class names carry a
+# build hash (Lyrics__Container-sc-1ynbvzw-1 kUgSbL) that changes on every redeploy,
+# so the class is only used as a fallback for pages without the attribute.
+CONTAINER_ATTRIBUTE = 'data-lyrics-container'
+CONTAINER_CLASS = re.compile(r'^Lyrics__Container(?:$|-)')
+
+
+def _join(blocks):
+    lyrics = '\n'.join(block.strip() for block in blocks)
+    return lyrics or None
+
+def extract_with_selectolax(content):
+    tree = LexborHTMLParser(content)
+    nodes = tree.css(f'div[{CONTAINER_ATTRIBUTE}="true"]')
+    if not nodes:
+        nodes = [n for n in tree.css('div[class^="Lyrics__Container"]')
+                 if any(CONTAINER_CLASS.match(c) for c in n.attributes.get('class', '').split())]
+    return _join(node.text(separator='\n') for node in nodes) if nodes else None
+
+def extract_with_lxml(content):
+    tree = lxml.html.fromstring(content)
+    nodes = tree.xpath(f'//div[@{CONTAINER_ATTRIBUTE}="true"]')
+    if not nodes:
+        nodes = [n for n in tree.xpath('//div[starts-with(@class, "Lyrics__Container")]')
+                 if any(CONTAINER_CLASS.match(c) for c in n.get('class', '').split())]
+    return _join('\n'.join(node.itertext()) for node in nodes) if nodes else None
+
+def extract_with_bs4(content):
+    # bs4 is only the fallback parser, so importing this module does not load it
+    from bs4 import BeautifulSoup, SoupStrainer
+
+    # Only the lyrics containers are turned into a tree; the rest of the page is skipped
+    soup = BeautifulSoup(content, 'html.parser', parse_only=SoupStrainer('div', attrs={CONTAINER_ATTRIBUTE: 'true'}))
+    nodes = soup.find_all('div', recursive=False)
+    if not nodes:
+        soup = BeautifulSoup(content, 'html.parser', parse_only=SoupStrainer('div', class_=CONTAINER_CLASS))
+        nodes = soup.find_all('div', recursive=False)
+    return _join(node.get_text(separator='\n') for node in nodes) if nodes else None
+
+EXTRACTORS = {
+    'selectolax': extract_with_selectolax,
+    'lxml': extract_with_lxml,
+    'bs4': extract_with_bs4,
+}
+
+def available_extractors():
+    """Names of the extractors whose parser is installed, fastest first"""
+    names = []
+    if LexborHTMLParser is not None:
+        names.append('selectolax')
+    if lxml is not None:
+        names.append('lxml')
+    names.append('bs4')
+    return names
+
+def get_extractor(name=None):
+    """The extractor called `name`, or the fastest available one"""
+    if name is None:
+        name = available_extractors()[0]
+    if name not in available_extractors():
+        raise ValueError(f"Lyrics extractor '{name}' is not available; choose from {available_extractors()}")
+    return EXTRACTORS[name]
+
+def extract_lyrics(content, extractor=None):
+    """Lyrics text from a Genius song page, or None if the page has no lyrics container"""
+    with get_metrics().phase('parsing'):
+        return get_extractor(extractor)(content)
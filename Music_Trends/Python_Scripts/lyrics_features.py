@@ -0,0 +1,200 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from storage import load_frame
+
+FEATURE_DIR = 'lyrics_features'
+
+# Genius section headers such as [Chorus] or [Verse 1: Artist] are not lyrics
+SECTION_HEADER = re.compile(r'\[[^\]]*\]')
+WORD = re.compile(r"[a-z0-9]+(?:'[a-z0-9]+)*")
+
+STAT_COLUMNS = ['tokens', 'unique_tokens', 'type_token_ratio', 'lines', 'unique_lines',
+                'repeated_line_share', 'max_line_repeats']
+
+
+def lyrics_hash(text):
+    """Content hash of one lyrics cell; missing lyrics all hash to the empty string's digest"""
+    if text is None or (not isinstance(text, str) and pd.isna(text)) or text in ('None', 'nan'):
+        text = ''
+    return hashlib.sha1(text.strip().encode('utf-8')).hexdigest()
+
+def tokenize(text):
+    """(word counts, repetition stats) for one song"""
+    if not isinstance(text, str) or text in ('None', 'nan'):
+        text = ''
+    text = SECTION_HEADER.sub('', text.lower())
+    words = WORD.findall(text)
+    lines = [' '.join(WORD.findall(line)) for line in text.splitlines()]
+    lines = [line for line in lines if line]
+    line_counts = Counter(lines)
+    counts = Counter(words)
+    stats = (
+        len(words),
+        len(counts),
+        len(counts) / len(words) if words else 0.0,
+        len(lines),
+        len(line_counts),
+        1 - len(line_counts) / len(lines) if lines else 0.0,
+        max(line_counts.values()) if lines else 0,
+    )
+    return counts, stats
+
+def tokenize_chunk(texts):
+    """Worker entry point: tokenize a list of lyrics in a separate process"""
+    return [tokenize(text) for text in texts]
+
+
+class FeatureStore:
+    """Word counts and repetition stats per distinct lyrics text, kept on disk between runs
+
+    Every song is keyed by the hash of its lyrics, so only new or edited lyrics
+    are tokenized again. The count matrix is stored as the three CSR arrays in
+    plain .npy files and memory-mapped on load; column ids come from vocab.json,
+    which only ever grows, so earlier rows stay valid.
+    """
+
+    def __init__(self, directory=FEATURE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.vocab = []
+        self.hashes = np.empty(0, dtype='S40')
+        self.data = np.empty(0, dtype=np.int32)
+        self.indices = np.empty(0, dtype=np.int32)
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.stat_rows = np.empty((0, len(STAT_COLUMNS)), dtype=np.float32)
+        self._load()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load(self):
+        if not os.path.exists(self._path('hashes.npy')):
+            return
+        with open(self._path('vocab.json')) as f:
+            self.vocab = json.load(f)
+        self.hashes = np.load(self._path('hashes.npy'))
+        self.data = np.load(self._path('data.npy'), mmap_mode='r')
+        self.indices = np.load(self._path('indices.npy'), mmap_mode='r')
+        self.indptr = np.load(self._path('indptr.npy'), mmap_mode='r')
+        self.stat_rows = np.load(self._path('stats.npy'), mmap_mode='r')
+
+    def _save(self, name, array):
+        # Write next to the target and swap in, so an interrupted run leaves the old file intact
+        np.save(self._path(name + '.tmp.npy'), array)
+        os.replace(self._path(name + '.tmp.npy'), self._path(name))
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def rows_for(self, hashes):
+        """Row of each hash in the store, -1 where it has not been tokenized yet"""
+        positions = pd.Index(self.hashes.astype(str)).get_indexer(hashes)
+        return np.asarray(positions)
+
+    def update(self, lyrics, workers=None, chunk_size=500):
+        """Tokenize the lyrics not in the store yet; returns the store row of every lyrics cell"""
+        hashes = [lyrics_hash(text) for text in lyrics]
+        rows = self.rows_for(hashes)
+        new = pd.Series(list(lyrics), dtype=object)[rows < 0]
+        new = new[~pd.Index(np.array(hashes)[rows < 0]).duplicated()]
+        if len(new) == 0:
+            return rows, 0
+
+        texts = new.tolist()
+        chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+        if len(chunks) > 1 and workers != 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = [song for chunk in executor.map(tokenize_chunk, chunks) for song in chunk]
+        else:
+            results = [song for chunk in chunks for song in tokenize_chunk(chunk)]
+
+        word_ids = {word: i for i, word in enumerate(self.vocab)}
+        data, indices, lengths, stats = [], [], [], []
+        for counts, song_stats in results:
+            for word in counts:
+                if word not in word_ids:
+                    word_ids[word] = len(self.vocab)
+                    self.vocab.append(word)
+            indices.extend(word_ids[word] for word in counts)
+            data.extend(counts.values())
+            lengths.append(len(counts))
+            stats.append(song_stats)
+
+        self.hashes = np.concatenate([self.hashes, np.array([hashes[i] for i in new.index], dtype='S40')])
+        self.data = np.concatenate([self.data, np.array(data, dtype=np.int32)])
+        self.indices = np.concatenate([self.indices, np.array(indices, dtype=np.int32)])
+        self.indptr = np.concatenate([self.indptr, self.indptr[-1] + np.cumsum(lengths, dtype=np.int64)])
+        self.stat_rows = np.concatenate([self.stat_rows, np.array(stats, dtype=np.float32)])
+
+        with open(self._path('vocab.json.tmp'), 'w') as f:
+            json.dump(self.vocab, f)
+        os.replace(self._path('vocab.json.tmp'), self._path('vocab.json'))
+        for name, array in [('data.npy', self.data), ('indices.npy', self.indices), ('indptr.npy', self.indptr),
+                            ('stats.npy', self.stat_rows), ('hashes.npy', self.hashes)]:
+            self._save(name, array)
+        self._load()
+        return self.rows_for(hashes), len(new)
+
+    def counts(self, rows=None):
+        """Word-count matrix (songs x vocabulary) for the given store rows"""
+        matrix = sp.csr_matrix((self.data, self.indices, self.indptr), shape=(len(self), len(self.vocab)))
+        return matrix if rows is None else matrix[rows]
+
+    def stats(self, rows=None):
+        """Repetition stats per song as a DataFrame"""
+        values = self.stat_rows if rows is None else self.stat_rows[rows]
+        return pd.DataFrame(np.asarray(values), columns=STAT_COLUMNS)
+
+    def tfidf(self, rows):
+        """Smoothed, L2-normalized TF-IDF for a set of songs, cached on disk per set of lyrics"""
+        key = hashlib.sha1(self.hashes[rows].tobytes() + str(len(self.vocab)).encode()).hexdigest()[:16]
+        path = self._path(f'tfidf_{key}.npz')
+        if os.path.exists(path):
+            return sp.load_npz(path)
+        matrix = tfidf(self.counts(rows))
+        sp.save_npz(path, matrix)
+        return matrix
+
+
+def tfidf(counts):
+    """TF-IDF with idf = ln((1 + n) / (1 + df)) + 1 and unit-length rows"""
+    counts = sp.csr_matrix(counts, dtype=np.float64)
+    n = counts.shape[0]
+    document_frequency = np.bincount(counts.indices, minlength=counts.shape[1])
+    idf = np.log((1 + n) / (1 + document_frequency)) + 1
+    weighted = counts @ sp.diags(idf)
+    norms = np.sqrt(np.asarray(weighted.multiply(weighted).sum(axis=1))).ravel()
+    norms[norms == 0] = 1
+    return sp.csr_matrix(sp.diags(1 / norms) @ weighted)
+
+def featurize(path, store_dir=FEATURE_DIR, workers=None, lyrics_column='Lyrics'):
+    """Counts, TF-IDF and repetition stats for every row of a lyrics workbook, in row order"""
+    df = load_frame(path)
+    store = FeatureStore(store_dir)
+    rows, tokenized = store.update(df[lyrics_column].tolist(), workers)
+    print(f"Tokenized {tokenized} new lyrics; {len(df) - tokenized} rows reused cached features "
+          f"({len(store)} songs, {len(store.vocab)} words in {store_dir}/)")
+    stats = store.stats(rows)
+    stats.index = df.index
+    return store.counts(rows), store.tfidf(rows), stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tokenize the Lyrics column into cached sparse feature matrices")
+    parser.add_argument('input', nargs='?', default='Unique_Songs_Lyrics_Spotify.xlsx', help="Workbook with a Lyrics column")
+    parser.add_argument('--store', default=FEATURE_DIR, help="Directory holding the cached features")
+    parser.add_argument('--workers', type=int, help="Tokenizer processes (default: one per CPU)")
+    args = parser.parse_args()
+
+    counts, weights, stats = featurize(args.input, args.store, args.workers)
+    print(f"Count matrix {counts.shape} with {counts.nnz} entries; TF-IDF cached under {args.store}/")
+    print(stats.describe().loc[['mean', '50%', 'max']])
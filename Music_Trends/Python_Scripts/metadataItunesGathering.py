@@ -0,0 +1,190 @@
+import os
+import argparse
+import threading
+import logging
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from checkpoint import CheckpointStore
+from http_cache import cached_get, get_cache
+from storage import load_frame, save_frame, export_excel
+from planner import ITUNES_COLUMNS, fill_from_matches, missing_mask, plan_itunes_work
+from throttle import get_throttle, log_throttle_metrics
+from metrics import get_metrics, write_metrics
+
+SEARCH_URL = "https://itunes.apple.com/search"
+LOOKUP_URL = "https://itunes.apple.com/lookup"
+
+# Track ids sent in one lookup call
+LOOKUP_BATCH_SIZE = 150
+
+# One pooled session per worker thread so connections to Apple are reused
+_local = threading.local()
+
+def _session():
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = _local.session = requests.Session()
+        session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+    return session
+
+def _itunes_get(url, params):
+    # Cached responses skip the network; the throttle paces the rest, backs off on 429 and retries
+    def fetch(fetch_url, **kwargs):
+        return get_throttle('itunes').call(lambda: _session().get(fetch_url, timeout=30, **kwargs))
+    return cached_get('itunes', url, params=params, fetch=fetch)
+
+def search_itunes(song_title, artist_name, limit=1):
+    """Search iTunes for a song and artist and return the metadata of the first hit, or None
+
+    None means iTunes answered and has no such song. Any other answer (a 429 or
+    server error left after the throttle's retries) raises, so the song is not
+    recorded and the next run searches it again.
+    """
+    response = _itunes_get(SEARCH_URL, {
+        "term": f"{song_title} {artist_name}",
+        "media": "music",
+        "entity": "song",
+        "limit": limit,
+    })
+    if response.status_code != 200:
+        raise requests.HTTPError(f"iTunes search failed with status {response.status_code}", response=response)
+
+    results = response.json().get('results', [])
+    return results[0] if results else None
+
+def lookup_itunes(track_ids):
+    """{track id: metadata} for up to LOOKUP_BATCH_SIZE ids in a single lookup call; raises unless iTunes answers"""
+    response = _itunes_get(LOOKUP_URL, {"id": ','.join(track_ids), "entity": "song"})
+    if response.status_code != 200:
+        raise requests.HTTPError(f"iTunes lookup failed with status {response.status_code}", response=response)
+    return {str(result['trackId']): result for result in response.json().get('results', []) if 'trackId' in result}
+
+def itunes_values(result):
+    """The ITUNES_COLUMNS values for one search or lookup result; N/A when nothing was found"""
+    if not result:
+        return {'Album': "N/A", 'Genre': "N/A", 'Release Date': "N/A", 'iTunes URL': "N/A", 'iTunes Track ID': None}
+    return {
+        'Album': result.get('collectionName', ""),
+        'Genre': result.get('primaryGenreName', ""),
+        'Release Date': result.get('releaseDate', ""),
+        'iTunes URL': result.get('trackViewUrl', ""),
+        'iTunes Track ID': str(result['trackId']) if 'trackId' in result else None,
+    }
+
+def fetch_itunes_metadata(input_file, output_file, title_column='Song', artist_column='Artist', workers=4, rate=None, refresh=False):
+    """Fill the iTunes columns for every song in input_file and write the result to output_file
+
+    Each distinct song is fetched once. Rows that already know their iTunes
+    track are refreshed through the lookup endpoint, LOOKUP_BATCH_SIZE per call;
+    the rest are searched on `workers` threads sharing one throttle. Every
+    result goes to a checkpoint log as it arrives, so an interrupted run
+    resumes where it stopped. With `refresh` every row with a track id is
+    looked up again, to pick up changed album or genre data.
+
+    Apple allows roughly 20 requests a minute, and every thread shares that
+    budget through the 'itunes' throttle, which never goes faster than that.
+    `rate` resets the throttle even when an earlier call already created it. A first run searches each song once,
+    so 30k new songs take about a day however many workers there are. Only
+    rows that already have a track id are batched, which in practice means a
+    `refresh` run. Those rows cost one lookup per LOOKUP_BATCH_SIZE songs.
+    """
+    if rate:
+        get_throttle('itunes', rate)
+
+    df = load_frame(input_file)
+    for column in ITUNES_COLUMNS:
+        if column not in df.columns:
+            df[column] = None
+
+    # Replay everything fetched in earlier runs
+    store = CheckpointStore(os.path.splitext(input_file)[0] + '_itunes_checkpoint.jsonl', (title_column, artist_column))
+    store.apply(df, ITUNES_COLUMNS)
+    fill_from_matches(df, ITUNES_COLUMNS, title_column, artist_column)
+    if refresh:
+        df.loc[~missing_mask(df['iTunes Track ID']), ITUNES_COLUMNS[:-1]] = None
+
+    plan = plan_itunes_work(df, title_column, artist_column)
+    print(f"{plan.total} of {len(df)} rows are missing iTunes metadata ({len(plan)} distinct songs)")
+    logging.info(f"{plan.total} of {len(df)} rows are missing iTunes metadata ({len(plan)} distinct songs)")
+    progress = get_metrics().progress('itunes', len(plan))
+
+    def record(index, result):
+        # Only the calling thread writes to df and the checkpoint
+        values = itunes_values(result)
+        for column, value in values.items():
+            df.at[index, column] = value
+        store.append(df.loc[index], **values)
+        progress.advance()
+
+    try:
+        # Known tracks: one lookup call per batch of ids
+        has_id = ~missing_mask(df.loc[plan.rows, 'iTunes Track ID']).to_numpy()
+        known = list(plan.rows[has_id])
+        unresolved = list(plan.rows[~has_id])
+        for start in range(0, len(known), LOOKUP_BATCH_SIZE):
+            batch = known[start:start + LOOKUP_BATCH_SIZE]
+            try:
+                found = lookup_itunes([str(df.at[index, 'iTunes Track ID']) for index in batch])
+            except Exception as e:
+                # Left empty, so the next run looks the batch up again
+                logging.error(f"iTunes lookup of {len(batch)} tracks failed: {e}")
+                continue
+            for index in batch:
+                result = found.get(str(df.at[index, 'iTunes Track ID']))
+                if result:
+                    record(index, result)
+                else:
+                    unresolved.append(index)  # Gone from the store; search for it instead
+            print(f"Looked up {start + len(batch)}/{len(known)} known tracks (ETA {progress.eta()})")
+
+        # Everything else is searched concurrently
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(search_itunes, df.at[index, title_column], df.at[index, artist_column]): index
+                       for index in unresolved}
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # Left empty, so the next run searches it again
+                    logging.error(f"iTunes search for row {index} failed: {e}")
+                    continue
+                record(index, result)
+                print(f"Processed: {df.at[index, title_column]} by {df.at[index, artist_column]} "
+                      f"({progress.done}/{progress.total}, ETA {progress.eta()})")
+    finally:
+        store.close()
+    plan.propagate(df, ITUNES_COLUMNS)
+
+    save_frame(df, output_file)
+    export_excel(df, output_file)
+    print(f"Metadata has been written to {output_file}")
+    get_cache().log_stats()
+    log_throttle_metrics()
+    write_metrics()
+    return df
+
+def main():
+    logging.basicConfig(filename='itunes_metadata.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(
+        description="Add iTunes metadata to every song in the input workbook",
+        epilog="iTunes allows about 20 requests a minute, shared by all workers. Songs without an iTunes "
+               "track id need one search each (about 1,200 songs an hour, so a day for 30k songs). "
+               f"Batched lookups ({LOOKUP_BATCH_SIZE} known tracks per request) only speed up --refresh runs.")
+    parser.add_argument('--input', default='Blank_Data.xlsx', help="Workbook with title and artist columns")
+    parser.add_argument('--output', default='Blank_Data_itunes.xlsx', help="Where the metadata is written")
+    parser.add_argument('--title-column', default='Song', help="Column holding the song title")
+    parser.add_argument('--artist-column', default='Artist', help="Column holding the artist")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="Searches in flight at once; they overlap latency but share the same rate limit")
+    parser.add_argument('--rate', type=float, default=None,
+                        help="Starting requests per second to iTunes (the throttle adapts it from there, "
+                             "never above Apple's 20 a minute)")
+    parser.add_argument('--refresh', action='store_true', help="Look up every song with a known iTunes track again")
+    args = parser.parse_args()
+
+    fetch_itunes_metadata(args.input, args.output, args.title_column, args.artist_column, args.workers, args.rate, args.refresh)
+
+if __name__ == "__main__":
+    main()
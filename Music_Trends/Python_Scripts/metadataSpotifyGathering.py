@@ -1,46 +1,65 @@
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
+import os
 import pandas as pd
-import json
+import argparse
 import time
 import logging
-from spotipy.exceptions import SpotifyException
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
-
-# Set up logging
-logging.basicConfig(filename='spotify_metadata.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+from http_cache import get_cache
+from storage import load_frame
+from planner import METADATA_COLUMNS, plan_metadata_work, song_keys
+from throttle import jittered_backoff, log_throttle_metrics
+from spotify_pool import SpotifyClientPool
+from metrics import get_metrics, write_metrics
+from app_config import get_config
+from work_queue import WorkQueue, run_worker, worker_name
 
 # Set the filename for reading and writing the Excel file
 FILENAME = 'Blank_Data.xlsx'
 
-# Load the Spotify credentials from config.json
-with open('config.json') as config_file:
-    config = json.load(config_file)
+# Every client_id/client_secret pair in config.json gets its own client; calls rotate across them.
+# The pool is built on the first Spotify call, so importing this module reads no config.
+_pool = None
+_pool_lock = threading.Lock()
 
-client_id = config['spotify']['client_id']
-client_secret = config['spotify']['client_secret']
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SpotifyClientPool.from_config(get_config())
+    return _pool
 
-# Set up Spotify credentials
-client_credentials_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret)
-sp = spotipy.Spotify(client_credentials_manager=client_credentials_manager, requests_timeout=10)
+MAX_RETRIES = 3
 
-# Load your song dataset (use pd.read_excel to load as a DataFrame)
-df = pd.read_excel(FILENAME)
+# Spotify's multi-ID endpoints (sp.tracks, sp.artists) accept at most 50 IDs per call
+SPOTIFY_BATCH_LIMIT = 50
 
-# Add columns for additional metadata
-df['Track Popularity'] = None
-df['Track Explicit'] = None
-df['Album'] = None
-df['Album Release Date'] = None
-df['Artist Popularity'] = None
-df['Artist Genres'] = None
-df['Track ID'] = None
-df['Total Tracks in Album'] = None
+def apply_track(row, track):
+    """Copy the track metadata into the row"""
+    row['Track Popularity'] = track['popularity']
+    row['Track Explicit'] = track['explicit']
+    row['Album'] = track['album']['name']
+    row['Album Release Date'] = track['album']['release_date']
+    row['Track ID'] = track['id']
+    row['Total Tracks in Album'] = track['album']['total_tracks']
+    return row
 
-MAX_RETRIES = 3
+def apply_artist(row, artist):
+    """Copy the artist metadata into the row"""
+    row['Artist Popularity'] = artist['popularity']
+    row['Artist Genres'] = ', '.join(artist['genres'])
+    return row
+
+def spotify_call(call):
+    """Run `call(sp)` on the next client of the pool; a rate-limited client is benched and another one used"""
+    return get_pool().call(call, MAX_RETRIES)
 
 # Function to fetch metadata from Spotify with retry logic
 def fetch_metadata(row):
+    # spotipy takes a noticeable time to import, so it is only loaded once metadata is fetched
+    from spotipy.exceptions import SpotifyException
+
     if pd.isnull(row['Title']) or pd.isnull(row['Artist']):
         logging.warning(f"Skipping row due to missing Title or Artist: {row}")
         return row
@@ -50,24 +69,19 @@ def fetch_metadata(row):
         try:
             logging.info(f"Fetching metadata for {row['Title']} by {row['Artist']}")
             # Search for the track by title and artist
-            result = sp.search(q=f'track:{row["Title"]} artist:{row["Artist"]}', type='track')
+            query = f'track:{row["Title"]} artist:{row["Artist"]}'
+            result = get_cache().memoize_json('spotify', f'search {query}', lambda: spotify_call(lambda sp: sp.search(q=query, type='track')))
             
             if result['tracks']['items']:
                 track = result['tracks']['items'][0]
 
                 # Fetch Track Metadata
-                row['Track Popularity'] = track['popularity']
-                row['Track Explicit'] = track['explicit']
-                row['Album'] = track['album']['name']
-                row['Album Release Date'] = track['album']['release_date']
-                row['Track ID'] = track['id']
-                row['Total Tracks in Album'] = track['album']['total_tracks']
+                apply_track(row, track)
 
                 # Fetch Artist Metadata
                 artist_id = track['artists'][0]['id']
-                artist = sp.artist(artist_id)
-                row['Artist Popularity'] = artist['popularity']
-                row['Artist Genres'] = ', '.join(artist['genres'])
+                artist = get_cache().memoize_json('spotify', f'artist {artist_id}', lambda: spotify_call(lambda sp: sp.artist(artist_id)))
+                apply_artist(row, artist)
 
             return row
 
@@ -95,60 +109,277 @@ def fetch_metadata(row):
             if retries == MAX_RETRIES:
                 logging.error(f"Max retries reached for {row['Title']} by {row['Artist']}. Skipping.")
                 return row
-            time.sleep(2)  # Wait before retrying
+            time.sleep(jittered_backoff(retries))  # Jittered backoff before retrying
 
     return row
 
+def new_excel_path(filename):
+    """Where save_to_new_excel writes the rows fetched for `filename`"""
+    return filename.replace('.xlsx', '_new.xlsx')
+
 # Function to save DataFrame to a new Excel file with "_new" appended to the filename
 def save_to_new_excel(data, filename):
-    new_filename = filename.replace('.xlsx', '_new.xlsx')
-    try:
-        # Try to append to the new Excel file
-        with pd.ExcelWriter(new_filename, mode='a', engine='openpyxl', if_sheet_exists='overlay') as writer:
-            data.to_excel(writer, sheet_name='Sheet1', index=False, header=False, startrow=writer.sheets['Sheet1'].max_row)
-    except FileNotFoundError:
-        # If the file does not exist, create it with headers
-        with pd.ExcelWriter(new_filename, mode='w', engine='openpyxl') as writer:
-            data.to_excel(writer, sheet_name='Sheet1', index=False)
+    new_filename = new_excel_path(filename)
+    with get_metrics().phase('excel_io'):
+        try:
+            # Try to append to the new Excel file
+            with pd.ExcelWriter(new_filename, mode='a', engine='openpyxl', if_sheet_exists='overlay') as writer:
+                data.to_excel(writer, sheet_name='Sheet1', index=False, header=False, startrow=writer.sheets['Sheet1'].max_row)
+        except FileNotFoundError:
+            # If the file does not exist, create it with headers
+            with pd.ExcelWriter(new_filename, mode='w', engine='openpyxl') as writer:
+                data.to_excel(writer, sheet_name='Sheet1', index=False)
+
+def expand_to_duplicates(updated, df, plan):
+    """Rows for every duplicate of the updated songs, each carrying its representative's metadata"""
+    members = [member for index in updated.index for member in plan.group(index)]
+    expanded = df.loc[members].copy()
+    expanded[METADATA_COLUMNS] = updated.loc[plan.representative[members].to_numpy(), METADATA_COLUMNS].to_numpy()
+    return expanded
 
 # Main function to fetch metadata for all songs and save to a new Excel file
 def fetch_all_metadata(df, filename):
-    # Start from the first row
-    start_index = 0
-    print(f"Starting from row {start_index}")
-    logging.info(f"Starting from row {start_index}")
+    # Work out up front which rows are missing metadata, so complete rows are never visited
+    plan = plan_metadata_work(df)
+    print(f"{plan.total} of {len(df)} rows are missing metadata ({len(plan)} distinct songs)")
+    logging.info(f"{plan.total} of {len(df)} rows are missing metadata ({len(plan)} distinct songs)")
 
     updated_rows = []
-    for index, row in df.iterrows():
-        # Check if any of the metadata columns are missing (None or NaN)
-        if pd.isnull(row['Track Popularity']) or pd.isnull(row['Track Explicit']) or pd.isnull(row['Album']) or pd.isnull(row['Album Release Date']) or pd.isnull(row['Artist Popularity']) or pd.isnull(row['Artist Genres']) or pd.isnull(row['Track ID']) or pd.isnull(row['Total Tracks in Album']):
-            
-            print(f"Missing metadata for row {index}: {row['Title']} by {row['Artist']}. Fetching...")
-            logging.info(f"Missing metadata for row {index}: {row['Title']} by {row['Artist']}. Fetching...")
-            updated_row = fetch_metadata(row)  # Fetch metadata if any value is missing
-            updated_rows.append(updated_row)
-
-        else:
-            print(f"Row {index}: {row['Title']} by {row['Artist']} already has metadata. Skipping...")
-            logging.info(f"Row {index}: {row['Title']} by {row['Artist']} already has metadata. Skipping...")
+    progress = get_metrics().progress('spotify', len(plan))
+    for position, index in enumerate(plan.rows):
+        row = df.loc[index].copy()
+        print(f"Missing metadata for row {index}: {row['Title']} by {row['Artist']}. Fetching...")
+        logging.info(f"Missing metadata for row {index}: {row['Title']} by {row['Artist']}. Fetching...")
+        updated_row = fetch_metadata(row)
+        updated_rows.append(updated_row)
+        progress.advance()
 
-        # Save every 10 rows to the new Excel file
-        if (index + 1) % 10 == 0:
-            temp_df = pd.DataFrame(updated_rows)
+        # Save every 10 songs to the new Excel file
+        if (position + 1) % 10 == 0:
+            temp_df = expand_to_duplicates(pd.DataFrame(updated_rows), df, plan)
             save_to_new_excel(temp_df, filename)
-            print(f"Saved rows {index-9} to {index} to new file: {filename.replace('.xlsx', '_new.xlsx')}")
-            logging.info(f"Saved rows {index-9} to {index} to new file: {filename.replace('.xlsx', '_new.xlsx')}")
+            print(f"Saved {len(temp_df)} rows to new file: {new_excel_path(filename)}")
+            logging.info(f"Saved {len(temp_df)} rows to new file: {new_excel_path(filename)}")
             updated_rows = []  # Clear the buffer after saving
 
-        # Add delay between requests to avoid rate limits
-        time.sleep(1)  # 1-second delay between requests
-
     # Save any remaining rows
     if updated_rows:
-        temp_df = pd.DataFrame(updated_rows)
+        temp_df = expand_to_duplicates(pd.DataFrame(updated_rows), df, plan)
         save_to_new_excel(temp_df, filename)
-        print(f"Saved remaining rows to new file: {filename.replace('.xlsx', '_new.xlsx')}")
-        logging.info(f"Saved remaining rows to new file: {filename.replace('.xlsx', '_new.xlsx')}")
+        print(f"Saved remaining rows to new file: {new_excel_path(filename)}")
+        logging.info(f"Saved remaining rows to new file: {new_excel_path(filename)}")
+
+# Searches of a batch run on several threads, which all count their calls in `backoff`
+_count_lock = threading.Lock()
+
+def call_with_backoff(call, backoff):
+    """Run `call(sp)` through the client pool, counting it in `backoff`
+
+    Each client's throttle honors Retry-After on 429, retries server errors and
+    timeouts with jittered backoff, and moves its request rate up and down (AIMD)
+    so it settles just under what Spotify allows that app.
+    """
+    result = spotify_call(call)
+    with _count_lock:
+        backoff['calls'] += 1
+    return result
+
+def fetch_artists(artist_ids, artists, backoff):
+    """Look up artists we have not seen yet, 50 per sp.artists call, memoizing them in `artists`"""
+    cache = get_cache()
+    missing = []
+    for artist_id in artist_ids:
+        if artist_id in artists:
+            continue
+        cached = cache.lookup_json('spotify', f'artist {artist_id}')
+        if cached is not None:
+            artists[artist_id] = cached
+        else:
+            missing.append(artist_id)
+
+    for start in range(0, len(missing), SPOTIFY_BATCH_LIMIT):
+        ids = missing[start:start + SPOTIFY_BATCH_LIMIT]
+        result = call_with_backoff(lambda sp: sp.artists(ids), backoff)
+        for artist in result['artists']:
+            if artist:
+                artists[artist['id']] = artist
+                cache.store_json('spotify', f"artist {artist['id']}", artist)
+
+def resolve_batch(batch, artists, searches, backoff):
+    """Fill the metadata columns of one batch of rows (at most 50) in place
+
+    `artists` and `searches` memoize artists and search results across batches.
+    """
+    from spotipy.exceptions import SpotifyException
+    cache = get_cache()
+    tracks = {}
+
+    try:
+        # Rows that know their track are refreshed with a single multi-ID call
+        known = batch['Track ID'].notnull()
+        track_ids = batch.loc[known, 'Track ID'].unique().tolist()
+        if track_ids:
+            result = call_with_backoff(lambda sp: sp.tracks(track_ids), backoff)
+            by_id = {track['id']: track for track in result['tracks'] if track}
+            for index in batch.index[known]:
+                tracks[index] = by_id.get(batch.at[index, 'Track ID'])
+
+        # The others need a search; identical queries are only sent once
+        queries = {}
+        for index, row in batch[~known].iterrows():
+            if pd.isnull(row['Title']) or pd.isnull(row['Artist']):
+                logging.warning(f"Skipping row due to missing Title or Artist: {row}")
+                continue
+            queries[index] = f'track:{row["Title"]} artist:{row["Artist"]}'
+
+        def search(query):
+            return cache.memoize_json('spotify', f'search {query}',
+                                      lambda: call_with_backoff(lambda sp: sp.search(q=query, type='track'), backoff))
+
+        new_queries = sorted(set(queries.values()) - set(searches))
+        with ThreadPoolExecutor(max_workers=len(get_pool())) as executor:
+            for query, result in zip(new_queries, executor.map(search, new_queries)):
+                items = result['tracks']['items']
+                searches[query] = items[0] if items else None
+        for index, query in queries.items():
+            tracks[index] = searches[query]
+
+        fetch_artists({track['artists'][0]['id'] for track in tracks.values() if track}, artists, backoff)
+
+    except (SpotifyException, requests.exceptions.RequestException) as e:
+        # Whatever was resolved before the error is still applied below
+        logging.error(f"Error fetching batch starting at row {batch.index[0]}: {e}")
+
+    for index, track in tracks.items():
+        if not track:
+            continue
+        row = apply_track(batch.loc[index].copy(), track)
+        artist = artists.get(track['artists'][0]['id'])
+        if artist:
+            apply_artist(row, artist)
+        batch.loc[index] = row
+
+    return batch
+
+def fetch_all_metadata_batched(df, filename, batch_size=SPOTIFY_BATCH_LIMIT):
+    """Batched variant of fetch_all_metadata
+
+    Rows that already have a Track ID are refreshed with one sp.tracks call per
+    batch, the rest need one search each (repeated title/artist pairs share it),
+    and the artists of a batch are deduplicated and fetched with sp.artists.
+    Artists are memoized for the whole run, so popular artists are only fetched once.
+    The searches of a batch run in parallel, one thread per client in the pool.
+    """
+    batch_size = min(batch_size, SPOTIFY_BATCH_LIMIT)
+    plan = plan_metadata_work(df)
+    todo = plan.rows
+    print(f"{plan.total} of {len(df)} rows are missing metadata ({len(todo)} distinct songs)")
+    logging.info(f"{plan.total} of {len(df)} rows are missing metadata ({len(todo)} distinct songs)")
+
+    backoff = {'calls': 0}
+    progress = get_metrics().progress('spotify', len(todo))
+    artists = {}
+    searches = {}
+
+    for start in range(0, len(todo), batch_size):
+        batch = df.loc[todo[start:start + batch_size]].copy()
+        resolve_batch(batch, artists, searches, backoff)
+
+        save_to_new_excel(expand_to_duplicates(batch, df, plan), filename)
+        progress.advance(len(batch))
+        print(f"Saved {start + len(batch)}/{len(todo)} rows to new file: {new_excel_path(filename)} (ETA {progress.eta()})")
+        logging.info(f"Saved {start + len(batch)}/{len(todo)} rows to new file: {new_excel_path(filename)}")
+
+    print(f"Made {backoff['calls']} Spotify API calls across {len(get_pool())} clients for {len(todo)} rows ({len(artists)} distinct artists)")
+    logging.info(f"Made {backoff['calls']} Spotify API calls for {len(todo)} rows ({len(artists)} distinct artists)")
+
+def fetch_all_metadata_shared(df, filename, queue_path, batch_size=SPOTIFY_BATCH_LIMIT):
+    """Batched fetch split with other processes or machines through the shared queue at queue_path
+
+    Every process claims leased batches of songs; the one that merges the
+    drained queue writes all of the results to the _new.xlsx file.
+    """
+    batch_size = min(batch_size, SPOTIFY_BATCH_LIMIT)
+    plan = plan_metadata_work(df)
+    stage = f"spotify {os.path.basename(filename)}"
+    queue = WorkQueue(queue_path, stage)
+    worker = worker_name()
+    keys = song_keys(df.loc[plan.rows], 'Title', 'Artist')
+    index_by_key = dict(zip(keys, plan.rows))
+    added = queue.add((key, {'Title': df.at[index, 'Title'], 'Artist': df.at[index, 'Artist']})
+                      for key, index in index_by_key.items())
+    print(f"[{worker}] {added} songs added to the {stage} queue in {queue_path}")
+
+    backoff = {'calls': 0}
+    progress = get_metrics().progress('spotify', len(plan))
+    artists = {}
+    searches = {}
+
+    def process_batch(items):
+        keys = [key for key, _ in items if key in index_by_key]
+        batch = resolve_batch(df.loc[[index_by_key[key] for key in keys]].copy(), artists, searches, backoff)
+        progress.advance(len(keys))
+        return {key: batch.loc[index_by_key[key], METADATA_COLUMNS].to_dict() for key in keys}
+
+    try:
+        run_worker(queue, worker, process_batch, batch_size)
+        print(f"[{worker}] made {backoff['calls']} Spotify API calls across {len(get_pool())} clients")
+        if not queue.claim_merge(worker):
+            print(f"Queue drained; another worker writes {new_excel_path(filename)} "
+                  f"(python work_queue.py {queue_path} --remerge \"{stage}\" to write it again)")
+            return
+        results = {index_by_key[key]: result for key, result in queue.results().items() if key in index_by_key}
+        updated = df.loc[list(results)].copy()
+        for index, result in results.items():
+            for column, value in result.items():
+                updated.at[index, column] = value
+        save_to_new_excel(expand_to_duplicates(updated, df, plan), filename)
+        queue.finish_merge(worker)
+        print(f"[{worker}] merged {len(results)} songs from the {stage} queue into {new_excel_path(filename)}")
+    finally:
+        queue.close()
+
+def enrich_file(filename, batched=False, batch_size=SPOTIFY_BATCH_LIMIT, queue_path=None):
+    """Fetch Spotify metadata for every song in `filename`; fetched rows go to the _new.xlsx file
+
+    With `queue_path` the songs are split with other workers through that work queue.
+    """
+    # Load your song dataset
+    df = load_frame(filename)
+
+    # The lyrics files call the title column 'Song'
+    if 'Title' not in df.columns and 'Song' in df.columns:
+        df['Title'] = df['Song']
+
+    # Add columns for additional metadata, keeping any metadata the file already has
+    for column in METADATA_COLUMNS:
+        if column not in df.columns:
+            df[column] = None
+
+    # Call the function to fetch metadata and save it
+    if queue_path:
+        fetch_all_metadata_shared(df, filename, queue_path, batch_size)
+    elif batched:
+        fetch_all_metadata_batched(df, filename, batch_size)
+    else:
+        fetch_all_metadata(df, filename)
+    get_cache().log_stats()
+    log_throttle_metrics()
+    write_metrics()
+    return new_excel_path(filename)
+
+def main():
+    logging.basicConfig(filename='spotify_metadata.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Add Spotify metadata to every song in the input workbook")
+    parser.add_argument('--batched', action='store_true',
+                        help="Use the multi-ID endpoints and artist dedup instead of one search + artist call per row")
+    parser.add_argument('--batch-size', type=int, default=SPOTIFY_BATCH_LIMIT,
+                        help="Rows per batch in batched mode (at most 50)")
+    parser.add_argument('--input', default=FILENAME, help="Workbook with Title and Artist columns")
+    parser.add_argument('--queue', help="Shared SQLite work queue; start this script on several processes or hosts with the same file to split the songs")
+    args = parser.parse_args()
+
+    enrich_file(args.input, args.batched, args.batch_size, args.queue)
 
-# Call the function to fetch metadata and save it
-fetch_all_metadata(df, FILENAME)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+import bisect
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Where write_metrics() puts metrics.json and metrics.prom unless told otherwise
+DEFAULT_METRICS_PATH = os.environ.get('MUSIC_TRENDS_METRICS', 'metrics')
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Every metric name gets this prefix in the Prometheus output
+PREFIX = 'music_trends_'
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Histogram:
+    """Bucketed observations; quantiles are interpolated within a bucket like Prometheus does"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)  # The last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                if i == len(self.bounds):
+                    return lower  # Beyond the last bound there is nothing to interpolate to
+                return lower + (self.bounds[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+
+class Progress:
+    """Rows done against rows planned for one stage, with rows/s and ETA gauges"""
+
+    def __init__(self, metrics, stage, total):
+        self.metrics = metrics
+        self.stage = stage
+        self.total = total
+        self.done = 0
+        self.eta_seconds = None
+        self.started = time.monotonic()
+        self.metrics.gauge('stage_rows_total', total, stage=stage)
+
+    def advance(self, rows=1):
+        self.done += rows
+        elapsed = time.monotonic() - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        self.eta_seconds = (self.total - self.done) / rate if rate else None
+        self.metrics.gauge('stage_rows_done', self.done, stage=self.stage)
+        self.metrics.gauge('stage_rows_per_second', round(rate, 3), stage=self.stage)
+        self.metrics.gauge('stage_eta_seconds', round(self.eta_seconds, 1) if rate else -1, stage=self.stage)
+        self.metrics.maybe_write()
+
+    def eta(self):
+        """Human readable estimate of the time left, for progress prints"""
+        if self.eta_seconds is None:
+            return 'unknown'
+        return time.strftime('%H:%M:%S', time.gmtime(self.eta_seconds))
+
+
+class Metrics:
+    """Counters, gauges and latency histograms, labelled like Prometheus metrics
+
+    Scripts record into the shared instance from get_metrics(); write() dumps it
+    as JSON (with p50/p90/p99 per histogram) and as Prometheus text. While a
+    long stage runs the files are refreshed every `interval` seconds.
+    """
+
+    def __init__(self, path=DEFAULT_METRICS_PATH, interval=15.0):
+        self.path = path
+        self.interval = interval
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._last_write = time.monotonic()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def count(self, name, amount=1, **labels):
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            key = _label_key(labels)
+            series[key] = series.get(key, 0) + amount
+
+    def gauge(self, name, value, **labels):
+        with self._lock:
+            self.gauges.setdefault(name, {})[_label_key(labels)] = value
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            key = _label_key(labels)
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe how long the block takes into histogram `name`"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @contextmanager
+    def phase(self, phase):
+        """Add the block's duration to the time spent in `phase` (excel_io, parquet_io, network, parsing...)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.count('phase_seconds_total', time.perf_counter() - started, phase=phase)
+
+    def progress(self, stage, total):
+        return Progress(self, stage, total)
+
+    def to_json(self):
+        with self._lock:
+            def series(metric, value):
+                return [{'labels': dict(key), **value(v)} for key, v in metric.items()]
+
+            return {
+                'written_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'counters': {name: series(m, lambda v: {'value': round(v, 6)}) for name, m in self.counters.items()},
+                'gauges': {name: series(m, lambda v: {'value': v}) for name, m in self.gauges.items()},
+                'histograms': {name: series(m, lambda h: {
+                    'count': h.count, 'sum': round(h.sum, 6),
+                    'p50': h.quantile(0.5), 'p90': h.quantile(0.9), 'p99': h.quantile(0.99),
+                }) for name, m in self.histograms.items()},
+            }
+
+    def to_prometheus(self):
+        def labels(key, extra=()):
+            pairs = list(key) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+        lines = []
+        with self._lock:
+            for kind, metrics in (('counter', self.counters), ('gauge', self.gauges)):
+                for name, series in sorted(metrics.items()):
+                    lines.append(f"# TYPE {PREFIX}{name} {kind}")
+                    lines.extend(f"{PREFIX}{name}{labels(key)} {value}" for key, value in series.items())
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                for key, histogram in series.items():
+                    cumulative = 0
+                    for bound, count in zip(histogram.bounds + [math.inf], histogram.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == math.inf else repr(bound)
+                        lines.append(f"{PREFIX}{name}_bucket{labels(key, [('le', le)])} {cumulative}")
+                    lines.append(f"{PREFIX}{name}_sum{labels(key)} {histogram.sum}")
+                    lines.append(f"{PREFIX}{name}_count{labels(key)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path=None):
+        """Write <path>.json and <path>.prom; returns the JSON path"""
+        path = path or self.path
+        # Stages running in parallel (or other processes) can write at the same moment: one write at a
+        # time in this process, and a temporary file of its own for every write
+        with self._write_lock:
+            for target, text in ((path + '.json', json.dumps(self.to_json(), indent=2)), (path + '.prom', self.to_prometheus())):
+                with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(target)),
+                                                 prefix=os.path.basename(target) + '.', suffix='.tmp', delete=False) as f:
+                    f.write(text)
+                os.replace(f.name, target)
+            self._last_write = time.monotonic()
+        return path + '.json'
+
+    def maybe_write(self):
+        """Refresh the metric files if the last write is older than `interval`"""
+        if time.monotonic() - self._last_write >= self.interval:
+            try:
+                self.write()
+            except OSError as e:
+                logging.warning(f"Could not write metrics to {self.path}: {e}")
+
+
+_shared_metrics = None
+_shared_lock = threading.Lock()
+
+def get_metrics():
+    """The process-wide metrics, created on first use"""
+    global _shared_metrics
+    with _shared_lock:
+        if _shared_metrics is None:
+            _shared_metrics = Metrics()
+    return _shared_metrics
+
+def write_metrics(path=None):
+    path = get_metrics().write(path)
+    logging.info(f"Metrics written to {path}")
+    return path
@@ -0,0 +1,100 @@
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# Marks the end of one fetch thread's share of the items
+_DONE = object()
+
+
+class ParsePool:
+    """Network threads feed raw pages through a bounded queue into a process pool of parsers
+
+    `fetch(item)` runs on `fetch_workers` threads and returns `(content, meta)`;
+    content is the raw page (None when there is nothing to parse) and meta is
+    passed through untouched. `parse(content)` runs in `parse_workers` processes,
+    so it must be a module-level function. `run()` yields `(item, meta, result)`
+    in completion order on the calling thread, which makes that thread the only
+    writer of checkpoints or files.
+
+    At most `max_pending` pages wait in the queue and at most `max_pending` are
+    being parsed, so memory stays flat however far the fetchers get ahead.
+    Items whose fetch raises are logged and left out, to be retried next run.
+    """
+
+    def __init__(self, fetch, parse, fetch_workers=4, parse_workers=None, max_pending=32):
+        self.fetch = fetch
+        self.parse = parse
+        self.fetch_workers = fetch_workers
+        self.parse_workers = parse_workers or os.cpu_count()
+        self.max_pending = max_pending
+
+    def _fetch_loop(self, items, lock, pages, stop):
+        while not stop.is_set():
+            with lock:
+                item = next(items, _DONE)
+            if item is _DONE:
+                break
+            try:
+                content, meta = self.fetch(item)
+            except Exception as e:
+                logging.error(f"Fetching {item} failed: {e}")
+                continue
+            # Blocks while the queue is full, which is what holds the fetchers back
+            self._put(pages, (item, content, meta), stop)
+        self._put(pages, _DONE, stop)
+
+    @staticmethod
+    def _put(pages, entry, stop):
+        # Give up once the consumer has gone away, so no fetch thread waits forever
+        while not stop.is_set():
+            try:
+                pages.put(entry, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def run(self, items):
+        items = iter(items)
+        lock = threading.Lock()
+        stop = threading.Event()
+        pages = queue.Queue(maxsize=self.max_pending)
+        fetchers = [threading.Thread(target=self._fetch_loop, args=(items, lock, pages, stop), daemon=True)
+                    for _ in range(self.fetch_workers)]
+        for thread in fetchers:
+            thread.start()
+
+        parsing = {}
+        finished_fetchers = 0
+        try:
+            with ProcessPoolExecutor(max_workers=self.parse_workers) as executor:
+                while finished_fetchers < len(fetchers) or parsing:
+                    # Only take new pages while there is room among the pages being parsed
+                    while finished_fetchers < len(fetchers) and len(parsing) < self.max_pending:
+                        try:
+                            entry = pages.get(timeout=0.05 if parsing else None)
+                        except queue.Empty:
+                            break
+                        if entry is _DONE:
+                            finished_fetchers += 1
+                            continue
+                        item, content, meta = entry
+                        if content is None:
+                            yield item, meta, None
+                            continue
+                        parsing[executor.submit(self.parse, content)] = (item, meta)
+
+                    if not parsing:
+                        continue
+                    done, _ = wait(list(parsing), timeout=0.05, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        item, meta = parsing.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            logging.error(f"Parsing {item} failed: {e}")
+                            result = None
+                        yield item, meta, result
+        finally:
+            stop.set()
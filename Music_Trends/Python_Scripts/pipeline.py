@@ -0,0 +1,305 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+
+from metrics import get_metrics, write_metrics
+
+# Fingerprints of the last successful run of every stage, kept in the work directory
+STATE_FILE = '.pipeline_state.json'
+
+
+class Stage:
+    """One step of the pipeline
+
+    `run(params)` reads the `inputs` files and writes the `outputs` files. A stage
+    only starts once every stage named in `deps` has finished, and is skipped
+    when its inputs and `params` are unchanged since its last successful run.
+    `complete()`, when given, must also return True for the stage to be
+    skipped; it catches outputs that exist but are missing data.
+    """
+
+    def __init__(self, name, run, inputs=(), outputs=(), deps=(), params=None, complete=None):
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.params = params or {}
+        self.complete = complete
+
+
+def file_digest(path):
+    """SHA-256 of a file, or of every file under a directory"""
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        for root, _, files in sorted(os.walk(path)):
+            for name in sorted(files):
+                digest.update(name.encode('utf-8'))
+                digest.update(file_digest(os.path.join(root, name)).encode('ascii'))
+    else:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+def fingerprint(stage):
+    """Hash of the stage's parameters and the content of its inputs"""
+    payload = {
+        'stage': stage.name,
+        'params': stage.params,
+        'inputs': {path: file_digest(path) for path in stage.inputs},
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class Pipeline:
+    """Runs stages as a dependency graph; independent stages run in parallel"""
+
+    def __init__(self, stages, workdir, max_parallel=2):
+        self.stages = {stage.name: stage for stage in stages}
+        self.workdir = workdir
+        self.max_parallel = max_parallel
+        self.state_path = os.path.join(workdir, STATE_FILE)
+
+    def _load_state(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                return json.load(f)
+        return {}
+
+    def _save_state(self, state):
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def _up_to_date(self, stage, digest, state):
+        if state.get(stage.name) != digest or not all(os.path.exists(path) for path in stage.outputs):
+            return False
+        return stage.complete is None or stage.complete()
+
+    def run(self, force=()):
+        """Run every stage that is out of date; `force` names stages to rerun regardless"""
+        state = self._load_state()
+        done, failed, running = set(), set(), {}
+        force = set(self.stages) if 'all' in force else set(force)
+
+        with ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+            while len(done) + len(failed) < len(self.stages):
+                settled = len(done) + len(failed)
+                for stage in self.stages.values():
+                    if stage.name in done or stage.name in failed or stage.name in running.values():
+                        continue
+                    if any(dep in failed for dep in stage.deps):
+                        print(f"[{stage.name}] not run: an upstream stage failed")
+                        failed.add(stage.name)
+                        continue
+                    if not all(dep in done for dep in stage.deps):
+                        continue
+
+                    digest = fingerprint(stage)
+                    if stage.name not in force and self._up_to_date(stage, digest, state):
+                        print(f"[{stage.name}] up to date, skipped")
+                        done.add(stage.name)
+                        continue
+
+                    print(f"[{stage.name}] running")
+                    future = executor.submit(self._run_stage, stage)
+                    future.digest = digest
+                    running[future] = stage.name
+
+                if not running:
+                    if len(done) + len(failed) == settled:
+                        raise RuntimeError("Pipeline stages depend on each other in a cycle or on unknown stages")
+                    continue
+
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        elapsed = future.result()
+                    except Exception as e:
+                        logging.exception(f"Stage {name} failed")
+                        print(f"[{name}] failed: {e}")
+                        failed.add(name)
+                        continue
+                    print(f"[{name}] finished in {elapsed:.1f}s")
+                    get_metrics().gauge('stage_seconds', round(elapsed, 3), stage=name)
+                    state[name] = future.digest
+                    self._save_state(state)
+                    done.add(name)
+
+        write_metrics(os.path.join(self.workdir, 'metrics'))
+        if failed:
+            raise RuntimeError(f"Pipeline stages failed: {', '.join(sorted(failed))}")
+
+    @staticmethod
+    def _run_stage(stage):
+        started = time.monotonic()
+        stage.run(stage.params)
+        return time.monotonic() - started
+
+
+def build_stages(workdir, start_date, end_date, workers=4, rate=2.0):
+    """billboard -> dedup -> lyrics -> (spotify, itunes)"""
+    def path(name):
+        return os.path.join(workdir, name)
+
+    # Stage modules are imported when their stage runs, so skipped stages cost nothing
+    # scrape_billboard_data raises when weeks are missing, so a crawl with gaps never counts as done
+    def run_billboard(params):
+        from billboard_data_scrape import scrape_billboard_data
+        scrape_billboard_data(datetime.strptime(params['start'], '%Y-%m-%d'),
+                              datetime.strptime(params['end'], '%Y-%m-%d'),
+                              path('billboard_hot_100.xlsx'), path('billboard_weeks'), params['workers'], params['rate'])
+
+    def billboard_complete():
+        # Every week of the range has to be in the week store, e.g. after weeks were deleted by hand
+        from billboard_data_scrape import stored_weeks, weekly_dates
+        expected = weekly_dates(datetime.strptime(start_date, '%Y-%m-%d'), datetime.strptime(end_date, '%Y-%m-%d'))
+        return set(expected) <= stored_weeks(path('billboard_weeks'))
+
+    def run_dedup(params):
+        from storage import load_frame, save_frame
+        from planner import song_keys
+        chart = load_frame(path('billboard_hot_100.xlsx'))
+        songs = chart[['Title', 'Artist']].rename(columns={'Title': 'Song'})
+        songs = songs[~song_keys(songs, 'Song', 'Artist').duplicated()].reset_index(drop=True)
+        save_frame(songs, path('unique_songs.xlsx'))
+        print(f"{len(songs)} unique songs out of {len(chart)} chart rows")
+
+    def run_lyrics(params):
+        from genuisLyrics import fetch_all_lyrics
+        fetch_all_lyrics(path('unique_songs.xlsx'), path('unique_songs_lyrics.xlsx'), params['workers'], params['rate'])
+
+    def run_spotify(params):
+        import pandas as pd
+        from metadataSpotifyGathering import enrich_file, new_excel_path
+        from storage import save_frame
+        # save_to_new_excel appends, so a rerun starts from an empty _new file
+        if os.path.exists(new_excel_path(path('unique_songs_lyrics.xlsx'))):
+            os.remove(new_excel_path(path('unique_songs_lyrics.xlsx')))
+        new_file = enrich_file(path('unique_songs_lyrics.xlsx'), batched=True)
+        fetched = pd.read_excel(new_file) if os.path.exists(new_file) else pd.DataFrame()
+        save_frame(fetched, path('spotify_metadata.xlsx'))
+
+    def run_itunes(params):
+        from metadataItunesGathering import fetch_itunes_metadata
+        fetch_itunes_metadata(path('unique_songs_lyrics.xlsx'), path('itunes_metadata.xlsx'), 'Song', 'Artist', params['workers'])
+
+    return [
+        Stage('billboard', run_billboard, outputs=[path('billboard_hot_100.parquet')],
+              params={'start': start_date, 'end': end_date, 'workers': workers, 'rate': rate},
+              complete=billboard_complete),
+        Stage('dedup', run_dedup, inputs=[path('billboard_hot_100.parquet')],
+              outputs=[path('unique_songs.parquet')], deps=['billboard']),
+        Stage('lyrics', run_lyrics, inputs=[path('unique_songs.parquet')],
+              outputs=[path('unique_songs_lyrics.parquet')], deps=['dedup'],
+              params={'workers': workers, 'rate': rate}),
+        Stage('spotify', run_spotify, inputs=[path('unique_songs_lyrics.parquet')],
+              outputs=[path('spotify_metadata.parquet')], deps=['lyrics']),
+        Stage('itunes', run_itunes, inputs=[path('unique_songs_lyrics.parquet')],
+              outputs=[path('itunes_metadata.parquet')], deps=['lyrics'], params={'workers': workers}),
+    ]
+
+def build_update_stages(workdir, through, workers=4, rate=2.0):
+    """Weekly update: missing chart weeks -> their new songs -> lyrics -> (spotify, itunes) -> merge
+
+    Only songs charting for the first time go through enrichment; the merge
+    stage adds them to the datasets the full pipeline builds.
+    """
+    def path(name):
+        return os.path.join(workdir, name)
+
+    def run_billboard_update(params):
+        from billboard_data_scrape import update_billboard_data
+        from storage import save_frame
+        _, songs = update_billboard_data(path('billboard_hot_100.xlsx'), path('billboard_weeks'),
+                                         datetime.strptime(params['through'], '%Y-%m-%d'), params['workers'], params['rate'])
+        save_frame(songs, path('new_songs.xlsx'))
+
+    def run_lyrics_update(params):
+        from genuisLyrics import fetch_all_lyrics
+        fetch_all_lyrics(path('new_songs.xlsx'), path('new_songs_lyrics.xlsx'), params['workers'], params['rate'])
+
+    def run_spotify_update(params):
+        import pandas as pd
+        from metadataSpotifyGathering import enrich_file, new_excel_path
+        from storage import save_frame
+        if os.path.exists(new_excel_path(path('new_songs_lyrics.xlsx'))):
+            os.remove(new_excel_path(path('new_songs_lyrics.xlsx')))
+        new_file = enrich_file(path('new_songs_lyrics.xlsx'), batched=True)
+        fetched = pd.read_excel(new_file) if os.path.exists(new_file) else pd.DataFrame()
+        save_frame(fetched, path('new_spotify_metadata.xlsx'))
+
+    def run_itunes_update(params):
+        from metadataItunesGathering import fetch_itunes_metadata
+        fetch_itunes_metadata(path('new_songs_lyrics.xlsx'), path('new_itunes_metadata.xlsx'), 'Song', 'Artist', params['workers'])
+
+    def run_merge(params):
+        from storage import append_frame, load_frame
+        for new, full in (('new_songs.xlsx', 'unique_songs.xlsx'),
+                          ('new_songs_lyrics.xlsx', 'unique_songs_lyrics.xlsx'),
+                          ('new_spotify_metadata.xlsx', 'spotify_metadata.xlsx'),
+                          ('new_itunes_metadata.xlsx', 'itunes_metadata.xlsx')):
+            rows = load_frame(path(new))
+            if len(rows):
+                merged = append_frame(rows, path(full), subset=['Song', 'Artist'] if 'Song' in rows.columns else None)
+                print(f"Added {len(rows)} rows to {full} ({len(merged)} rows)")
+
+    new_outputs = [path('new_spotify_metadata.parquet'), path('new_itunes_metadata.parquet')]
+    return [
+        Stage('billboard_update', run_billboard_update, outputs=[path('new_songs.parquet')],
+              params={'through': through, 'workers': workers, 'rate': rate}),
+        Stage('lyrics_update', run_lyrics_update, inputs=[path('new_songs.parquet')],
+              outputs=[path('new_songs_lyrics.parquet')], deps=['billboard_update'],
+              params={'workers': workers, 'rate': rate}),
+        Stage('spotify_update', run_spotify_update, inputs=[path('new_songs_lyrics.parquet')],
+              outputs=[path('new_spotify_metadata.parquet')], deps=['lyrics_update']),
+        Stage('itunes_update', run_itunes_update, inputs=[path('new_songs_lyrics.parquet')],
+              outputs=[path('new_itunes_metadata.parquet')], deps=['lyrics_update'], params={'workers': workers}),
+        Stage('merge_update', run_merge, inputs=[path('new_songs_lyrics.parquet')] + new_outputs,
+              deps=['spotify_update', 'itunes_update']),
+    ]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run billboard -> dedup -> lyrics -> Spotify/iTunes, skipping unchanged stages")
+    parser.add_argument('--start', help="First chart week (YYYY-MM-DD)")
+    parser.add_argument('--end', help="Last chart week (YYYY-MM-DD)")
+    parser.add_argument('--update', action='store_true',
+                        help="Crawl every week missing since the first stored one (through --end or today), "
+                             "including weeks that failed before, and enrich only their new songs")
+    parser.add_argument('--workdir', default='pipeline_data', help="Directory for every stage's inputs and outputs")
+    parser.add_argument('--workers', type=int, default=4, help="Concurrent requests within the crawl and lyrics stages")
+    parser.add_argument('--rate', type=float, default=2.0, help="Requests per second per host")
+    parser.add_argument('--parallel', type=int, default=2, help="Stages allowed to run at the same time")
+    parser.add_argument('--force', nargs='*', default=[], help="Stages to rerun even if up to date ('all' for every stage)")
+    args = parser.parse_args()
+
+    if args.update:
+        args.end = args.end or datetime.now().strftime('%Y-%m-%d')
+    elif not (args.start and args.end):
+        parser.error("--start and --end are required unless --update is given")
+
+    for date_str in (args.start, args.end):
+        if date_str is None:
+            continue
+        try:
+            datetime.strptime(date_str, '%Y-%m-%d')
+        except ValueError:
+            print("Error: Invalid date format. Please use YYYY-MM-DD.")
+            exit(1)
+
+    os.makedirs(args.workdir, exist_ok=True)
+    # The stage scripts only set up their own log files when run directly
+    logging.basicConfig(filename=os.path.join(args.workdir, 'pipeline.log'), level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.update:
+        stages = build_update_stages(args.workdir, args.end, args.workers, args.rate)
+    else:
+        stages = build_stages(args.workdir, args.start, args.end, args.workers, args.rate)
+    Pipeline(stages, args.workdir, args.parallel).run(force=args.force)
@@ -0,0 +1,134 @@
+import pandas as pd
+
+from song_matching import canonical_keys
+
+# Strings that stand for an empty cell once a column has been through astype(str) or Excel.
+# 'None' is deliberately not here: the lyrics scripts store it for "searched, nothing found",
+# and store '' for a request that failed, so only that one is retried.
+EMPTY_MARKERS = ['', 'nan', 'NaN', '<NA>']
+
+METADATA_COLUMNS = ['Track Popularity', 'Track Explicit', 'Album', 'Album Release Date',
+                    'Artist Popularity', 'Artist Genres', 'Track ID', 'Total Tracks in Album']
+
+# Filled in by metadataItunesGathering.py; the track id lets later runs use the lookup endpoint
+ITUNES_COLUMNS = ['Album', 'Genre', 'Release Date', 'iTunes URL', 'iTunes Track ID']
+
+
+def missing_mask(series):
+    """Boolean mask of the cells in `series` that are NaN/None or one of the empty markers"""
+    mask = series.isna()
+    if series.dtype == object or pd.api.types.is_string_dtype(series):
+        mask |= series.isin(EMPTY_MARKERS)
+    return mask
+
+def song_keys(df, title_column, artist_column=None):
+    """Canonical title+artist key per row, used to send each song to the fetchers only once"""
+    artists = df[artist_column] if artist_column is not None and artist_column in df.columns else None
+    keys = canonical_keys(df[title_column], artists)
+    keys.index = df.index
+    return keys
+
+
+class WorkPlan:
+    """Rows that still need work, with rows for the same song collapsed onto one representative
+
+    `rows` is what gets handed to the fetchers; `representative` maps every
+    needed row to the row whose result it should copy.
+    """
+
+    def __init__(self, needed, keys):
+        # `keys` only has to cover the needed rows
+        needed_keys = keys[needed[needed].index]
+        first = ~needed_keys.duplicated()
+        self.rows = needed_keys.index[first]
+        self.total = int(needed.sum())
+
+        rep_by_key = pd.Series(self.rows, index=needed_keys[first].to_numpy())
+        self.representative = pd.Series(rep_by_key.reindex(needed_keys.to_numpy()).to_numpy(),
+                                         index=needed_keys.index)
+
+        self._groups = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def group(self, index):
+        """All needed rows that share the representative row `index`, itself included"""
+        if self._groups is None:
+            self._groups = self.representative.groupby(self.representative.to_numpy()).groups
+        return list(self._groups.get(index, [index]))
+
+    def propagate(self, df, columns):
+        """Copy the fetched values from each representative row onto its duplicates"""
+        duplicates = self.representative[self.representative.index != self.representative.to_numpy()]
+        if len(duplicates):
+            df.loc[duplicates.index, columns] = df.loc[duplicates.to_numpy(), columns].to_numpy()
+        return df
+
+
+def new_songs(recent, known, title_column='Title', artist_column='Artist'):
+    """One row per song in `recent` whose canonical key never appears in `known`
+
+    Used by the weekly update so only songs that just entered the chart are
+    sent on to lyrics and metadata enrichment.
+    """
+    known_keys = set(song_keys(known, title_column, artist_column)) if len(known) else set()
+    keys = song_keys(recent, title_column, artist_column)
+    fresh = ~keys.isin(known_keys) & ~keys.duplicated()
+    return recent[fresh.to_numpy()].reset_index(drop=True)
+
+def fill_from_matches(df, columns, title_column='Song', artist_column='Artist'):
+    """Fill empty cells from another row of the same song that already has a value
+
+    This lets a resumed run reuse results fetched for a differently spelled duplicate.
+    Keys are only built for the rows that need filling and the rows that could
+    donate a value; rows without a title take part in neither.
+    """
+    missing = {column: missing_mask(df[column]) for column in columns}
+    missing = {column: mask for column, mask in missing.items() if mask.any()}
+    if not missing:
+        return df
+
+    titled = ~missing_mask(df[title_column])
+    needed = pd.Series(False, index=df.index)
+    has_value = pd.Series(False, index=df.index)
+    for mask in missing.values():
+        needed |= mask
+        has_value |= ~mask
+    needed &= titled
+    has_value &= titled
+    if not needed.any() or not has_value.any():
+        return df
+
+    rows = needed | has_value
+    keys = song_keys(df[rows], title_column, artist_column)
+    for column, mask in missing.items():
+        values = df.loc[rows, column].where(~mask[rows])
+        filled = values.groupby(keys.to_numpy()).transform('first')
+        take = values.isna() & filled.notna()
+        if take.any():
+            df.loc[take[take].index, column] = filled[take]
+    return df
+
+def plan_lyrics_work(df, title_column='Song', artist_column='Artist'):
+    """Rows still missing a Lyrics_URL, or missing Lyrics while their URL could still be scraped"""
+    url_missing = missing_mask(df['Lyrics_URL'])
+    lyrics_missing = missing_mask(df['Lyrics'])
+    # A URL of 'None' means the search found nothing, so there is nothing left to scrape
+    needed = url_missing | (lyrics_missing & (df['Lyrics_URL'] != 'None'))
+    # Keys are only built for the rows that need work, which is cheap on a mostly complete dataset
+    return WorkPlan(needed, song_keys(df[needed], title_column, artist_column))
+
+def plan_metadata_work(df, title_column='Title', artist_column='Artist'):
+    """Rows with at least one empty Spotify metadata column"""
+    needed = pd.Series(False, index=df.index)
+    for column in METADATA_COLUMNS:
+        needed |= missing_mask(df[column]) if column in df.columns else True
+    return WorkPlan(needed, song_keys(df[needed], title_column, artist_column))
+
+def plan_itunes_work(df, title_column='Song', artist_column='Artist'):
+    """Rows without iTunes metadata; 'N/A' means the search found nothing and is not retried"""
+    needed = pd.Series(False, index=df.index)
+    for column in ITUNES_COLUMNS[:-1]:
+        needed |= missing_mask(df[column]) if column in df.columns else True
+    return WorkPlan(needed, song_keys(df[needed], title_column, artist_column))
@@ -0,0 +1,395 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from planner import song_keys
+from storage import export_excel, load_frame, save_frame
+
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lyrics_rank_weeks_model.h5')
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Unique_Songs_Lyrics_Spotify.xlsx')
+
+# Numeric inputs chart_features() can look up from the chart history when the model asks
+# for them by these names: the best rank a song reached and its total weeks on the chart
+CHART_FEATURE_COLUMNS = ['peak_rank', 'weeks_on_board']
+
+# Prefix of the scored catalog's columns, one per model output head
+PREDICTION_PREFIX = 'predicted_'
+
+# Same defaults as keras.preprocessing.text.Tokenizer, which the model was trained with
+KERAS_FILTERS = '!"#$%&()*+,-./:;<=>?@[\\]^_`{|}~\t\n'
+
+
+class LyricsTokenizer:
+    """Keras-compatible word tokenizer that turns a whole batch of lyrics into one padded matrix
+
+    The word index has to be the one the model was trained with, read from the
+    saved Keras tokenizer (tokenizer.to_json()). A word index fitted on other
+    lyrics gives the same words different ids, and the scores mean nothing.
+    """
+
+    def __init__(self, word_index, num_words=None, maxlen=None):
+        self.word_index = word_index
+        self.num_words = num_words
+        # Padding length used in training, if it was saved with the tokenizer
+        self.maxlen = maxlen
+        self.table = str.maketrans(KERAS_FILTERS, ' ' * len(KERAS_FILTERS))
+
+    @classmethod
+    def from_json(cls, path):
+        with open(path) as f:
+            config = json.load(f)['config']
+        word_index = config['word_index']
+        if isinstance(word_index, str):
+            word_index = json.loads(word_index)
+        return cls(word_index, config.get('num_words'), config.get('maxlen'))
+
+    def _split(self, texts):
+        texts = pd.Series(texts, dtype=object).fillna('').astype(str)
+        return texts.str.lower().str.translate(self.table).str.split()
+
+    def to_matrix(self, texts, maxlen):
+        """Token ids padded and truncated at the front to `maxlen`, like pad_sequences' defaults"""
+        tokens = self._split(texts)
+        lengths = tokens.str.len().to_numpy()
+        rows = np.repeat(np.arange(len(tokens)), lengths)
+        ids = pd.Series(list(itertools.chain.from_iterable(tokens)), dtype=object).map(self.word_index)
+        ids = ids.to_numpy(dtype=np.float64, na_value=np.nan)
+
+        # Unknown words, and words outside num_words, are dropped as texts_to_sequences does
+        keep = ~np.isnan(ids)
+        if self.num_words:
+            keep &= ids < self.num_words
+        rows, ids = rows[keep], ids[keep].astype(np.int32)
+
+        # Position of each token counted from the end of its song; the last maxlen are kept
+        counts = np.bincount(rows, minlength=len(tokens))
+        ends = np.cumsum(counts)
+        from_end = ends[rows] - np.arange(len(rows)) - 1
+        keep = from_end < maxlen
+
+        matrix = np.zeros((len(tokens), maxlen), dtype=np.int32)
+        matrix[rows[keep], maxlen - 1 - from_end[keep]] = ids[keep]
+        return matrix
+
+
+def _tensor_names(tensors, names=None):
+    # Keras 2 lists the names on the model; otherwise they come from the tensors ("lyrics:0" -> "lyrics")
+    if names:
+        return list(names)
+    return [tensor.name.split(':')[0].split('/')[0] for tensor in tensors]
+
+def _width(shape):
+    # (batch,) and (batch, 1) inputs both take one value per song; None is a variable sequence length
+    return shape[-1] if len(shape) > 1 else 1
+
+
+class RankModel:
+    """The lyrics RNN, loaded on first use and kept in memory for every later batch
+
+    Inputs and outputs come from the saved model itself. The input with a
+    sequence length takes the tokenized lyrics. Any other input takes numeric
+    features, named after it (`feature_columns`). A model trained on lyrics
+    alone needs nothing else. Every output head is returned under its own name.
+
+    A model that takes lyrics of any length does not say how long they were
+    in training; that length has to come from `maxlen` or the tokenizer.
+    """
+
+    def __init__(self, path=MODEL_PATH, tokenizer=None, threads=None, maxlen=None):
+        self.path = path
+        self.tokenizer = tokenizer
+        self.threads = threads
+        self.requested_maxlen = maxlen
+        self.model = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self.model is not None:
+                return self.model
+            # TensorFlow takes seconds to import, so it is only loaded when a score is needed
+            import tensorflow as tf
+            if self.threads:
+                tf.config.threading.set_intra_op_parallelism_threads(self.threads)
+                tf.config.threading.set_inter_op_parallelism_threads(self.threads)
+            started = time.monotonic()
+            model = tf.keras.models.load_model(self.path, compile=False)
+            self._read_signature(model)
+            self.model = model
+            # One tiny prediction so the first real request does not pay for graph tracing
+            self._predict(np.zeros((1, self.maxlen), dtype=np.int32), np.zeros((1, len(self.feature_columns)), dtype=np.float32))
+            logging.info(f"Loaded {self.path} in {time.monotonic() - started:.1f}s (maxlen {self.maxlen}, "
+                         f"features {self.feature_columns or 'none'}, outputs {self.output_names})")
+            return model
+
+    def _read_signature(self, model):
+        names = _tensor_names(model.inputs, getattr(model, 'input_names', None))
+        widths = [_width(tuple(tensor.shape)) for tensor in model.inputs]
+        # The lyrics input is the one with a sequence length, fixed or variable
+        variable = [i for i, width in enumerate(widths) if width is None]
+        self.text_input = variable[0] if variable else max(range(len(widths)), key=lambda i: widths[i])
+        self.maxlen = widths[self.text_input] or self._padding_length()
+        # (position, name, width) of every other input, in the model's order
+        self.feature_inputs = [(i, names[i], widths[i]) for i in range(len(widths)) if i != self.text_input]
+        self.feature_columns = []
+        for _, name, width in self.feature_inputs:
+            self.feature_columns += [name] if width == 1 else [f"{name}_{k}" for k in range(width)]
+        self.output_names = _tensor_names(model.outputs, getattr(model, 'output_names', None))
+
+    def _padding_length(self):
+        # A variable-length lyrics input: padding to any other length than in training changes the scores
+        maxlen = self.requested_maxlen or getattr(self.tokenizer, 'maxlen', None)
+        if not maxlen:
+            raise ValueError(f"{self.path} takes lyrics of any length; pass the padding length used in "
+                             "training (--maxlen) or save it as maxlen in the tokenizer JSON config")
+        return int(maxlen)
+
+    def _predict(self, sequences, features):
+        """{output name: predictions}; one value per song, or a row per song for a wider head"""
+        inputs = [None] * (len(self.feature_inputs) + 1)
+        inputs[self.text_input] = sequences
+        start = 0
+        for position, _, width in self.feature_inputs:
+            inputs[position] = features[:, start:start + width]
+            start += width
+        outputs = self.model.predict_on_batch(inputs if len(inputs) > 1 else inputs[0])
+
+        if isinstance(outputs, dict):
+            heads = outputs.items()
+        else:
+            heads = zip(self.output_names, outputs if isinstance(outputs, (list, tuple)) else [outputs])
+        predictions = {}
+        for name, values in heads:
+            values = np.asarray(values).reshape(len(sequences), -1)
+            predictions[name] = values[:, 0] if values.shape[1] == 1 else values
+        return predictions
+
+    def score(self, lyrics, features=None):
+        """{output name: predictions} for each lyrics text and its row of `feature_columns` values"""
+        self._load()
+        if self.tokenizer is None:
+            raise ValueError("No tokenizer: pass the Keras tokenizer JSON saved when the model was trained")
+        sequences = self.tokenizer.to_matrix(lyrics, self.maxlen)
+        if features is None:
+            features = np.zeros((len(sequences), 0))
+        return self._predict(sequences, np.asarray(features, dtype=np.float32).reshape(len(sequences), len(self.feature_columns)))
+
+
+class LatencyStats:
+    """Throughput and latency percentiles over everything recorded so far"""
+
+    def __init__(self):
+        self.samples = []
+        self.items = 0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, seconds, items=1):
+        with self._lock:
+            self.samples.append(seconds)
+            self.items += items
+
+    def summary(self):
+        with self._lock:
+            samples = np.array(self.samples)
+            elapsed = time.monotonic() - self.started
+        if not len(samples):
+            return {'songs': 0, 'songs_per_second': 0.0, 'p50_ms': None, 'p99_ms': None}
+        return {
+            'songs': self.items,
+            'songs_per_second': round(self.items / elapsed, 1),
+            'p50_ms': round(float(np.percentile(samples, 50)) * 1000, 2),
+            'p99_ms': round(float(np.percentile(samples, 99)) * 1000, 2),
+        }
+
+
+def chart_features(df, charts_path, title_column='Song', artist_column='Artist'):
+    """Peak rank and weeks on board for each catalog row, matched to the chart history by song key"""
+    from chart_stream import aggregate_charts
+    songs = aggregate_charts(charts_path).to_frame()
+    songs['key'] = song_keys(songs, 'song', 'artist').to_numpy()
+    by_key = songs.groupby('key').agg(peak_rank=('peak_rank', 'min'), weeks_on_board=('weeks_on_board', 'sum'))
+    return by_key.reindex(song_keys(df, title_column, artist_column).to_numpy()).set_axis(df.index)
+
+def catalog_features(df, columns, charts_path=None, title_column='Song', artist_column='Artist'):
+    """The model's numeric inputs for every catalog row: catalog columns, or chart history lookups"""
+    if all(column in df.columns for column in columns):
+        return df[columns]
+    if charts_path and set(columns) <= set(CHART_FEATURE_COLUMNS):
+        return chart_features(df, charts_path, title_column, artist_column)[columns]
+    missing = [column for column in columns if column not in df.columns]
+    hint = "; pass the chart history to look them up" if set(missing) <= set(CHART_FEATURE_COLUMNS) else ""
+    raise ValueError(f"The model also takes {columns}, but the catalog has no {missing} columns{hint}")
+
+def score_catalog(catalog_path, model, charts_path=None, batch_size=256, title_column='Song', artist_column='Artist'):
+    """Score every catalog row that has lyrics; adds a predicted_<output> column per model output"""
+    df = load_frame(catalog_path)
+    model._load()
+    features = catalog_features(df, model.feature_columns, charts_path, title_column, artist_column)
+
+    lyrics = df['Lyrics'].astype(object)
+    scorable = lyrics.notna() & ~lyrics.isin(['', 'None', 'nan']) & features.notna().all(axis=1)
+
+    rows = df.index[scorable]
+    predictions = {}
+    stats = LatencyStats()
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        started = time.monotonic()
+        positions = df.index.get_indexer(batch)
+        for name, values in model.score(lyrics[batch].tolist(), features.loc[batch].to_numpy()).items():
+            if name not in predictions:
+                predictions[name] = np.full((len(df),) + values.shape[1:], np.nan)
+            predictions[name][positions] = values
+        stats.record(time.monotonic() - started, len(batch))
+
+    for name, values in predictions.items():
+        if values.ndim == 1:
+            df[PREDICTION_PREFIX + name] = values
+        else:
+            for k in range(values.shape[1]):
+                df[f"{PREDICTION_PREFIX}{name}_{k}"] = values[:, k]
+    summary = stats.summary()
+    print(f"Scored {summary['songs']} of {len(df)} songs at {summary['songs_per_second']} songs/s "
+          f"(batch of {batch_size}: p50 {summary['p50_ms']} ms, p99 {summary['p99_ms']} ms)")
+    return df
+
+
+class MicroBatcher:
+    """Collects single-song requests for up to `max_wait` seconds and scores them as one batch"""
+
+    def __init__(self, model, max_batch=32, max_wait=0.01):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.stats = LatencyStats()
+        self.requests = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, lyrics, features):
+        future = Future()
+        self.requests.put((lyrics, features, future, time.monotonic()))
+        return future
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                predictions = self.model.score([r[0] for r in batch], [r[1] for r in batch])
+            except Exception as e:
+                logging.exception("Scoring batch failed")
+                for _, _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            finished = time.monotonic()
+            for i, (_, _, future, submitted) in enumerate(batch):
+                self.stats.record(finished - submitted)
+                future.set_result({name: values[i].tolist() for name, values in predictions.items()})
+
+
+def make_handler(batcher):
+    feature_columns = batcher.model.feature_columns
+
+    class ScoreHandler(BaseHTTPRequestHandler):
+        """POST /score {"lyrics": ..., plus a value for each of the model's feature_columns}; GET /stats
+
+        The reply holds every model output: {"predictions": {"<output name>": value, ...}}.
+        """
+
+        def _reply(self, status, body):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, batcher.stats.summary())
+            else:
+                self._reply(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/score':
+                return self._reply(404, {'error': 'not found'})
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                features = [float(request[column]) for column in feature_columns]
+                predictions = batcher.submit(request['lyrics'], features).result(timeout=30)
+            except (KeyError, ValueError, TypeError) as e:
+                return self._reply(400, {'error': f"bad request: {e}"})
+            except Exception as e:
+                return self._reply(500, {'error': str(e)})
+            self._reply(200, {'predictions': predictions})
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return ScoreHandler
+
+def serve(model, host='127.0.0.1', port=8765, max_batch=32, max_wait=0.01):
+    model._load()
+    batcher = MicroBatcher(model, max_batch, max_wait)
+    server = ThreadingHTTPServer((host, port), make_handler(batcher))
+    print(f"Scoring on http://{host}:{port}/score (micro-batches of up to {max_batch}, {max_wait * 1000:.0f} ms wait); "
+          f"requests need lyrics{''.join(', ' + column for column in model.feature_columns)}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Served: {batcher.stats.summary()}")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Score lyrics with lyrics_rank_weeks_model.h5")
+    parser.add_argument('mode', choices=['score', 'serve'], help="Score the whole catalog, or answer single-song requests over HTTP")
+    parser.add_argument('--model', default=MODEL_PATH, help="Saved Keras model")
+    parser.add_argument('--tokenizer', required=True,
+                        help="Keras tokenizer JSON saved when the model was trained; the token ids have to match training")
+    parser.add_argument('--maxlen', type=int,
+                        help="Padding length used in training; required when the model takes lyrics of any length "
+                             "and the tokenizer JSON does not record it")
+    parser.add_argument('--catalog', default=CATALOG_PATH, help="Songs with lyrics to score")
+    parser.add_argument('--charts', help="Chart history (charts.csv or a Parquet dataset) for a model that also takes peak_rank and weeks_on_board")
+    parser.add_argument('--output', help="Where to write the scored catalog (default: <catalog>_scored.xlsx)")
+    parser.add_argument('--batch-size', type=int, default=256, help="Songs per model call when scoring the catalog")
+    parser.add_argument('--threads', type=int, help="CPU threads TensorFlow may use")
+    parser.add_argument('--port', type=int, default=8765, help="Port for serve mode")
+    parser.add_argument('--max-batch', type=int, default=32, help="Largest micro-batch in serve mode")
+    parser.add_argument('--max-wait-ms', type=float, default=10, help="How long serve mode waits to fill a micro-batch")
+    args = parser.parse_args()
+
+    model = RankModel(args.model, LyricsTokenizer.from_json(args.tokenizer), args.threads, args.maxlen)
+    if args.mode == 'score':
+        scored = score_catalog(args.catalog, model, args.charts, args.batch_size)
+        output = args.output or os.path.splitext(args.catalog)[0] + '_scored.xlsx'
+        save_frame(scored, output)
+        export_excel(scored, output)
+    else:
+        serve(model, port=args.port, max_batch=args.max_batch, max_wait=args.max_wait_ms / 1000)
@@ -0,0 +1,197 @@
+import heapq
+import re
+import sys
+import unicodedata
+from collections import Counter
+from operator import itemgetter
+
+import pandas as pd
+
+# Parenthetical or bracketed suffixes such as (From "Back To The Future Part III"), [Remix], (feat. X)
+BRACKETS = re.compile(r'\s*[\(\[][^\)\]]*[\)\]]')
+# Trailing " - Remastered 2011" style versions
+DASH_SUFFIX = re.compile(r'\s+-\s+.*$')
+# Featured artists credited without brackets: "Song Feat. X", "Artist Featuring Y". A bare
+# "with" or "x" is left alone, it is part of titles like "Dancing With Myself" or "Me x You"
+FEATURING = re.compile(r'\s+(?:featuring|feat\.?|ft\.?)\s+.*$')
+# Co-credits between the main artists; every one of them is kept in the key
+ARTIST_SEPARATORS = re.compile(r'\s*(?:,|&|\+|/|\band\b|\s(?:x|with|vs\.?)\s)\s*')
+NON_WORD = re.compile(r'[^\w\s]')
+SPACES = re.compile(r'\s+')
+
+
+def _fold(text):
+    # Lower case without accents, so "Beyoncé" and "Beyonce" agree
+    text = unicodedata.normalize('NFKD', str(text)).encode('ascii', 'ignore').decode('ascii')
+    return text.lower().replace('’', "'").strip()
+
+def _clean(text):
+    return SPACES.sub(' ', NON_WORD.sub('', text)).strip()
+
+def normalize_title(title):
+    """Title without featuring credits, bracketed suffixes or punctuation"""
+    if title is None or (not isinstance(title, str) and pd.isna(title)):
+        return ''
+    text = _fold(title)
+    text = BRACKETS.sub('', text)
+    text = DASH_SUFFIX.sub('', text)
+    text = FEATURING.sub('', text)
+    return _clean(text.replace('&', ' and '))
+
+def _artist_name(text):
+    text = _clean(text)
+    return text[4:] if text.startswith('the ') else text
+
+def normalize_artist(artist):
+    """The credited artists, sorted and joined with ", "; featured artists are dropped
+
+    Co-credits are kept, so "Simon & Garfunkel" and "Garfunkel, Simon" agree
+    but neither collapses onto a solo song by one of them.
+    """
+    if artist is None or (not isinstance(artist, str) and pd.isna(artist)):
+        return ''
+    text = BRACKETS.sub('', _fold(artist))
+    text = FEATURING.sub('', text)
+    names = {_artist_name(name) for name in ARTIST_SEPARATORS.split(text)}
+    return ', '.join(sorted(name for name in names if name))
+
+def canonical_key(title, artist=None):
+    """Key under which Billboard, Genius, Spotify and iTunes spellings of a song agree"""
+    return f"{normalize_title(title)}|{normalize_artist(artist)}"
+
+def canonical_keys(titles, artists=None):
+    """canonical_key for whole columns; each distinct title/artist pair is only normalized once"""
+    titles = pd.Series(titles).reset_index(drop=True)
+    artists = pd.Series([None] * len(titles)) if artists is None else pd.Series(artists).reset_index(drop=True)
+    pairs = pd.DataFrame({'title': titles.astype(object), 'artist': artists.astype(object)})
+    unique = pairs.drop_duplicates()
+    keys = pd.Series([canonical_key(t, a) for t, a in zip(unique['title'], unique['artist'])], index=unique.index)
+    lookup = pd.MultiIndex.from_frame(unique.fillna('\0'))
+    positions = lookup.get_indexer(pd.MultiIndex.from_frame(pairs.fillna('\0')))
+    return pd.Series(keys.to_numpy()[positions])
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SongIndex:
+    """Local catalog of resolved songs with exact and fuzzy lookup
+
+    Exact matches go through a dict of canonical keys. Everything else is
+    fuzzy matched on normalized titles by character-trigram Jaccard similarity.
+    With an artist, only that artist's songs (found through an index of
+    credited artists) and songs without an artist are candidates; without
+    one, candidates come from a trigram inverted index over all titles.
+    """
+
+    def __init__(self):
+        self.keys = {}
+        self.titles = []
+        self.title_grams = []
+        self.artists = []
+        self.values = []
+        self.postings = {}
+        self.by_artist = {}
+        # Trigram postings of the songs without an artist, which match any artist
+        self.no_artist_postings = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, title, artist, value=None):
+        """Add a song and return its id; `value` is whatever the caller wants back (a row index, a URL...)"""
+        key = canonical_key(title, artist)
+        if key in self.keys:
+            return self.keys[key]
+
+        song_id = len(self.values)
+        self.keys[key] = song_id
+        norm_title = normalize_title(title)
+        norm_artist = normalize_artist(artist)
+        grams = trigrams(norm_title)
+        self.titles.append(norm_title)
+        self.title_grams.append(grams)
+        self.artists.append(norm_artist)
+        self.values.append(value)
+        for gram in grams:
+            self.postings.setdefault(gram, []).append(song_id)
+            if not norm_artist:
+                self.no_artist_postings.setdefault(gram, []).append(song_id)
+        if norm_artist:
+            for name in norm_artist.split(', '):
+                self.by_artist.setdefault(name, []).append(song_id)
+        return song_id
+
+    @classmethod
+    def from_frame(cls, df, title_column, artist_column, value_column=None):
+        index = cls()
+        values = df[value_column] if value_column else df.index
+        for title, artist, value in zip(df[title_column], df[artist_column], values):
+            index.add(title, artist, value)
+        return index
+
+    def lookup(self, title, artist=None, threshold=0.6, max_candidates=20):
+        """Return (song_id, score) for the best match, or None"""
+        exact = self.keys.get(canonical_key(title, artist))
+        if exact is not None:
+            return exact, 1.0
+
+        grams = trigrams(normalize_title(title))
+        # Jaccard similarity is at most shared / len(grams), so songs sharing fewer trigrams cannot match
+        min_shared = threshold * len(grams)
+        candidates = [(song_id, shared) for song_id, shared in self._candidates(grams, normalize_artist(artist))
+                      if shared >= min_shared]
+
+        # The artist gate is applied before this cut, so other artists' songs with a
+        # common title ("Love", "Stay") cannot crowd out the right one
+        best = None
+        for song_id, shared in heapq.nlargest(max_candidates, candidates, key=itemgetter(1)):
+            score = shared / (len(grams) + len(self.title_grams[song_id]) - shared)
+            if score >= threshold and (best is None or score > best[1]):
+                best = (song_id, score)
+        return best
+
+    def _candidates(self, grams, norm_artist):
+        # (song_id, shared trigrams) for every song the artist gate lets through
+        counts = Counter()
+        postings = self.no_artist_postings if norm_artist else self.postings
+        for gram in grams:
+            counts.update(postings.get(gram, ()))
+        if not norm_artist:
+            return counts.items()
+
+        # Sources differ in how many co-credits they list, so one shared artist is enough
+        songs = {song_id for name in norm_artist.split(', ') for song_id in self.by_artist.get(name, ())}
+        return [(song_id, len(grams & self.title_grams[song_id])) for song_id in songs] + list(counts.items())
+
+    def join(self, df, title_column, artist_column, threshold=0.6):
+        """Match every row of df against the catalog; returns a Series of song ids (NaN when unmatched)
+
+        Rows are joined on canonical keys first; only the distinct keys left over
+        go through the fuzzy index.
+        """
+        keys = canonical_keys(df[title_column], df[artist_column])
+        ids = keys.map(self.keys)
+
+        unmatched = keys[ids.isna()].drop_duplicates()
+        if len(unmatched):
+            sample = df.iloc[unmatched.index]
+            fuzzy = {}
+            for key, title, artist in zip(unmatched, sample[title_column], sample[artist_column]):
+                match = self.lookup(title, artist, threshold)
+                if match is not None:
+                    fuzzy[key] = match[0]
+            ids = ids.fillna(keys.map(fuzzy))
+
+        ids.index = df.index
+        return ids
+
+if __name__ == "__main__":
+    # Report how many songs of one file can be resolved locally against another
+    from storage import load_frame
+    catalog = load_frame(sys.argv[1])
+    queries = load_frame(sys.argv[2])
+    index = SongIndex.from_frame(catalog, 'Song', 'Artist')
+    matched = index.join(queries, 'Song', 'Artist')
+    print(f"{matched.notna().sum()} of {len(queries)} rows of {sys.argv[2]} match a song in {sys.argv[1]}")
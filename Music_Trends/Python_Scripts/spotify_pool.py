@@ -0,0 +1,129 @@
+import logging
+import os
+import re
+import threading
+import time
+
+import requests
+
+from throttle import SERVICE_RATES, classify_outcome, get_throttle
+
+# config.json holds one pair per Spotify app: client_id/client_secret, client_id_2/client_secret_2, ...
+CLIENT_ID_KEY = re.compile(r'^client_id(_\w+)?$')
+
+# How long a client sits out after a 429 that carries no Retry-After header
+DEFAULT_BENCH_SECONDS = 10
+
+# Access tokens are kept here between runs, one file per app, so a new process reuses a valid token
+TOKEN_CACHE_DIR = os.environ.get('MUSIC_TRENDS_TOKEN_CACHE', '.spotify_tokens')
+
+
+def load_credentials(config):
+    """Every (name, client_id, client_secret) in the config's spotify section"""
+    section = config['spotify']
+    credentials = []
+    for key in sorted(section, key=lambda k: (len(k), k)):
+        match = CLIENT_ID_KEY.match(key)
+        if not match:
+            continue
+        secret_key = 'client_secret' + (match.group(1) or '')
+        if section.get(key) and section.get(secret_key):
+            credentials.append((key, section[key], section[secret_key]))
+    if not credentials:
+        raise Exception("Spotify API credentials are missing in the config.json file.")
+    return credentials
+
+
+class PooledClient:
+    """One Spotify app: its client, its own adaptive throttle and when it may be used again"""
+
+    def __init__(self, name, client_id, client_secret, rate, requests_timeout=10, token_cache_dir=TOKEN_CACHE_DIR):
+        # spotipy is slow to import, so it is loaded when the first client is built
+        import spotipy
+        from spotipy.cache_handler import CacheFileHandler
+        from spotipy.oauth2 import SpotifyClientCredentials
+
+        self.name = name
+        os.makedirs(token_cache_dir, exist_ok=True)
+        credentials = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret,
+                                               cache_handler=CacheFileHandler(os.path.join(token_cache_dir, name)))
+        # A plain session keeps spotipy from sleeping through 429s itself, so the pool
+        # sees them (with Retry-After) and can move the request to another client
+        self.sp = spotipy.Spotify(client_credentials_manager=credentials,
+                                  requests_session=requests.Session(), requests_timeout=requests_timeout)
+        self.throttle = get_throttle(f'spotify {name}', rate)
+        self.benched_until = 0.0
+        self.benched = 0
+
+
+class SpotifyClientPool:
+    """Shards Spotify calls round-robin across every credential pair in config.json
+
+    Each client is paced by its own throttle, so the combined request rate grows
+    with the number of apps. A client that gets a 429 is benched for Retry-After
+    and the request is sent again on the next client; the pool only waits when
+    every client is benched.
+    """
+
+    def __init__(self, credentials, rate=None, requests_timeout=10):
+        rate = rate or SERVICE_RATES['spotify']
+        self.clients = [PooledClient(name, client_id, secret, rate, requests_timeout)
+                        for name, client_id, secret in credentials]
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, rate=None):
+        return cls(load_credentials(config), rate)
+
+    def __len__(self):
+        return len(self.clients)
+
+    def _next_client(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                for _ in range(len(self.clients)):
+                    client = self.clients[self._next]
+                    self._next = (self._next + 1) % len(self.clients)
+                    if client.benched_until <= now:
+                        return client
+                wait = min(client.benched_until for client in self.clients) - now
+            logging.warning(f"All {len(self.clients)} Spotify clients are benched; waiting {wait:.1f}s")
+            time.sleep(max(wait, 0))
+
+    def _bench(self, client, retry_after):
+        seconds = retry_after if retry_after is not None else DEFAULT_BENCH_SECONDS
+        with self._lock:
+            client.benched_until = max(client.benched_until, time.monotonic() + seconds)
+            client.benched += 1
+        print(f"Spotify client {client.name} rate limited; benched for {seconds:.1f} seconds")
+        logging.warning(f"Spotify client {client.name} rate limited; benched for {seconds:.1f} seconds")
+
+    def call(self, request, retries=3):
+        """Run `request(sp)` on the next free client
+
+        A 429 benches the client and moves the request to another one; server
+        errors and timeouts are retried up to `retries` times with backoff.
+        """
+        failures = 0
+        throttled = 0
+        while True:
+            client = self._next_client()
+            try:
+                return client.throttle.call(lambda: request(client.sp), retries=0)
+            except Exception as e:
+                outcome, retry_after = classify_outcome(error=e)
+                if outcome == 'throttled' and throttled < retries * len(self.clients):
+                    throttled += 1
+                    self._bench(client, retry_after)
+                    continue
+                if outcome == 'failed' and failures < retries:
+                    failures += 1
+                    time.sleep(client.throttle.backoff_delay(failures))
+                    continue
+                raise
+
+    def snapshot(self):
+        """Per-client rate, circuit state, counters and benchings"""
+        return [{**client.throttle.snapshot(), 'benched': client.benched} for client in self.clients]
@@ -0,0 +1,191 @@
+import logging
+import os
+import sys
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from metrics import get_metrics
+
+# Default location of the partitioned chart history
+CHARTS_DATASET = 'charts_parquet'
+
+# Explicit column types for charts.csv (Kaggle Billboard Hot 100 export)
+CHART_SCHEMA = pa.schema([
+    ('date', pa.date32()),
+    ('rank', pa.int8()),
+    ('song', pa.string()),
+    ('artist', pa.string()),
+    ('last-week', pa.int8()),
+    ('peak-rank', pa.int8()),
+    ('weeks-on-board', pa.int16()),
+])
+
+# Columns that are read back as pandas categoricals; they repeat every week a song charts
+CHART_DICTIONARY_COLUMNS = ['song', 'artist']
+
+# Types for the columns the scrapers add to the intermediate workbooks.
+# Anything not listed keeps whatever type pandas infers.
+FRAME_DTYPES = {
+    'Song': 'string',
+    'Title': 'string',
+    'Artist': 'string',
+    'Lyrics_URL': 'string',
+    'Lyrics': 'string',
+    'Track Popularity': 'Int16',
+    'Track Explicit': 'boolean',
+    'Album': 'string',
+    'Album Release Date': 'string',
+    'Artist Popularity': 'Int16',
+    'Artist Genres': 'string',
+    'Track ID': 'string',
+    'Total Tracks in Album': 'Int16',
+    'Rank': 'Int16',
+}
+
+
+def _with_year(batches):
+    # Add the partition column to every batch coming off the CSV reader
+    for batch in batches:
+        years = pc.year(batch.column('date')).cast(pa.int16())
+        yield pa.RecordBatch.from_arrays(batch.columns + [years], names=batch.schema.names + ['year'])
+
+def convert_charts_csv(csv_path='charts.csv', dataset_dir=CHARTS_DATASET):
+    """Stream charts.csv into a Parquet dataset partitioned by chart year
+
+    The CSV is read in blocks, so the conversion never holds the whole file in memory.
+    """
+    reader = pa_csv.open_csv(
+        csv_path,
+        read_options=pa_csv.ReadOptions(block_size=16 * 1024 * 1024),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={field.name: field.type for field in CHART_SCHEMA},
+            include_columns=CHART_SCHEMA.names,
+        ),
+    )
+    schema = CHART_SCHEMA.append(pa.field('year', pa.int16()))
+    ds.write_dataset(
+        _with_year(reader),
+        dataset_dir,
+        schema=schema,
+        format='parquet',
+        partitioning=ds.partitioning(pa.schema([('year', pa.int16())]), flavor='hive'),
+        existing_data_behavior='delete_matching',
+    )
+    logging.info(f"Converted {csv_path} to Parquet dataset {dataset_dir}")
+
+def read_charts(dataset_dir=CHARTS_DATASET, columns=None, filters=None):
+    """Load the chart history from Parquet
+
+    `columns` limits which columns are read and `filters` (pyarrow DNF filters,
+    e.g. [('year', '>=', 1990), ('rank', '<=', 10)]) are pushed down, so
+    partitions and row groups that cannot match are skipped without being read.
+    """
+    if not os.path.isdir(dataset_dir):
+        raise FileNotFoundError(f"{dataset_dir} not found; run 'python storage.py charts.csv' first")
+
+    read_dictionary = [c for c in CHART_DICTIONARY_COLUMNS if columns is None or c in columns]
+    table = pq.read_table(dataset_dir, columns=columns, filters=filters, read_dictionary=read_dictionary)
+    df = table.to_pandas(date_as_object=False)
+
+    # Keep the narrow integer types pandas would otherwise widen
+    if 'last-week' in df.columns:
+        df['last-week'] = df['last-week'].astype('Int8')  # Empty for a song's debut week
+    if 'year' in df.columns:
+        df['year'] = df['year'].astype('int16')  # Partition keys come back as categories
+    return df
+
+def read_chart_years(start_year, end_year, columns=None, dataset_dir=CHARTS_DATASET):
+    """Chart rows from start_year to end_year inclusive"""
+    return read_charts(dataset_dir, columns, filters=[('year', '>=', start_year), ('year', '<=', end_year)])
+
+def parquet_path(path):
+    """The Parquet file that stands in for an .xlsx/.csv path"""
+    return os.path.splitext(path)[0] + '.parquet'
+
+def apply_dtypes(df):
+    """Cast known columns to their explicit types"""
+    for column, dtype in FRAME_DTYPES.items():
+        if column in df.columns:
+            try:
+                df[column] = df[column].astype(dtype)
+            except (TypeError, ValueError) as e:
+                logging.warning(f"Keeping inferred type for column {column}: {e}")
+    return df
+
+def save_frame(df, path):
+    """Write a dataset as Parquet; `path` may name the old .xlsx file"""
+    target = parquet_path(path)
+    with get_metrics().phase('parquet_io'):
+        apply_dtypes(df.copy()).to_parquet(target, index=False)
+    return target
+
+def _parquet_is_current(path, target):
+    # The Parquet copy stands in for the workbook until the workbook is changed after it was written
+    if not os.path.exists(target):
+        return False
+    return not os.path.exists(path) or os.stat(target).st_mtime_ns >= os.stat(path).st_mtime_ns
+
+def load_frame(path, columns=None):
+    """Read a dataset, preferring its Parquet copy
+
+    The first time an .xlsx or .csv is loaded a Parquet copy is written next to it,
+    so later runs skip the slow spreadsheet parse. The copy is only used while it
+    is at least as new as the .xlsx/.csv; an edited workbook or a newly
+    downloaded CSV is converted again.
+    """
+    target = parquet_path(path)
+    metrics = get_metrics()
+    if _parquet_is_current(path, target):
+        with metrics.phase('parquet_io'):
+            return pd.read_parquet(target, columns=columns)
+    if os.path.exists(target):
+        logging.info(f"{path} changed after {target} was written; converting it again")
+
+    with metrics.phase('excel_io'):
+        if path.endswith('.csv'):
+            df = pd.read_csv(path)
+        else:
+            df = pd.read_excel(path)
+    df = apply_dtypes(df)
+    with metrics.phase('parquet_io'):
+        df.to_parquet(target, index=False)
+    logging.info(f"Converted {path} to {target}")
+    return df[columns] if columns is not None else df
+
+def append_frame(df, path, subset=None):
+    """Add rows to a stored dataset, keeping the stored row where `subset` columns repeat"""
+    target = parquet_path(path)
+    if os.path.exists(target):
+        with get_metrics().phase('parquet_io'):
+            df = pd.concat([pd.read_parquet(target), df], ignore_index=True)
+    df = df.drop_duplicates(subset=subset, keep='first').reset_index(drop=True)
+    save_frame(df, path)
+    return df
+
+def export_excel(df, path):
+    """Excel is only an export format: write the workbook for people to open"""
+    with get_metrics().phase('excel_io'):
+        df.to_excel(path, index=False)
+    # The workbook is an export of the Parquet copy written just before it; give it the same
+    # timestamp, so load_frame keeps using the Parquet copy until someone edits the workbook
+    target = parquet_path(path)
+    if target != path and os.path.exists(target):
+        stat = os.stat(target)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    return path
+
+if __name__ == "__main__":
+    # Convert charts.csv and any workbooks given on the command line
+    paths = sys.argv[1:] or ['charts.csv']
+    for path in paths:
+        if os.path.basename(path) == 'charts.csv':
+            convert_charts_csv(path)
+            print(f"Converted {path} to {CHARTS_DATASET}/")
+        else:
+            load_frame(path)
+            print(f"Converted {path} to {parquet_path(path)}")
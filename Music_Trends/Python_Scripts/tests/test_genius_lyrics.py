@@ -0,0 +1,73 @@
+import json
+
+import pandas as pd
+import pytest
+
+import app_config
+import genuisLyrics
+import http_cache
+import throttle
+from bench_suite import StubServer
+
+# Every stub response waits this long, so concurrent requests overlap at the stub
+LATENCY = 0.05
+SONGS = 16
+WORKERS = 8
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open(tmp_path / 'config.json', 'w') as f:
+        json.dump({'GENUIS_API_TOKEN': 'test'}, f)
+    monkeypatch.setattr(app_config, '_configs', {})
+    # Fresh service throttles that never hold a request back; only fetch_all_lyrics' per-host rate applies
+    monkeypatch.setattr(throttle, '_throttles', {})
+    for service in ('genius_search', 'genius_page'):
+        throttle.get_throttle(service, 10000)
+    pd.DataFrame({'Song': [f"Song {i}" for i in range(SONGS)],
+                  'Artist': [f"Artist {i % 5}" for i in range(SONGS)]}).to_excel(tmp_path / 'songs.xlsx', index=False)
+    return tmp_path
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    with StubServer(latency=LATENCY) as server:
+        monkeypatch.setattr(genuisLyrics, 'GENIUS_SEARCH_URL', f"{server.url}/genius/search")
+        yield server
+
+
+def _fetch(workdir, stub, workers, rate=10000):
+    # Each run starts cold: its own copy of the songs, no checkpoint, an empty cache and fresh stub counters
+    source = str(workdir / f'songs_{workers}_{rate}.xlsx')
+    output = str(workdir / f'lyrics_{workers}_{rate}.xlsx')
+    pd.read_excel(workdir / 'songs.xlsx').to_excel(source, index=False)
+    http_cache.configure_cache(str(workdir / f'cache_{workers}_{rate}.sqlite'))
+    stub.requests, stub.arrivals, stub.max_in_flight = 0, [], 0
+    genuisLyrics.fetch_all_lyrics(source, output, workers=workers, rate=rate)
+    df = pd.read_excel(output).sort_values('Song').reset_index(drop=True)
+    return df[['Song', 'Artist', 'Lyrics_URL', 'Lyrics']]
+
+
+def test_concurrent_fetch_overlaps_requests_and_matches_serial_loop(workdir, stub):
+    serial = _fetch(workdir, stub, workers=1)
+    assert stub.max_in_flight == 1
+
+    concurrent = _fetch(workdir, stub, workers=WORKERS)
+    # Two requests per song (search and page), several of them waiting on the stub at once
+    assert stub.requests == 2 * SONGS
+    assert 1 < stub.max_in_flight <= WORKERS
+
+    pd.testing.assert_frame_equal(serial, concurrent)
+    assert serial['Lyrics'].notna().all()
+
+
+def test_concurrent_fetch_respects_the_host_rate(workdir, stub):
+    rate = 20
+    _fetch(workdir, stub, workers=WORKERS, rate=rate)
+
+    # The token bucket lets a burst of `rate` requests through, then one every 1/rate seconds
+    arrivals = sorted(stub.arrivals)
+    assert len(arrivals) == 2 * SONGS
+    for i, arrival in enumerate(arrivals):
+        assert arrival - arrivals[0] >= (i + 1 - rate) / rate - 0.02
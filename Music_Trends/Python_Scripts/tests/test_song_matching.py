@@ -0,0 +1,33 @@
+from song_matching import SongIndex
+
+
+def test_common_title_is_matched_to_its_artist():
+    index = SongIndex()
+    # More songs called "Love" by other artists than the lookup keeps as candidates
+    for i in range(40):
+        index.add('Love', f"Other Artist {i}")
+    target = index.add('Love', 'Target Band')
+
+    assert index.lookup('Lovee', 'Target Band', threshold=0.5) == (target, 4 / 7)
+
+
+def test_other_artists_do_not_match():
+    index = SongIndex()
+    index.add('Love You Baby', 'Artist 385')
+
+    assert index.lookup('Love You Babe', 'Artist 3') is None
+    assert index.lookup('Love You Babe', None) is not None
+
+
+def test_one_shared_co_credit_is_enough():
+    index = SongIndex()
+    song = index.add('Telephone', 'Lady Gaga & Beyonce')
+
+    assert index.lookup('Telephon', 'Beyonce', threshold=0.5)[0] == song
+
+
+def test_songs_without_an_artist_match_any_artist():
+    index = SongIndex()
+    song = index.add('Home', None)
+
+    assert index.lookup('Homee', 'Anyone', threshold=0.5)[0] == song
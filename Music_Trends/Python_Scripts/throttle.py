@@ -0,0 +1,323 @@
+import json
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlparse
+
+import requests
+
+from metrics import get_metrics
+
+# Starting requests per second for each service; the adaptive throttles move from here
+SERVICE_RATES = {
+    'genius_search': 5.0,
+    'genius_page': 5.0,
+    'spotify': 10.0,
+    'itunes': 0.33,  # iTunes Search allows roughly 20 calls a minute
+    'billboard': 2.0,
+}
+
+# Ceilings the adaptive throttles never climb past, for services that document their limit
+SERVICE_MAX_RATES = {
+    'itunes': 20 / 60,  # Apple documents approximately 20 calls a minute
+}
+
+# Network errors worth retrying; anything else is a bug or a real answer and is raised at once
+RETRYABLE_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+
+class TokenBucket:
+    """Token bucket that allows `rate` requests per second with bursts up to `capacity`"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` tokens are available, then take them"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                # Refill based on the time since the last update
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+
+                wait = (tokens - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = float(rate)
+
+
+class HostRateLimiter:
+    """Keep one token bucket per host so every site gets its own request budget"""
+
+    def __init__(self, rate, capacity=None, host_rates=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.host_rates = host_rates or {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket_for(self, host):
+        with self._lock:
+            if host not in self._buckets:
+                rate = self.host_rates.get(host, self.rate)
+                self._buckets[host] = TokenBucket(rate, self.capacity)
+            return self._buckets[host]
+
+    def acquire(self, url):
+        """Wait for a slot on the host that serves `url`"""
+        self.bucket_for(urlparse(url).netloc).acquire()
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a service whose circuit is open"""
+
+
+def jittered_backoff(attempt, base_delay=1.0, max_delay=60.0):
+    """Full-jitter exponential backoff: anywhere from 0 to base_delay * 2**attempt"""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+def _retry_after(headers):
+    try:
+        return float((headers or {}).get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+def classify_outcome(result=None, error=None):
+    """('ok' | 'throttled' | 'failed' | 'error', Retry-After) for a response or a raised error
+
+    'error' is a raised error that says nothing about the service's health
+    (a 4xx answer, a bug in the caller); only returned responses count as 'ok'.
+    """
+    if error is not None:
+        if isinstance(error, RETRYABLE_ERRORS):
+            return 'failed', None
+        # SpotifyException carries http_status/headers, requests' HTTPError a response
+        response = getattr(error, 'response', None)
+        status = getattr(error, 'http_status', None) or getattr(response, 'status_code', None)
+        headers = getattr(error, 'headers', None) or getattr(response, 'headers', None)
+    else:
+        status = getattr(result, 'status_code', 200)
+        headers = getattr(result, 'headers', None)
+
+    if status == 429:
+        return 'throttled', _retry_after(headers)
+    if status is not None and status >= 500:
+        return 'failed', _retry_after(headers)
+    return ('error' if error is not None else 'ok'), None
+
+
+class AdaptiveThrottle:
+    """Request pacing for one service that finds the highest rate the service tolerates
+
+    - AIMD: every success raises the rate by `increase`; a 429 or server error
+      multiplies it by `decrease`. The rate stays between `min_rate` and `max_rate`.
+    - A 429 pauses every caller of the service for Retry-After (or a jittered
+      backoff when the header is missing); failed calls are retried after a
+      jittered exponential backoff.
+    - After `failure_threshold` consecutive failures the circuit opens: nothing
+      is sent for `reset_timeout` seconds, then one probe decides whether it
+      closes again or stays open for twice as long. Callers wait for the probe,
+      or get CircuitOpenError straight away when `wait_when_open` is False.
+    """
+
+    def __init__(self, name, rate, min_rate=None, max_rate=None, increase=None, decrease=0.5,
+                 failure_threshold=5, reset_timeout=30.0, base_delay=1.0, max_delay=60.0, wait_when_open=True):
+        self.name = name
+        self._set_bounds(rate, min_rate, max_rate, increase)
+        self.bucket = TokenBucket(min(rate, self.max_rate))
+        self.decrease = decrease
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.wait_when_open = wait_when_open
+
+        self.state = 'closed'
+        self.counts = Counter()
+        self._failures = 0
+        self._open_for = reset_timeout
+        self._open_until = 0.0
+        self._paused_until = 0.0
+        self._lock = threading.Condition()
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    def _set_bounds(self, rate, min_rate=None, max_rate=None, increase=None):
+        self.min_rate = min_rate or rate / 20
+        self.max_rate = max_rate or rate * 4
+        self.increase = increase or rate / 20
+
+    def reset_rate(self, rate, min_rate=None, max_rate=None, increase=None):
+        """Adapt from `rate` again, with the bounds worked out as for a new throttle"""
+        with self._lock:
+            self._set_bounds(rate, min_rate, max_rate, increase)
+            self.bucket.set_rate(min(rate, self.max_rate))
+
+    def backoff_delay(self, attempt):
+        return jittered_backoff(attempt, self.base_delay, self.max_delay)
+
+    def acquire(self):
+        """Wait until the circuit lets a request through and a token is free"""
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                if self.state == 'closed':
+                    break
+                if self.state == 'open' and now >= self._open_until:
+                    self.state = 'half-open'  # This caller becomes the probe
+                    break
+                if not self.wait_when_open:
+                    raise CircuitOpenError(f"{self.name} circuit is {self.state}")
+                self._lock.wait(max(self._open_until - now, 0.1))
+            pause = self._paused_until - now
+
+        if pause > 0:
+            time.sleep(pause)
+        self.bucket.acquire()
+
+    def _set_rate(self, rate):
+        self.bucket.set_rate(min(self.max_rate, max(self.min_rate, rate)))
+
+    def record_success(self):
+        with self._lock:
+            self.counts['successes'] += 1
+            self._failures = 0
+            if self.state != 'closed':
+                logging.info(f"{self.name} circuit closed")
+                self.state = 'closed'
+                self._open_for = self.reset_timeout
+                self._lock.notify_all()
+            self._set_rate(self.rate + self.increase)
+
+    def record_throttled(self, retry_after=None, attempt=0):
+        with self._lock:
+            self.counts['throttled'] += 1
+            self._set_rate(self.rate * self.decrease)
+            pause = retry_after if retry_after is not None else self.backoff_delay(attempt)
+            self._paused_until = max(self._paused_until, time.monotonic() + pause)
+            if self.state == 'half-open':
+                self._open(self._open_for)
+        logging.warning(f"{self.name} throttled; pausing {pause:.1f}s, rate now {self.rate:.2f}/s")
+
+    def record_failure(self):
+        with self._lock:
+            self.counts['failures'] += 1
+            self._failures += 1
+            self._set_rate(self.rate * self.decrease)
+            if self.state == 'half-open':
+                self._open(min(self._open_for * 2, self.max_delay * 10))
+            elif self.state == 'closed' and self._failures >= self.failure_threshold:
+                self._open(self.reset_timeout)
+
+    def record_error(self):
+        """A raised error that is not the service's fault: the rate and the circuit stay as they are"""
+        with self._lock:
+            self.counts['errors'] += 1
+            if self.state == 'half-open':
+                # The probe told us nothing; let the next caller probe straight away
+                self.state = 'open'
+                self._open_until = time.monotonic()
+                self._lock.notify_all()
+
+    def _open(self, seconds):
+        # Called with the lock held
+        self.state = 'open'
+        self._open_for = seconds
+        self._open_until = time.monotonic() + seconds
+        self.counts['circuit_opens'] += 1
+        self._lock.notify_all()
+        logging.warning(f"{self.name} circuit open for {seconds:.1f}s after {self._failures} failures")
+
+    def call(self, request, retries=3):
+        """Run `request()` under this throttle, retrying throttled and failed attempts
+
+        A response is returned as is once retries run out (callers already handle
+        non-200 answers); a raised error is re-raised. Raised client errors are
+        passed straight through without moving the rate or the circuit.
+        """
+        for attempt in range(retries + 1):
+            self.acquire()
+            with self._lock:
+                self.counts['calls'] += 1
+            result, error = None, None
+            started = time.perf_counter()
+            try:
+                result = request()
+            except Exception as e:
+                error = e
+
+            outcome, retry_after = classify_outcome(result, error)
+            elapsed = time.perf_counter() - started
+            metrics = get_metrics()
+            metrics.observe('request_seconds', elapsed, service=self.name)
+            metrics.count('requests_total', service=self.name, outcome=outcome)
+            metrics.count('phase_seconds_total', elapsed, phase='network')
+            if outcome == 'ok':
+                self.record_success()
+                return result
+            if outcome == 'error':
+                self.record_error()
+                raise error
+
+            if outcome == 'throttled':
+                self.record_throttled(retry_after, attempt)
+            else:
+                self.record_failure()
+
+            if attempt == retries:
+                if error is not None:
+                    raise error
+                return result
+
+            with self._lock:
+                self.counts['retries'] += 1
+            if outcome == 'failed':
+                time.sleep(self.backoff_delay(attempt))
+
+    def snapshot(self):
+        """Live metrics: current rate, circuit state and outcome counters"""
+        with self._lock:
+            return {'service': self.name, 'rate': round(self.rate, 3), 'state': self.state, **self.counts}
+
+
+_throttles = {}
+_throttles_lock = threading.Lock()
+
+def get_throttle(service, rate=None):
+    """The process-wide throttle for `service`, created at `rate` (or its SERVICE_RATES default)
+
+    Passing `rate` for a throttle that already exists resets it to that rate.
+    SERVICE_MAX_RATES caps the rate either way.
+    """
+    with _throttles_lock:
+        max_rate = SERVICE_MAX_RATES.get(service)
+        if service not in _throttles:
+            _throttles[service] = AdaptiveThrottle(service, rate or SERVICE_RATES.get(service, 1.0), max_rate=max_rate)
+        elif rate:
+            _throttles[service].reset_rate(rate, max_rate=max_rate)
+        return _throttles[service]
+
+def throttle_metrics():
+    with _throttles_lock:
+        throttles = list(_throttles.values())
+    return [throttle.snapshot() for throttle in throttles]
+
+def log_throttle_metrics():
+    for metrics in throttle_metrics():
+        logging.info(f"Throttle stats: {json.dumps(metrics)}")
@@ -0,0 +1,292 @@
+import argparse
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+# How long a claimed batch stays with its worker without a heartbeat
+DEFAULT_LEASE_SECONDS = 300
+
+# A song whose batch failed this many times is left out instead of being handed out again
+MAX_ATTEMPTS = 3
+
+
+def worker_name():
+    """Default worker id: host and process, so workers on several machines can share a queue"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def queue_stages(path):
+    """Names of the stages with songs in the queue file at path"""
+    conn = sqlite3.connect(path)
+    try:
+        return [row[0] for row in conn.execute('SELECT DISTINCT stage FROM tasks ORDER BY stage')]
+    finally:
+        conn.close()
+
+def _json_default(value):
+    # numpy scalars and pandas NA end up in fetched rows
+    if hasattr(value, 'item'):
+        return value.item()
+    return None
+
+
+class WorkQueue:
+    """Songs of one stage, handed out in leased batches through a shared SQLite file
+
+    Every worker adds the same songs (adding is idempotent), then claims batches.
+    A claim is a lease: the worker has to heartbeat() before `lease_seconds` run
+    out, otherwise the batch goes to the next worker that asks. Results are
+    stored with the song, so once the queue is drained any worker can merge them.
+    Merging is leased the same way: claim_merge() before writing the output,
+    finish_merge() once it is written.
+    """
+
+    def __init__(self, path, stage, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.stage = stage
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+
+        # Autocommit, so claim() can take the write lock with BEGIN IMMEDIATE
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS tasks ('
+            ' stage TEXT, key TEXT, payload TEXT, state TEXT, worker TEXT, lease_until REAL,'
+            ' attempts INTEGER, result TEXT, PRIMARY KEY (stage, key))'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS tasks_state ON tasks (stage, state)')
+        # Queues from before merges were leased only recorded who merged; their rows would block every retry
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(merges)')]
+        if columns and 'finished_at' not in columns:
+            self._conn.execute('DROP TABLE merges')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS merges (stage TEXT PRIMARY KEY, worker TEXT, lease_until REAL, finished_at REAL)'
+        )
+
+    def add(self, items):
+        """Queue (key, payload) pairs; returns how many were new or queued again
+
+        Keys already queued are left alone, except songs that failed every
+        attempt in an earlier run: they get a fresh set of attempts.
+        """
+        items = [(key, json.dumps(payload, default=_json_default)) for key, payload in items]
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.execute('BEGIN IMMEDIATE')
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO tasks VALUES (?, ?, ?, 'pending', NULL, NULL, 0, NULL)",
+                ((self.stage, key, payload) for key, payload in items),
+            )
+            self._conn.executemany(
+                "UPDATE tasks SET attempts = 0 WHERE stage = ? AND key = ? AND state = 'pending' AND attempts >= ?",
+                ((self.stage, key, self.max_attempts) for key, _ in items),
+            )
+            added = self._conn.total_changes - before
+            if added:
+                # New songs mean the merged output is out of date
+                self._conn.execute('DELETE FROM merges WHERE stage = ?', (self.stage,))
+            self._conn.execute('COMMIT')
+        return added
+
+    def claim(self, worker, limit):
+        """Lease up to `limit` songs that are pending or whose lease ran out; returns [(key, payload)]"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            rows = self._conn.execute(
+                "SELECT key, payload FROM tasks WHERE stage = ? AND attempts < ?"
+                " AND (state = 'pending' OR (state = 'leased' AND lease_until < ?)) LIMIT ?",
+                (self.stage, self.max_attempts, now, limit),
+            ).fetchall()
+            self._conn.executemany(
+                "UPDATE tasks SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1"
+                " WHERE stage = ? AND key = ?",
+                ((worker, now + self.lease_seconds, self.stage, key) for key, _ in rows),
+            )
+            self._conn.execute('COMMIT')
+        return [(key, json.loads(payload)) for key, payload in rows]
+
+    def heartbeat(self, worker):
+        """Extend every lease `worker` holds; returns how many it still holds"""
+        with self._lock:
+            return self._conn.execute(
+                "UPDATE tasks SET lease_until = ? WHERE stage = ? AND state = 'leased' AND worker = ?",
+                (time.time() + self.lease_seconds, self.stage, worker),
+            ).rowcount
+
+    def complete(self, worker, results):
+        """Store {key: result} and mark those songs done
+
+        A result is kept even if the lease had already passed to another worker;
+        the song is simply not fetched a second time.
+        """
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            self._conn.executemany(
+                "UPDATE tasks SET state = 'done', worker = ?, lease_until = NULL, result = ?"
+                " WHERE stage = ? AND key = ? AND state != 'done'",
+                ((worker, json.dumps(result, default=_json_default), self.stage, key) for key, result in results.items()),
+            )
+            self._conn.execute('COMMIT')
+
+    def release(self, worker, keys=None):
+        """Hand `worker`'s leased songs (or just `keys`) back to the queue"""
+        query = "UPDATE tasks SET state = 'pending', worker = NULL, lease_until = NULL WHERE stage = ? AND state = 'leased' AND worker = ?"
+        with self._lock:
+            if keys is None:
+                self._conn.execute(query, (self.stage, worker))
+            else:
+                self._conn.executemany(query + ' AND key = ?', ((self.stage, worker, key) for key in keys))
+
+    def counts(self):
+        """Songs per state; pending songs that used up their attempts count as failed"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT CASE WHEN state != 'done' AND attempts >= ? AND (state = 'pending' OR lease_until < ?)"
+                " THEN 'failed' ELSE state END, COUNT(*) FROM tasks WHERE stage = ? GROUP BY 1",
+                (self.max_attempts, time.time(), self.stage),
+            ).fetchall()
+        counts = {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}
+        counts.update(dict(rows))
+        return counts
+
+    def drained(self):
+        """True once no song is waiting or leased"""
+        counts = self.counts()
+        return counts['pending'] == 0 and counts['leased'] == 0
+
+    def results(self):
+        """{key: result} of every finished song"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, result FROM tasks WHERE stage = ? AND state = 'done'", (self.stage,)
+            ).fetchall()
+        return {key: json.loads(result) for key, result in rows}
+
+    def claim_merge(self, worker):
+        """True for the one worker of a drained queue that writes the merged output
+
+        The claim is a lease. If its worker never calls finish_merge(), e.g.
+        because it crashed while writing, the merge goes to whoever asks once
+        the lease has run out. A finished merge is not handed out again until
+        new songs are added or reset_merge() is called.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            row = self._conn.execute(
+                'SELECT worker, lease_until, finished_at FROM merges WHERE stage = ?', (self.stage,)
+            ).fetchone()
+            claimed = row is None or (row[2] is None and (row[0] == worker or row[1] < now))
+            if claimed:
+                self._conn.execute('INSERT OR REPLACE INTO merges VALUES (?, ?, ?, NULL)',
+                                   (self.stage, worker, now + self.lease_seconds))
+            self._conn.execute('COMMIT')
+        return claimed
+
+    def finish_merge(self, worker):
+        """Record that `worker` has written the merged output"""
+        with self._lock:
+            self._conn.execute(
+                'UPDATE merges SET finished_at = ? WHERE stage = ? AND worker = ? AND finished_at IS NULL',
+                (time.time(), self.stage, worker),
+            )
+
+    def merge_state(self):
+        """'open', 'merging' or 'merged'"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT lease_until, finished_at FROM merges WHERE stage = ?', (self.stage,)
+            ).fetchone()
+        if row is None or (row[1] is None and row[0] < time.time()):
+            return 'open'
+        return 'merged' if row[1] is not None else 'merging'
+
+    def reset_merge(self):
+        """Let the next worker that drains the queue write the output again, e.g. after it was lost"""
+        with self._lock:
+            self._conn.execute('DELETE FROM merges WHERE stage = ?', (self.stage,))
+
+    def close(self):
+        self._conn.close()
+
+
+class Heartbeat:
+    """Keeps a worker's leases alive from a background thread while its batch is being fetched"""
+
+    def __init__(self, queue, worker, interval=None):
+        self.queue = queue
+        self.worker = worker
+        self.interval = interval or queue.lease_seconds / 3
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.queue.heartbeat(self.worker)
+            except sqlite3.Error as e:
+                logging.warning(f"Heartbeat for {self.worker} failed: {e}")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_worker(queue, worker, process_batch, batch_size=25, poll=5.0):
+    """Claim and process batches until the queue is drained; returns the number of songs this worker did
+
+    `process_batch([(key, payload), ...])` returns {key: result}. Keys it leaves
+    out, and whole batches that raise, go back to the queue for another attempt.
+    While other workers still hold leases this one waits, and takes over any
+    lease that runs out.
+    """
+    processed = 0
+    with Heartbeat(queue, worker):
+        while True:
+            items = queue.claim(worker, batch_size)
+            if not items:
+                if queue.drained():
+                    break
+                time.sleep(poll)
+                continue
+
+            try:
+                results = process_batch(items)
+            except Exception as e:
+                logging.error(f"Worker {worker} failed on a batch of {len(items)}: {e}")
+                queue.release(worker, [key for key, _ in items])
+                continue
+
+            queue.complete(worker, results)
+            queue.release(worker, [key for key, _ in items if key not in results])
+            processed += len(results)
+            counts = queue.counts()
+            print(f"[{worker}] {processed} songs done here; queue: {counts['done']} done, "
+                  f"{counts['pending']} pending, {counts['leased']} leased, {counts['failed']} failed")
+    return processed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the state of a shared work queue")
+    parser.add_argument('path', help="The SQLite queue file")
+    parser.add_argument('--remerge', metavar='STAGE', action='append', default=[],
+                        help="Let the next worker of this stage write its merged output again")
+    args = parser.parse_args()
+
+    for stage in queue_stages(args.path):
+        queue = WorkQueue(args.path, stage)
+        if stage in args.remerge:
+            queue.reset_merge()
+        counts = queue.counts()
+        print(f"{stage}: {counts['done']} done, {counts['pending']} pending, {counts['leased']} leased, "
+              f"{counts['failed']} failed; merge {queue.merge_state()}")
+        queue.close()